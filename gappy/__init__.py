@@ -1,11 +1,10 @@
 # -*- coding: utf-8 -*-
 import time
-import json
+import zlib
+import importlib
 import threading
-import collections
-import bisect
-import requests
 from . import api
+from . import codec
 from . import exception
 
 
@@ -14,37 +13,140 @@ __version_info__ = (0, 4, 3)
 __version__ = '.'.join(map(str, __version_info__))
 
 
+# Submodules imported on first use rather than with the package, so that a
+# short-lived process sending one message does not pay for all of them.
+_lazy_modules = frozenset(['aio', 'broadcast', 'coalesce', 'dispatch', 'history', 'keyboard',
+                           'metrics', 'outbox', 'process', 'ratelimit', 'schedule', 'scheduler',
+                           'store', 'template', 'upload', 'webhook'])
+
+
+def __getattr__(name):
+    if name in _lazy_modules:
+        return importlib.import_module('.' + name, __name__)
+    raise AttributeError('module %r has no attribute %r' % (__name__, name))
+
+
+class _Lazy(object):
+    """Class attribute imported from a submodule when first read."""
+
+    def __init__(self, module, name):
+        self._module = module
+        self._name = name
+
+    def __set_name__(self, owner, attr):
+        self._owner = owner
+        self._attr = attr
+
+    def __get__(self, obj, cls):
+        value = getattr(importlib.import_module(self._module, __name__), self._name)
+        setattr(self._owner, self._attr, value)
+        return value
+
+
 class _BotBase(object):
-    def __init__(self, token):
+    def __init__(self, token, base_url=None):
         self._token = token
+        self._base_url = base_url
         self._file_chunk_size = 65536
 
 
-def _strip(params, more=[]):
-    return {key: value for key, value in params.items() if key not in ['self'] + more}
+def _make_jsonable(value):
+    if isinstance(value, list):
+        return [_make_jsonable(v) for v in value]
+    elif isinstance(value, dict):
+        return {k: _make_jsonable(v) for k, v in value.items() if v is not None}
+    elif isinstance(value, tuple) and hasattr(value, '_asdict'):
+        return {k: _make_jsonable(v) for k, v in value._asdict().items() if v is not None}
+    else:
+        return value
 
 
-def _rectify(params):
-    def make_jsonable(value):
-        if isinstance(value, list):
-            return [make_jsonable(v) for v in value]
-        elif isinstance(value, dict):
-            return {k: make_jsonable(v) for k, v in value.items() if v is not None}
-        elif isinstance(value, tuple) and hasattr(value, '_asdict'):
-            return {k: make_jsonable(v) for k, v in value._asdict().items() if v is not None}
-        else:
-            return value
+# Values sent as they are, without a trip through `_make_jsonable`.
+_plain = frozenset([str, int, float, bool])
 
-    def flatten(value):
-        v = make_jsonable(value)
+# Keyboards and forms built ahead, sent as the JSON they carry; filled in by
+# `gappy.keyboard` when it is imported, before any of them can exist.
+_prebuilt = set()
 
-        if isinstance(v, (dict, list)):
-            return json.dumps(v, separators=(',', ':'))
-        else:
-            return v
 
+def _flatten(value):
+    if type(value) in _prebuilt:
+        return value.json
+    v = _make_jsonable(value)
+
+    if isinstance(v, (dict, list)):
+        return codec.dumps(v)
+    else:
+        return v
+
+
+# Keyboards and forms are often the very same object on every call. Their
+# JSON is kept by identity, next to the jsonable copy it was made from; the
+# copy is compared with the object (in C) to notice in-place changes.
+# Entries hold the object itself, so that its id is not reused while cached:
+# up to `_json_cache_size` keyboards and forms are kept alive until the cache
+# fills up and is cleared. Use `gappy.keyboard` for ones sent many times.
+_json_cache = {}
+_json_cache_size = 256
+
+
+def _flatten_cached(value):
+    if type(value) in _prebuilt:
+        return value.json
+    entry = _json_cache.get(id(value))
+    if entry is not None and entry[0] is value and entry[1] == value:
+        return entry[2]
+
+    v = _make_jsonable(value)
+    if not isinstance(v, (dict, list)):
+        return v
+    text = codec.dumps(v)
+    if len(_json_cache) >= _json_cache_size:
+        _json_cache.clear()
+    _json_cache[id(value)] = (value, v, text)
+    return text
+
+
+_cached_fields = frozenset(['reply_keyboard', 'inline_keyboard', 'form'])
+
+
+def _rectify(params):
     # remove None, then json-serialize if needed
-    return {k: flatten(v) for k, v in params.items() if v is not None}
+    return {k: v if type(v) in _plain else
+            _flatten_cached(v) if k in _cached_fields else _flatten(v)
+            for k, v in params.items() if v is not None}
+
+
+def _encoder(*names):
+    """
+    Compile the payload builder of an API method.
+
+    The builder takes one value per field name, in order, and returns what
+    ``_rectify`` would for the same fields, without going through ``locals()``.
+    """
+    fields = tuple((name, _flatten_cached if name in _cached_fields else _flatten) for name in names)
+
+    def encode(*values):
+        p = {}
+        for (name, flatten), v in zip(fields, values):
+            if v is not None:
+                p[name] = v if type(v) in _plain else flatten(v)
+        return p
+    return encode
+
+
+_message_payload = _encoder('chat_id', 'type', 'data', 'reply_keyboard', 'inline_keyboard', 'form')
+_edit_payload = _encoder('chat_id', 'message_id', 'data', 'inline_keyboard')
+_delete_payload = _encoder('chat_id', 'message_id')
+_callback_payload = _encoder('chat_id', 'callback_id', 'text', 'show_alert')
+_invoice_payload = _encoder('chat_id', 'amount', 'description')
+_pay_payload = _encoder('chat_id', 'ref_id')
+_wallet_payload = _encoder('chat_id', 'desc')
+
+
+def _decoded(result):
+    # Some methods answer with a JSON document inside a JSON string.
+    return codec.loads(result) if isinstance(result, (str, bytes)) else result
 
 
 def t(var_boolean):
@@ -57,140 +159,174 @@ class Bot(_BotBase):
     """
     A class that is sorted by timestamp.
 
-    Use `bisect` module to ensure order in event queue.
+    Use `heapq` module to ensure order in event queue.
     """
 
-    class Scheduler(threading.Thread):
-        Event = collections.namedtuple('Event', ['timestamp', 'data'])
-        Event.__eq__ = lambda self, other: self.timestamp == other.timestamp
-        Event.__ne__ = lambda self, other: self.timestamp != other.timestamp
-        Event.__gt__ = lambda self, other: self.timestamp > other.timestamp
-        Event.__ge__ = lambda self, other: self.timestamp >= other.timestamp
-        Event.__lt__ = lambda self, other: self.timestamp < other.timestamp
-        Event.__le__ = lambda self, other: self.timestamp <= other.timestamp
-
-        def __init__(self):
-            """Reentrant lock to allow locked method calling locked method."""
-            super(Bot.Scheduler, self).__init__()
-            self._eventq = []
-            self._lock = threading.RLock()
-            self._event_handler = None
-
-        def _locked(fn):
-            def k(self, *args, **kwargs):
-                with self._lock:
-                    return fn(self, *args, **kwargs)
-            return k
-
-        @_locked
-        def _insert_event(self, data, when):
-            ev = self.Event(when, data)
-            bisect.insort(self._eventq, ev)
-            return ev
-
-        @_locked
-        def _remove_event(self, event):
-            # Find event according to its timestamp.
-            # Index returned should be one behind.
-            i = bisect.bisect(self._eventq, event)
-
-            """ Having two events with identical timestamp is unlikely but possible.
-            I am going to move forward and compare timestamp AND object address
-            to make sure the correct object is found."""
-
-            while i > 0:
-                i -= 1
-                e = self._eventq[i]
-
-                if e.timestamp != event.timestamp:
-                    raise exception.EventNotFound(event)
-                elif id(e) == id(event):
-                    self._eventq.pop(i)
-                    return
-
-            raise exception.EventNotFound(event)
-
-        @_locked
-        def _pop_expired_event(self):
-            if not self._eventq:
-                return None
-
-            if self._eventq[0].timestamp <= time.time():
-                return self._eventq.pop(0)
-            else:
-                return None
-
-        def event_at(self, when, data):
-            """
-            Schedule some data to emit at an absolute timestamp.
-
-            :type when: int or float
-            :type data: dictionary
-            :return: an internal Event object
-            """
-            return self._insert_event(data, when)
-
-        def event_later(self, delay, data):
-            """
-            Schedule some data to emit after a number of seconds.
-
-            :type delay: int or float
-            :type data: dictionary
-            :return: an internal Event object
-            """
-            return self._insert_event(data, time.time() + delay)
-
-        def event_now(self, data):
-            """
-            Emit some data as soon as possible.
-
-            :type data: dictionary
-            :return: an internal Event object
-            """
-            return self._insert_event(data, time.time())
-
-        def cancel(self, event):
-            """
-            Cancel an event.
-
-            :type event: an internal Event object
-            """
-            self._remove_event(event)
-
-        def run(self):
-            while 1:
-                e = self._pop_expired_event()
-                while e:
-                    if callable(e.data):
-                        d = e.data()  # call the data-producing function
-                        if d is not None:
-                            self._event_handler(d)
-                    else:
-                        self._event_handler(e.data)
-
-                    e = self._pop_expired_event()
-                time.sleep(0.1)
-
-        def run_as_thread(self):
-            self.daemon = True
-            self.start()
-
-        def on_event(self, fn):
-            self._event_handler = fn
-
-    def __init__(self, token):
-        """TOKEN."""
-        super(Bot, self).__init__(token)
-        self._scheduler = self.Scheduler()
-        self._last_message = ''
-
-    def _api_request(self, method, params=None, **kwargs):
+    Scheduler = _Lazy('.scheduler', 'Scheduler')
+
+    def __init__(self, token, session=None, pool_size=10, timeout=None, base_url=None,
+                 upload_cache=None, limiter=None, retry=None, history=None):
+        """
+        TOKEN.
+
+        :param session: a ``requests.Session`` to reuse; one is created with
+            ``api.create_session`` if not given
+        :param pool_size: maximum number of keep-alive connections kept to Gap
+        :param timeout: default timeout, in seconds, for every API call
+        :param base_url: API root, defaults to ``api.API_URL``
+        :param upload_cache: a ``gappy.upload.UploadCache``; files found in it
+            are not uploaded again
+        :param limiter: a ``gappy.ratelimit.RateLimiter`` applied to every API call
+        :param retry: a ``gappy.ratelimit.RetryPolicy`` applied to every API call
+        :param history: a ``gappy.history.MessageHistory`` keeping sent messages
+        """
+        super(Bot, self).__init__(token, base_url)
+        # The session, and `requests` with it, is made on the first call.
+        self._session = session
+        self._pool_size = pool_size
+        self._session_lock = threading.Lock()
+        self._timeout = timeout
+        self._upload_cache = upload_cache
+        self._limiter = limiter
+        self._retry = retry
+        self._hooks = None
+        if history is None:
+            from . import history as gappy_history
+            history = gappy_history.MessageHistory()
+        self._history = history
+
+    @property
+    def tokens(self):
+        return [self._token]
+
+    def token_for(self, chat_id):
+        """Token serving a chat."""
+        return self._token
+
+    def _get_session(self):
+        if self._session is None:
+            with self._session_lock:
+                if self._session is None:
+                    self._session = api.create_session(pool_maxsize=self._pool_size)
+        return self._session
+
+    def _api_request(self, method, params=None, token=None, **kwargs):
         if method == 'sendMessage':
-            self._last_message = params
-        return api.request((self._token, method, params), **kwargs)
+            self._history.record(params)
+        kwargs.setdefault('session', self._get_session())
+        kwargs.setdefault('timeout', self._timeout)
+        kwargs.setdefault('base_url', self._base_url)
+        kwargs.setdefault('limiter', self._limiter)
+        kwargs.setdefault('retry', self._retry)
+        kwargs.setdefault('hooks', self._hooks)
+        return api.request((token or self._token, method, params), **kwargs)
+
+    def _get_hooks(self):
+        if self._hooks is None:
+            self._hooks = api.Hooks()
+        return self._hooks
+
+    def on_request(self, fn):
+        """
+        Call ``fn(method, params)`` before every API call.
+
+        May be used as a decorator.
+        """
+        self._get_hooks().pre.append(fn)
+        return fn
+
+    def on_response(self, fn):
+        """
+        Call ``fn(observation)`` after every API call and upload, with a
+        ``gappy.api.Observation`` of its latency, size and outcome.
+
+        May be used as a decorator.
+        """
+        self._get_hooks().post.append(fn)
+        return fn
+
+    def add_metrics(self, collector=None):
+        """
+        Collect latency, traffic and error metrics of every API call.
+
+        :param collector: a ``gappy.metrics.MetricsCollector``, created if not given
+        :return: the collector
+        """
+        if collector is None:
+            from . import metrics
+            collector = metrics.MetricsCollector()
+        self.on_response(collector.observe)
+        return collector
+
+    def dispatcher(self, workers=8, maxsize=1024, timeout=None):
+        """
+        Dispatcher making calls in order within a chat, in parallel across chats.
+
+        :return: a ``gappy.dispatch.Dispatcher`` with the send methods of this
+            bot, each returning a future
+        """
+        from . import dispatch
+        return dispatch.Dispatcher(self, workers, maxsize, timeout)
+
+    def outbox(self, path, workers=4, **kwargs):
+        """
+        Outbox keeping calls on disk until Gap has accepted them.
+
+        :param path: SQLite database file; calls left in it by an earlier
+            run are sent again
+        :return: a ``gappy.outbox.Outbox`` with the send methods of this
+            bot, each returning the idempotency key of the queued call
+        """
+        from . import outbox
+        return outbox.Outbox(self, path, workers, **kwargs)
+
+    def coalescer(self, window=0.5, workers=4):
+        """
+        Coalescer for messages edited over and over, e.g. progress bars.
+
+        :param window: least number of seconds between two edits of a message
+        :return: a ``gappy.coalesce.EditCoalescer`` with the ``edit_message``
+            and ``delete_message`` methods of this bot, each returning a future
+        """
+        from . import coalesce
+        return coalesce.EditCoalescer(self, window, workers)
+
+    def uploader(self, workers=4, bandwidth=None, maxsize=1024):
+        """
+        Uploader sending several files at once.
+
+        :param bandwidth: bytes per second over all uploads, or ``None`` for
+            no limit
+        :return: a ``gappy.upload.UploadManager`` whose ``upload_file``
+            returns a future
+        """
+        from . import upload
+        return upload.UploadManager(self, workers, bandwidth, maxsize)
+
+    def close(self):
+        """Close all pooled connections of this bot."""
+        if self._session is not None:
+            self._session.close()
+
+    def get_last_message(self, chat_id=None):
+        """
+        Last message sent.
+
+        :param chat_id: chat to look in; any chat if not given
+        :return: payload of the message, or an empty string
+        """
+        last = self._history.last(chat_id)
+        return last if last is not None else ''
+
+    def get_recent_messages(self, chat_id, n=None):
+        """
+        Messages last sent to a chat.
 
-    def get_last_message(self):
-        return self._last_message
+        :param chat_id: int
+        :param n: maximum number of messages
+        :return: list of payloads, oldest first
+        """
+        return self._history.recent(chat_id, n)
 
     def send_text(
         self,
@@ -210,8 +346,7 @@ class Bot(_BotBase):
         :param form: json/dict
         :return: array
         """
-        type = 'text'
-        p = _rectify(_strip(locals()))
+        p = _message_payload(chat_id, 'text', data, reply_keyboard, inline_keyboard, form)
         return self._api_request('sendMessage', p)
 
     def send_image(
@@ -236,19 +371,14 @@ class Bot(_BotBase):
         """
         type = 'image'
         try:
-            tmp = json.loads(image)
+            tmp = codec.loads(image)
             tmp.update({'desc': desc})
-            image = json.dumps(tmp)
-            data = image
-            del image, desc, tmp
-            p = _rectify(_strip(locals()))
-
+            data = codec.dumps(tmp)
         except Exception:
             # if os.path.isfile(image):
                 # raise ValueError('Image path is invalid')
-            type, data = self.upload_file('image', image, desc)
-            del desc
-            p = _rectify(_strip(locals()))
+            type, data = self.upload_file('image', image, desc, self.token_for(chat_id))
+        p = _message_payload(chat_id, type, data, reply_keyboard, inline_keyboard, form)
 
         return self._api_request('sendMessage', p)
 
@@ -274,18 +404,14 @@ class Bot(_BotBase):
         """
         type = 'audio'
         try:
-            tmp = json.loads(audio)
+            tmp = codec.loads(audio)
             tmp.update({'desc': desc})
-            audio = json.dumps(tmp)
-            data = audio
-            del audio, desc, tmp
-            p = _rectify(_strip(locals()))
+            data = codec.dumps(tmp)
         except Exception:
             # if os.path.isfile(audio):
                 # raise ValueError('Audio path is invalid')
-            type, data = self.upload_file('audio', audio, desc)
-            del desc
-            p = _rectify(_strip(locals()))
+            type, data = self.upload_file('audio', audio, desc, self.token_for(chat_id))
+        p = _message_payload(chat_id, type, data, reply_keyboard, inline_keyboard, form)
 
         return self._api_request('sendMessage', p)
 
@@ -311,18 +437,14 @@ class Bot(_BotBase):
         """
         type = 'video'
         try:
-            tmp = json.loads(video)
+            tmp = codec.loads(video)
             tmp.update({'desc': desc})
-            video = json.dumps(tmp)
-            data = video
-            del video, desc, tmp
-            p = _rectify(_strip(locals()))
+            data = codec.dumps(tmp)
         except Exception:
             # if os.path.isfile(video):
                 # raise ValueError('Video path is invalid')
-            type, data = self.upload_file('video', video, desc)
-            del video, desc
-            p = _rectify(_strip(locals()))
+            type, data = self.upload_file('video', video, desc, self.token_for(chat_id))
+        p = _message_payload(chat_id, type, data, reply_keyboard, inline_keyboard, form)
 
         return self._api_request('sendMessage', p)
 
@@ -348,18 +470,14 @@ class Bot(_BotBase):
         """
         type = 'file'
         try:
-            tmp = json.loads(file)
+            tmp = codec.loads(file)
             tmp.update({'desc': desc})
-            file = json.dumps(tmp)
-            data = file
-            del file, desc, tmp
-            p = _rectify(_strip(locals()))
+            data = codec.dumps(tmp)
         except Exception:
             # if os.path.isfile(file):
                 # raise ValueError('File path is invalid')
-            type, data = self.upload_file('file', file, desc)
-            del desc
-            p = _rectify(_strip(locals()))
+            type, data = self.upload_file('file', file, desc, self.token_for(chat_id))
+        p = _message_payload(chat_id, type, data, reply_keyboard, inline_keyboard, form)
 
         return self._api_request('sendMessage', p)
 
@@ -385,18 +503,14 @@ class Bot(_BotBase):
         """
         type = 'voice'
         try:
-            tmp = json.loads(voice)
+            tmp = codec.loads(voice)
             tmp.update({'desc': desc})
-            voice = json.dumps(tmp)
-            data = voice
-            del voice, desc, tmp
-            p = _rectify(_strip(locals()))
+            data = codec.dumps(tmp)
         except Exception:
             # if os.path.isfile(voice):
                 # raise ValueError('Voice path is invalid')
-            type, data = self.upload_file('voice', voice, desc)
-            del desc
-            p = _rectify(_strip(locals()))
+            type, data = self.upload_file('voice', voice, desc, self.token_for(chat_id))
+        p = _message_payload(chat_id, type, data, reply_keyboard, inline_keyboard, form)
 
         return self._api_request('sendMessage', p)
 
@@ -442,12 +556,10 @@ class Bot(_BotBase):
         :param form: json
         :return: Array
         """
-        data = json.dumps(dict(lat=lat, long=long, desc=desc))
-        del lat, long, desc
-        type = 'location'
-        p = _rectify(_strip(locals()))
+        data = codec.dumps(dict(lat=lat, long=long, desc=desc))
+        p = _message_payload(chat_id, 'location', data, reply_keyboard, inline_keyboard, form)
         mes = self._api_request('location', p)
-        return json.loads(mes)['id'] if mes else False
+        return _decoded(mes)['id'] if mes else False
 
     def send_contact(
         self,
@@ -469,12 +581,102 @@ class Bot(_BotBase):
         :param form: json
         :return: Array
         """
-        type = 'contact'
-        data = json.dumps(dict(phone=phone, name=name))
-        del phone, name
-        p = _rectify(_strip(locals()))
+        data = codec.dumps(dict(phone=phone, name=name))
+        p = _message_payload(chat_id, 'contact', data, reply_keyboard, inline_keyboard, form)
         mes = self._api_request('contact', p)
-        return json.loads(mes)['id'] if mes else False
+        return _decoded(mes)['id'] if mes else False
+
+    def broadcast(
+        self,
+        chat_ids,
+        type,
+        data,
+        desc="",
+        reply_keyboard=None,
+        inline_keyboard=None,
+        form=None,
+        workers=8
+    ):
+        """
+        Broadcast one message to many chats.
+
+        The payload is built once. Files are uploaded once per bot account,
+        before the first message is sent. Raise ``pool_size`` to at least ``workers`` to give
+        every worker a kept-alive connection.
+
+        :param chat_ids: iterable of chat ids
+        :param type: text, image, audio, video, file, voice, location or contact
+        :param data: text, file path or descriptor, or a dict for location
+            and contact
+        :param desc: string
+        :param reply_keyboard: string
+        :param inline_keyboard: array
+        :param form: json
+        :param workers: maximum number of concurrent requests
+        :return: a ``gappy.broadcast.Broadcast`` to iterate for per-chat results
+        """
+        files = None
+        if type in ('image', 'audio', 'video', 'file', 'voice'):
+            try:
+                tmp = codec.loads(data)
+                tmp.update({'desc': desc})
+                data = codec.dumps(tmp)
+            except Exception:
+                # once for each account, as one cannot send another's files
+                files = {t: self.upload_file(type, data, desc, t) for t in self.tokens}
+        method = type if type in ('location', 'contact') else 'sendMessage'
+        if files is None:
+            payloads = None
+            p = _message_payload(None, type, data, reply_keyboard, inline_keyboard, form)
+        else:
+            payloads = {t: _message_payload(None, type, d, reply_keyboard, inline_keyboard, form)
+                        for t, (type, d) in files.items()}
+
+        def send(chat_id):
+            params = dict(p if payloads is None else payloads[self.token_for(chat_id)])
+            params['chat_id'] = chat_id
+            return self._api_request(method, params)
+
+        from . import broadcast
+        return broadcast.Broadcast(send, chat_ids, workers)
+
+    def send_template(
+        self,
+        chat_id,
+        template,
+        **variables
+    ):
+        """
+        Send a message made from a template.
+
+        :param chat_id: int
+        :param template: a ``gappy.template.Template``
+        :param variables: values for the fields of its text
+        :return: array
+        """
+        return self._api_request('sendMessage', template.render(chat_id, variables))
+
+    def broadcast_template(
+        self,
+        template,
+        recipients,
+        workers=8
+    ):
+        """
+        Broadcast a template, filled in for each chat.
+
+        :param template: a ``gappy.template.Template``
+        :param recipients: iterable of ``(chat_id, variables)`` pairs, where
+            ``variables`` is a dict of values for the fields of the text
+        :param workers: maximum number of concurrent requests
+        :return: a ``gappy.broadcast.Broadcast`` to iterate for per-chat results
+        """
+        from . import broadcast
+
+        def send(chat_id, variables):
+            return self._api_request('sendMessage', template.render(chat_id, variables))
+
+        return broadcast.Broadcast(send, recipients, workers, pairs=True)
 
     def edit_message(
         self,
@@ -492,7 +694,7 @@ class Bot(_BotBase):
         :param inline_keyboard: array
         :return: array
         """
-        p = _rectify(_strip(locals()))
+        p = _edit_payload(chat_id, message_id, data, inline_keyboard)
         return self._api_request('editMessage', p)
 
     def delete_message(
@@ -507,7 +709,7 @@ class Bot(_BotBase):
         :param message_id: int
         :return: array
         """
-        p = _rectify(_strip(locals()))
+        p = _delete_payload(chat_id, message_id)
         return self._api_request('deleteMessage', p)
 
     def answer_callback(
@@ -527,7 +729,7 @@ class Bot(_BotBase):
         :return: array
         """
         show_alert = t(show_alert)
-        p = _rectify(_strip(locals()))
+        p = _callback_payload(chat_id, callback_id, text, show_alert)
         return self._api_request('answerCallback', p)
 
     def send_invoice(
@@ -544,9 +746,9 @@ class Bot(_BotBase):
         :param description: string
         :return: string
         """
-        p = _rectify(_strip(locals()))
+        p = _invoice_payload(chat_id, amount, description)
         res = self._api_request('invoice', p)
-        res = json.loads(res)
+        res = _decoded(res)
         return res['id']
 
     def pay_verify(
@@ -561,9 +763,9 @@ class Bot(_BotBase):
         :param ref_id: int
         :return: boolean
         """
-        p = _rectify(_strip(locals()))
+        p = _pay_payload(chat_id, ref_id)
         res = self._api_request('payVerify', p)
-        res = json.loads(res)
+        res = _decoded(res)
         if isinstance(res, list):
             return res['status'] == 'verified'
 
@@ -579,9 +781,9 @@ class Bot(_BotBase):
         :param ref_id: int
         :return: boolean
         """
-        p = _rectify(_strip(locals()))
+        p = _pay_payload(chat_id, ref_id)
         res = self._api_request('payInquiry', p)
-        res = json.loads(res)
+        res = _decoded(res)
         if isinstance(res, list):
             return res['status'] == 'verified'
 
@@ -597,7 +799,7 @@ class Bot(_BotBase):
         :param desc: string
         :return: string
         """
-        p = _rectify(_strip(locals()))
+        p = _wallet_payload(chat_id, desc)
         return self._api_request('requestWalletCharge', p)
 
     def reply_keyboard(
@@ -609,34 +811,143 @@ class Bot(_BotBase):
         """
         Reply keyboard.
 
-        :param keyboard: keyboard
+        Build a ``gappy.keyboard.ReplyKeyboard`` once instead to send the
+        same keyboard many times.
+
+        :param keyboard: list of rows, each a list of buttons
         :param once: once
         :param selective: boolean
-        :return: boolean
+        :return: string
         """
-        if isinstance(keyboard, list):
+        if not isinstance(keyboard, (list, tuple)):
             raise ValueError("Keyboard must be array")
-        p = _rectify(_strip(locals()))
-        return json.dumps(p)
+        from . import keyboard as gappy_keyboard
+        return gappy_keyboard.ReplyKeyboard(keyboard, once, selective).json
 
     def upload_file(
         self,
         content_type,
         file,
-        desc=None
+        desc=None,
+        token=None
     ):
+        """
+        Upload File.
+
+        The file is streamed in chunks of ``_file_chunk_size`` bytes. With an
+        upload cache, a file uploaded before is not sent again.
 
-        r = requests.post(
-            'https://api.gap.im/upload',
-            files={content_type: open(file, 'rb')},
-            headers={'token': self._token}
-        )
-        if r.ok:
-            p = json.loads(r.text)
-            if desc:
-                p.update({'desc': desc})
-                return content_type, json.dumps(p)
+        :param content_type: string
+        :param file: path, binary file object, bytes or memoryview
+        :param desc: string
+        :param token: bot account to upload with, which must be the one
+            sending the file; ``token_for(None)`` by default
+        :return: tuple of content type and the uploaded file descriptor
+        """
+        key = p = None
+        if self._upload_cache is not None:
+            key = self._upload_key(self._upload_cache, content_type, file, token)
+            if key is not None:
+                p = self._upload_cache.get(key)
+
+        if p is None:
+            p = self._upload(content_type, file, token=token)
+            if key is not None:
+                self._upload_cache.put(key, p)
+
+        if desc:
+            p.update({'desc': desc})
+        return content_type, codec.dumps(p)
+
+    def _upload_key(self, cache, content_type, file, token=None):
+        return cache.key(content_type, file, self._file_chunk_size)
+
+    def _upload(self, content_type, file, meter=None, token=None):
+        hooks = self._hooks
+        from . import upload
+        with upload.MultipartStream(content_type, file, self._file_chunk_size, meter=meter) as stream:
+            req = (token or self.token_for(None), 'upload', stream)
+            fn, kwargs = api._transform(req,
+                                        session=self._get_session(),
+                                        timeout=self._timeout,
+                                        base_url=self._base_url)
+            if hooks is None:
+                r = fn(**kwargs)
             else:
-                return content_type, json.dumps(p)
-        else:
+                for h in hooks.pre:
+                    h('upload', None)
+                start = time.perf_counter()
+                r = None
+                try:
+                    r = fn(**kwargs)
+                    if not r.ok:
+                        raise ValueError(r.status_code, r.reason)
+                except Exception as e:
+                    api._observe(hooks, req, start, r, e)
+                    raise
+                api._observe(hooks, req, start, r, None)
+        if not r.ok:
             raise ValueError(r.status_code, r.reason)
+        return codec.loads(r.content)
+
+
+def _jump_hash(key, buckets):
+    # Jump consistent hash (Lamping & Veach): adding a bucket moves only
+    # 1/buckets of the keys, all of them to the new bucket.
+    b, j = -1, 0
+    while j < buckets:
+        b = j
+        key = (key * 2862933555777941757 + 1) & 0xffffffffffffffff
+        j = int((b + 1) * (float(1 << 31) / float((key >> 33) + 1)))
+    return b
+
+
+class BotPool(Bot):
+    """
+    A ``Bot`` sending through several bot accounts.
+
+    Each chat is served by one token, picked by a hash of the chat id that
+    does not change between runs; appending a token moves only its share of
+    the chats to it. The tokens share one connection pool, rate limiter,
+    retry policy, message history and hooks, so metrics cover the whole
+    pool. A shared limiter's overall ``rate`` is for the pool as a whole.
+
+    Calls without a chat use the first token. Files sent to a chat are
+    uploaded with the chat's token, and cached for each token apart.
+    """
+
+    def __init__(self, tokens, **kwargs):
+        """
+        :param tokens: list of bot tokens
+        :param kwargs: as for ``Bot``
+        """
+        tokens = list(tokens)
+        if not tokens:
+            raise ValueError('At least one token is required')
+        super(BotPool, self).__init__(tokens[0], **kwargs)
+        self._tokens = tokens
+
+    @property
+    def tokens(self):
+        return list(self._tokens)
+
+    def token_for(self, chat_id):
+        """Token serving a chat."""
+        if chat_id is None:
+            return self._tokens[0]
+        key = zlib.crc32(str(chat_id).encode('utf-8'))
+        return self._tokens[_jump_hash(key, len(self._tokens))]
+
+    def _upload_key(self, cache, content_type, file, token=None):
+        key = super(BotPool, self)._upload_key(cache, content_type, file, token)
+        if key is None:
+            return None
+        import hashlib
+        # the token itself is a secret, and the cache may be on disk
+        account = hashlib.sha256((token or self._tokens[0]).encode('utf-8')).hexdigest()[:16]
+        return '%s:%s' % (account, key)
+
+    def _api_request(self, method, params=None, token=None, **kwargs):
+        if token is None and params is not None:
+            token = self.token_for(params.get('chat_id'))
+        return super(BotPool, self)._api_request(method, params, token, **kwargs)
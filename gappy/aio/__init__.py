@@ -0,0 +1,537 @@
+# -*- coding: utf-8 -*-
+import os
+import contextlib
+import aiohttp
+from . import api
+from .. import codec
+from .. import history as gappy_history
+from .. import keyboard as gappy_keyboard
+from .. import (_BotBase, t, _decoded, _message_payload, _edit_payload,
+                _delete_payload, _callback_payload, _invoice_payload, _pay_payload,
+                _wallet_payload)
+
+
+class AsyncBot(_BotBase):
+    """
+    An asyncio counterpart of ``gappy.Bot``.
+
+    Every method that talks to Gap is a coroutine. Connections are kept
+    alive in one ``aiohttp.ClientSession`` per bot, created on first use
+    so that the bot can be constructed outside of a running event loop.
+    """
+
+    def __init__(self, token, session=None, pool_size=100, timeout=None, base_url=None,
+                 limiter=None, retry=None, history=None):
+        """
+        TOKEN.
+
+        :param session: an ``aiohttp.ClientSession`` to reuse; one is created
+            with ``gappy.aio.api.create_session`` if not given
+        :param pool_size: maximum number of connections kept to Gap
+        :param timeout: default timeout, in seconds, for every API call
+        :param base_url: API root, defaults to ``gappy.api.API_URL``
+        :param limiter: a ``gappy.ratelimit.RateLimiter`` applied to every API call
+        :param retry: a ``gappy.ratelimit.RetryPolicy`` applied to every API call
+        :param history: a ``gappy.history.MessageHistory`` keeping sent messages
+        """
+        super(AsyncBot, self).__init__(token, base_url)
+        self._session = session
+        self._pool_size = pool_size
+        self._timeout = timeout
+        self._limiter = limiter
+        self._retry = retry
+        self._history = history if history is not None else gappy_history.MessageHistory()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        await self.close()
+
+    def _get_session(self):
+        if self._session is None:
+            self._session = api.create_session(limit=self._pool_size)
+        return self._session
+
+    async def _api_request(self, method, params=None, **kwargs):
+        if method == 'sendMessage':
+            self._history.record(params)
+        kwargs.setdefault('timeout', self._timeout)
+        kwargs.setdefault('base_url', self._base_url)
+        kwargs.setdefault('limiter', self._limiter)
+        kwargs.setdefault('retry', self._retry)
+        return await api.request((self._token, method, params), self._get_session(), **kwargs)
+
+    async def close(self):
+        """Close all pooled connections of this bot."""
+        if self._session is not None:
+            await self._session.close()
+
+    def get_last_message(self, chat_id=None):
+        """
+        Last message sent.
+
+        :param chat_id: chat to look in; any chat if not given
+        :return: payload of the message, or an empty string
+        """
+        last = self._history.last(chat_id)
+        return last if last is not None else ''
+
+    def get_recent_messages(self, chat_id, n=None):
+        """
+        Messages last sent to a chat.
+
+        :param chat_id: int
+        :param n: maximum number of messages
+        :return: list of payloads, oldest first
+        """
+        return self._history.recent(chat_id, n)
+
+    async def send_text(
+        self,
+        chat_id,
+        data,
+        reply_keyboard=None,
+        inline_keyboard=None,
+        form=None
+    ):
+        """
+        Send text messages.
+
+        :param chat_id: int
+        :param data: str
+        :param reply_keyboard: str
+        :param inline_keyboard: array
+        :param form: json/dict
+        :return: array
+        """
+        p = _message_payload(chat_id, 'text', data, reply_keyboard, inline_keyboard, form)
+        return await self._api_request('sendMessage', p)
+
+    async def send_image(
+        self,
+        chat_id,
+        image,
+        desc="",
+        reply_keyboard=None,
+        inline_keyboard=None,
+        form=None
+    ):
+        """
+        Send Image.
+
+        :param chat_id: int
+        :param image: string
+        :param desc: string
+        :param reply_keyboard: string
+        :param inline_keyboard: array
+        :param form: json
+        :return: Array
+        """
+        type = 'image'
+        try:
+            tmp = codec.loads(image)
+            tmp.update({'desc': desc})
+            data = codec.dumps(tmp)
+        except Exception:
+            # if os.path.isfile(image):
+                # raise ValueError('Image path is invalid')
+            type, data = await self.upload_file('image', image, desc)
+        p = _message_payload(chat_id, type, data, reply_keyboard, inline_keyboard, form)
+
+        return await self._api_request('sendMessage', p)
+
+    async def send_audio(
+        self,
+        chat_id,
+        audio,
+        desc="",
+        reply_keyboard=None,
+        inline_keyboard=None,
+        form=None
+    ):
+        """
+        Send Audio.
+
+        :param chat_id: int
+        :param audio: string
+        :param desc: string
+        :param reply_keyboard: string
+        :param inline_keyboard: array
+        :param form: json
+        :return: Array
+        """
+        type = 'audio'
+        try:
+            tmp = codec.loads(audio)
+            tmp.update({'desc': desc})
+            data = codec.dumps(tmp)
+        except Exception:
+            # if os.path.isfile(audio):
+                # raise ValueError('Audio path is invalid')
+            type, data = await self.upload_file('audio', audio, desc)
+        p = _message_payload(chat_id, type, data, reply_keyboard, inline_keyboard, form)
+
+        return await self._api_request('sendMessage', p)
+
+    async def send_video(
+        self,
+        chat_id,
+        video,
+        desc="",
+        reply_keyboard=None,
+        inline_keyboard=None,
+        form=None
+    ):
+        """
+        Send Video.
+
+        :param chat_id: int
+        :param video: string
+        :param desc: string
+        :param reply_keyboard: string
+        :param inline_keyboard: array
+        :param form: json
+        :return: Array
+        """
+        type = 'video'
+        try:
+            tmp = codec.loads(video)
+            tmp.update({'desc': desc})
+            data = codec.dumps(tmp)
+        except Exception:
+            # if os.path.isfile(video):
+                # raise ValueError('Video path is invalid')
+            type, data = await self.upload_file('video', video, desc)
+        p = _message_payload(chat_id, type, data, reply_keyboard, inline_keyboard, form)
+
+        return await self._api_request('sendMessage', p)
+
+    async def send_file(
+        self,
+        chat_id,
+        file,
+        desc="",
+        reply_keyboard=None,
+        inline_keyboard=None,
+        form=None
+    ):
+        """
+        Send File.
+
+        :param chat_id: int
+        :param file: string
+        :param desc: string
+        :param reply_keyboard: string
+        :param inline_keyboard: array
+        :param form: json
+        :return: Array
+        """
+        type = 'file'
+        try:
+            tmp = codec.loads(file)
+            tmp.update({'desc': desc})
+            data = codec.dumps(tmp)
+        except Exception:
+            # if os.path.isfile(file):
+                # raise ValueError('File path is invalid')
+            type, data = await self.upload_file('file', file, desc)
+        p = _message_payload(chat_id, type, data, reply_keyboard, inline_keyboard, form)
+
+        return await self._api_request('sendMessage', p)
+
+    async def send_voice(
+        self,
+        chat_id,
+        voice,
+        desc="",
+        reply_keyboard=None,
+        inline_keyboard=None,
+        form=None
+    ):
+        """
+        Send Voice.
+
+        :param chat_id: int
+        :param voice: string
+        :param desc: string
+        :param reply_keyboard: string
+        :param inline_keyboard: array
+        :param form: json
+        :return: Array
+        """
+        type = 'voice'
+        try:
+            tmp = codec.loads(voice)
+            tmp.update({'desc': desc})
+            data = codec.dumps(tmp)
+        except Exception:
+            # if os.path.isfile(voice):
+                # raise ValueError('Voice path is invalid')
+            type, data = await self.upload_file('voice', voice, desc)
+        p = _message_payload(chat_id, type, data, reply_keyboard, inline_keyboard, form)
+
+        return await self._api_request('sendMessage', p)
+
+    async def send_action(
+        self,
+        chat_id,
+        action
+    ):
+        """
+        Send Action.
+
+        :param chat_id: int
+        :param action: string
+        :return: Array
+        """
+        actions = ['typing']
+        if action in actions:
+            p = dict(chat_id=chat_id)
+            return await self._api_request('sendAction', p)
+
+        raise ValueError(
+            'Invalid Action! Accepted value: ' + ','.join(actions))
+
+    async def send_location(
+        self,
+        chat_id,
+        lat,
+        long,
+        desc="",
+        reply_keyboard=None,
+        inline_keyboard=None,
+        form=None
+    ):
+        """
+        Send Location.
+
+        :param chat_id: int
+        :param lat: float
+        :param long: float
+        :param desc: string
+        :param reply_keyboard: string
+        :param inline_keyboard: array
+        :param form: json
+        :return: Array
+        """
+        data = codec.dumps(dict(lat=lat, long=long, desc=desc))
+        p = _message_payload(chat_id, 'location', data, reply_keyboard, inline_keyboard, form)
+        mes = await self._api_request('location', p)
+        return _decoded(mes)['id'] if mes else False
+
+    async def send_contact(
+        self,
+        chat_id,
+        phone,
+        name,
+        reply_keyboard=None,
+        inline_keyboard=None,
+        form=None
+    ):
+        """
+        Send Contact.
+
+        :param chat_id: int
+        :param phone: string
+        :param name: string
+        :param reply_keyboard: string
+        :param inline_keyboard: array
+        :param form: json
+        :return: Array
+        """
+        data = codec.dumps(dict(phone=phone, name=name))
+        p = _message_payload(chat_id, 'contact', data, reply_keyboard, inline_keyboard, form)
+        mes = await self._api_request('contact', p)
+        return _decoded(mes)['id'] if mes else False
+
+    async def send_template(
+        self,
+        chat_id,
+        template,
+        **variables
+    ):
+        """
+        Send a message made from a template.
+
+        :param chat_id: int
+        :param template: a ``gappy.template.Template``
+        :param variables: values for the fields of its text
+        :return: array
+        """
+        return await self._api_request('sendMessage', template.render(chat_id, variables))
+
+    async def edit_message(
+        self,
+        chat_id,
+        message_id,
+        data=None,
+        inline_keyboard=None
+    ):
+        """
+        Edit Message.
+
+        :param chat_id: int
+        :param message_id: int
+        :param data: string
+        :param inline_keyboard: array
+        :return: array
+        """
+        p = _edit_payload(chat_id, message_id, data, inline_keyboard)
+        return await self._api_request('editMessage', p)
+
+    async def delete_message(
+        self,
+        chat_id,
+        message_id
+    ):
+        """
+        Delete Message.
+
+        :param chat_id: int
+        :param message_id: int
+        :return: array
+        """
+        p = _delete_payload(chat_id, message_id)
+        return await self._api_request('deleteMessage', p)
+
+    async def answer_callback(
+        self,
+        chat_id,
+        callback_id,
+        text,
+        show_alert=False
+    ):
+        """
+        Answer Callback.
+
+        :param chat_id: int
+        :param callback_id: int
+        :param text: string
+        :param show_alert: boolean
+        :return: array
+        """
+        show_alert = t(show_alert)
+        p = _callback_payload(chat_id, callback_id, text, show_alert)
+        return await self._api_request('answerCallback', p)
+
+    async def send_invoice(
+        self,
+        chat_id,
+        amount,
+        description
+    ):
+        """
+        Send Invoice.
+
+        :param chat_id: int
+        :param amount: int
+        :param description: string
+        :return: string
+        """
+        p = _invoice_payload(chat_id, amount, description)
+        res = await self._api_request('invoice', p)
+        res = _decoded(res)
+        return res['id']
+
+    async def pay_verify(
+        self,
+        chat_id,
+        ref_id
+    ):
+        """
+        Pay verify.
+
+        :param chat_id: int
+        :param ref_id: int
+        :return: boolean
+        """
+        p = _pay_payload(chat_id, ref_id)
+        res = await self._api_request('payVerify', p)
+        res = _decoded(res)
+        if isinstance(res, list):
+            return res['status'] == 'verified'
+
+    async def pay_inquiry(
+        self,
+        chat_id,
+        ref_id
+    ):
+        """
+        Pay inquiry.
+
+        :param chat_id: int
+        :param ref_id: int
+        :return: boolean
+        """
+        p = _pay_payload(chat_id, ref_id)
+        res = await self._api_request('payInquiry', p)
+        res = _decoded(res)
+        if isinstance(res, list):
+            return res['status'] == 'verified'
+
+    async def request_wallet_charge(
+        self,
+        chat_id,
+        desc=None
+    ):
+        """
+        Request Wallet Charge.
+
+        :param chat_id: int
+        :param desc: string
+        :return: string
+        """
+        p = _wallet_payload(chat_id, desc)
+        return await self._api_request('requestWalletCharge', p)
+
+    def reply_keyboard(
+        self,
+        keyboard,
+        once=True,
+        selective=False
+    ):
+        """
+        Reply keyboard.
+
+        Build a ``gappy.keyboard.ReplyKeyboard`` once instead to send the
+        same keyboard many times.
+
+        :param keyboard: list of rows, each a list of buttons
+        :param once: once
+        :param selective: boolean
+        :return: string
+        """
+        if not isinstance(keyboard, (list, tuple)):
+            raise ValueError("Keyboard must be array")
+        return gappy_keyboard.ReplyKeyboard(keyboard, once, selective).json
+
+    async def upload_file(
+        self,
+        content_type,
+        file,
+        desc=None
+    ):
+        """
+        Upload File.
+
+        :param content_type: string
+        :param file: path, binary file object, bytes or memoryview
+        :param desc: string
+        :return: tuple of content type and the uploaded file descriptor
+        """
+        with contextlib.ExitStack() as stack:
+            if isinstance(file, (str, os.PathLike)):
+                file = stack.enter_context(open(file, 'rb'))
+            form = aiohttp.FormData()
+            form.add_field(content_type, file)
+            fn, kwargs = api._transform((self._token, 'upload', None), self._get_session(),
+                                        timeout=self._timeout, base_url=self._base_url)
+            kwargs['data'] = form
+            async with fn(**kwargs) as r:
+                if r.status >= 400:
+                    raise ValueError(r.status, r.reason)
+                p = codec.loads(await r.read())
+        if desc:
+            p.update({'desc': desc})
+        return content_type, codec.dumps(p)
@@ -0,0 +1,80 @@
+# -*- coding: utf-8 -*-
+import asyncio
+import collections
+import aiohttp
+from .. import api as _api
+
+
+_default_pool_spec = dict(limit=100, limit_per_host=0, keepalive_timeout=30)
+
+
+class _Response(collections.namedtuple('_Response', ['status_code', 'content', 'reason', 'ok'])):
+    """The attributes `gappy.api._parse` reads from a response."""
+
+    __slots__ = ()
+
+    @property
+    def text(self):
+        return self.content.decode('utf-8', 'replace')
+
+
+def create_session(**pool_kw):
+    """
+    Create a keep-alive ``aiohttp.ClientSession``.
+
+    Must be called while an event loop is running.
+
+    :param pool_kw: overrides for ``limit``, ``limit_per_host`` and
+        ``keepalive_timeout``, passed to ``aiohttp.TCPConnector``
+    :return: aiohttp.ClientSession
+    """
+    spec = dict(_default_pool_spec, **pool_kw)
+    return aiohttp.ClientSession(connector=aiohttp.TCPConnector(**spec))
+
+
+def _stringify(fields):
+    # aiohttp only encodes str values; mirror what `requests` does for us.
+    return {k: v if isinstance(v, str) else str(v) for k, v in fields.items()}
+
+
+def _transform(req, session, **user_kw):
+    token, method, params = req
+    fields = _api._compose_fields(req, **user_kw)
+    url = _api._methodurl(req, **user_kw)
+    kwargs = {'url': url, 'headers': {'token': token}}
+    if user_kw.get('timeout') is not None:
+        kwargs['timeout'] = aiohttp.ClientTimeout(total=user_kw['timeout'])
+    if method == 'upload':
+        kwargs['data'] = fields
+    else:
+        kwargs['data'] = _stringify(fields)
+    return session.post, kwargs
+
+
+async def _read(response):
+    content = await response.read()
+    return _Response(response.status, content, response.reason, response.status < 400)
+
+
+async def request(req, session, limiter=None, retry=None, **user_kw):
+    fn, kwargs = _transform(req, session, **user_kw)
+    attempt = 0
+    while 1:
+        if limiter is not None:
+            delay = limiter.reserve(_api._chat_of(req))
+            if delay > 0:
+                await asyncio.sleep(delay)
+        try:
+            async with fn(**kwargs) as r:
+                response = await _read(r)
+                headers = r.headers
+        except aiohttp.ClientConnectionError:
+            if retry is None or attempt >= retry.retries:
+                raise
+            delay = retry.delay(attempt)
+        else:
+            if retry is None or attempt >= retry.retries or not retry.retryable(response.status_code):
+                return _api._parse(response)
+            delay = retry.delay(attempt, headers)
+        await asyncio.sleep(delay)
+        attempt += 1
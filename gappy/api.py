@@ -1,12 +1,38 @@
 # -*- coding: utf-8 -*-
-import json
-import requests
+import time
+import collections
+from . import codec
 from . import exception
 
 
-def _methodurl(req, **user_kw):
+API_URL = 'https://api.gap.im'
+
+_default_pool_spec = dict(pool_connections=1, pool_maxsize=10, pool_block=False)
+
+
+def create_session(**pool_kw):
+    """
+    Create a keep-alive HTTP session backed by a thread-safe connection pool.
+
+    :param pool_kw: overrides for ``pool_connections``, ``pool_maxsize``
+        and ``pool_block``, passed to ``requests.adapters.HTTPAdapter``
+    :return: requests.Session
+    """
+    # `requests` takes longer to import than all of gappy; it is only
+    # imported once a session is needed.
+    import requests
+    import requests.adapters
+    spec = dict(_default_pool_spec, **pool_kw)
+    adapter = requests.adapters.HTTPAdapter(**spec)
+    session = requests.Session()
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+
+def _methodurl(req, base_url=None, **user_kw):
     token, method, params = req
-    return 'https://api.gap.im/%s' % (method)
+    return '%s/%s' % (base_url or API_URL, method)
 
 
 def _fix_type(v):
@@ -15,29 +41,48 @@ def _fix_type(v):
 
 def _compose_fields(req, **user_kw):
     token, method, params = req
-    fields = {k: _fix_type(v) for k, v in params.items()} if params is not None else {}
-    return fields
+    if params is None:
+        return {}
+    # Only floats need converting; otherwise the payload is sent as it is.
+    for v in params.values():
+        if isinstance(v, float):
+            return {k: _fix_type(v) for k, v in params.items()}
+    return params
+
+
+def _which_poster(req, session=None, **user_kw):
+    # A one-time connection is made only when no session is given.
+    if session is not None:
+        return session.post
+    import requests
+    return requests.post
 
 
 def _transform(req, **user_kw):
     token, method, params = req
-    fields = _compose_fields(req, **user_kw)
     url = _methodurl(req, **user_kw)
     headers = {'token': token}
+    poster = _which_poster(req, **user_kw)
+    kwargs = {'url': url, 'headers': headers}
+    if user_kw.get('timeout') is not None:
+        kwargs['timeout'] = user_kw['timeout']
     if method == 'upload':
-        return requests.post, {'url': url, 'files': fields, 'headers': headers}        
+        # `params` is a `gappy.upload.MultipartStream`, sent as it is read.
+        headers['Content-Type'] = params.content_type
+        kwargs['data'] = params
     else:
-        return requests.post, {'url': url, 'data': fields, 'headers': headers}
+        kwargs['data'] = _compose_fields(req, **user_kw)
+    return poster, kwargs
 
 
 def _parse(response):
     try:
-        text = response.text
-        data = json.loads(text)
+        # parsed from the raw body, skipping charset detection and decoding
+        data = codec.loads(response.content)
     except ValueError:  # No JSON object could be decoded
         raise exception.BadHTTPResponse(
             response.status_code,
-            text,
+            response.text,
             response.reason)
 
     if response.ok:
@@ -48,7 +93,77 @@ def _parse(response):
         raise exception.GapError(description, data)
 
 
-def request(req, **user_kw):
+def _chat_of(req):
+    token, method, params = req
+    return params.get('chat_id') if isinstance(params, dict) else None
+
+
+def _send(req, fn, kwargs, limiter, retry):
+    import requests
+    attempt = 0
+    while 1:
+        if limiter is not None:
+            limiter.acquire(_chat_of(req))
+        try:
+            r = fn(**kwargs)  # `fn` must be thread-safe
+        except requests.ConnectionError:
+            if retry is None or attempt >= retry.retries:
+                raise
+            delay = retry.delay(attempt)
+        else:
+            if retry is None or attempt >= retry.retries or not retry.retryable(r.status_code):
+                return r
+            delay = retry.delay(attempt, r.headers)
+        time.sleep(delay)
+        attempt += 1
+
+
+Observation = collections.namedtuple(
+    'Observation', ['method', 'params', 'elapsed', 'status', 'bytes_out', 'bytes_in', 'error'])
+
+
+class Hooks(object):
+    """
+    Callables run around every API call of a bot.
+
+    ``pre`` hooks are called as ``fn(method, params)`` before the call, and
+    ``post`` hooks as ``fn(observation)`` after it, with an ``Observation``
+    of the call, whether it succeeded or not.
+    """
+
+    def __init__(self):
+        self.pre = []
+        self.post = []
+
+
+def _observe(hooks, req, start, response, error):
+    token, method, params = req
+    status = bytes_out = bytes_in = None
+    if response is not None:
+        status = response.status_code
+        bytes_in = len(response.content)
+        body = response.request.body
+        bytes_out = len(body) if isinstance(body, (bytes, str)) else getattr(body, 'len', None)
+    ob = Observation(method, params, time.perf_counter() - start, status, bytes_out, bytes_in, error)
+    for fn in hooks.post:
+        fn(ob)
+
+
+def request(req, limiter=None, retry=None, hooks=None, **user_kw):
     fn, kwargs = _transform(req, **user_kw)
-    r = fn(**kwargs)  # `fn` must be thread-safe
-    return _parse(r)
+    if hooks is None:
+        return _parse(_send(req, fn, kwargs, limiter, retry))
+
+    token, method, params = req
+    for h in hooks.pre:
+        h(method, params)
+    start = time.perf_counter()
+    r = None
+    try:
+        r = _send(req, fn, kwargs, limiter, retry)
+        data = _parse(r)
+    except Exception as e:
+        _observe(hooks, req, start, r, e)
+        raise
+    _observe(hooks, req, start, r, None)
+    return data
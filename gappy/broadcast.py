@@ -0,0 +1,108 @@
+# -*- coding: utf-8 -*-
+import time
+import threading
+import collections
+import concurrent.futures
+from . import codec
+
+
+Result = collections.namedtuple('Result', ['chat_id', 'ok', 'message_id', 'error'])
+
+
+def _message_id(res):
+    # `location` and `contact` answer with a JSON document inside a string.
+    if isinstance(res, (str, bytes)):
+        res = codec.loads(res)
+    return res.get('id') if isinstance(res, dict) else None
+
+
+class Broadcast(object):
+    """
+    Send one payload to many chats, ``workers`` requests at a time.
+
+    Nothing is sent until the broadcast is iterated. Iterating yields a
+    ``Result`` per chat as soon as its request completes, so results arrive
+    out of order. Chat ids are consumed lazily, with at most ``2 * workers``
+    requests in flight, so ``chat_ids`` may be a generator over millions.
+
+    Counters may be read from any thread while the broadcast runs.
+    """
+
+    def __init__(self, send, chat_ids, workers=8, pairs=False):
+        """
+        :param send: callable taking a chat id and returning the API response
+        :param chat_ids: iterable of chat ids
+        :param workers: maximum number of concurrent requests
+        :param pairs: ``chat_ids`` yields ``(chat_id, value)`` pairs, and
+            ``send`` takes both
+        """
+        self._send = send
+        self._chat_ids = chat_ids
+        self._workers = workers
+        self._pairs = pairs
+        self._lock = threading.Lock()
+        self.succeeded = 0
+        self.failed = 0
+        self.started_at = None
+        self.finished_at = None
+
+    def _send_one(self, item):
+        chat_id = item[0] if self._pairs else item
+        try:
+            res = self._send(*item) if self._pairs else self._send(item)
+        except Exception as e:
+            with self._lock:
+                self.failed += 1
+            return Result(chat_id, False, None, e)
+        with self._lock:
+            self.succeeded += 1
+        return Result(chat_id, True, _message_id(res), None)
+
+    def __iter__(self):
+        self.started_at = time.time()
+        window = 2 * self._workers
+        with concurrent.futures.ThreadPoolExecutor(self._workers) as executor:
+            pending = set()
+            for item in self._chat_ids:
+                if len(pending) >= window:
+                    done, pending = concurrent.futures.wait(
+                        pending, return_when=concurrent.futures.FIRST_COMPLETED)
+                    for f in done:
+                        yield f.result()
+                pending.add(executor.submit(self._send_one, item))
+
+            for f in concurrent.futures.as_completed(pending):
+                yield f.result()
+        self.finished_at = time.time()
+
+    def run(self):
+        """
+        Send to every chat and wait for all of them.
+
+        :return: list of ``Result``
+        """
+        return list(self)
+
+    @property
+    def done(self):
+        return self.succeeded + self.failed
+
+    @property
+    def elapsed(self):
+        if self.started_at is None:
+            return 0.0
+        return (self.finished_at or time.time()) - self.started_at
+
+    @property
+    def rate(self):
+        """Completed requests per second."""
+        elapsed = self.elapsed
+        return self.done / elapsed if elapsed else 0.0
+
+    def stats(self):
+        """
+        :return: dict with ``done``, ``succeeded``, ``failed``, ``elapsed``
+            seconds and ``rate`` in requests per second
+        """
+        return dict(done=self.done, succeeded=self.succeeded, failed=self.failed,
+                    elapsed=self.elapsed, rate=self.rate)
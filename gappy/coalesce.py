@@ -0,0 +1,171 @@
+# -*- coding: utf-8 -*-
+import time
+import heapq
+import itertools
+import threading
+import collections
+import concurrent.futures
+from . import dispatch
+
+
+class _Edit(object):
+    __slots__ = ('chat_id', 'message_id', 'data', 'inline_keyboard', 'future', 'seq')
+
+    def __init__(self, chat_id, message_id, data, inline_keyboard, seq):
+        self.chat_id = chat_id
+        self.message_id = message_id
+        self.data = data
+        self.inline_keyboard = inline_keyboard
+        self.future = concurrent.futures.Future()
+        self.seq = seq
+
+
+class EditCoalescer(object):
+    """
+    Edit messages at most once per ``window`` seconds each, sending only
+    the latest content.
+
+    The first edit of a message is sent right away. Edits made to it
+    within ``window`` seconds of the last one sent are merged - the latest
+    ``data`` and ``inline_keyboard`` given win - and sent together when the
+    window is over. Every edit returns a ``concurrent.futures.Future`` of
+    the request that carries it, shared by all the edits merged into it.
+
+    Deleting a message through the coalescer cancels its pending edit.
+    Requests for one chat are made one after another, in order.
+    """
+
+    def __init__(self, bot, window=0.5, workers=4, maxsize=1024):
+        """
+        :param bot: a ``gappy.Bot``
+        :param window: least number of seconds between two edits of a message
+        :param workers: number of threads making requests
+        :param maxsize: requests a thread may have waiting
+        """
+        self._bot = bot
+        self._window = window
+        self._pending = {}
+        self._sent = collections.OrderedDict()  # key -> time, oldest first
+        self._dueq = []
+        self._sequence = itertools.count()
+        self._cond = threading.Condition()
+        self._closed = False
+        self.requested = 0
+        self.sent = 0
+        self.cancelled = 0
+        self._executor = dispatch.PartitionedExecutor(workers, maxsize, 'gappy-edit')
+        self._thread = threading.Thread(target=self._run, name='gappy-edit-coalescer')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def edit_message(self, chat_id, message_id, data=None, inline_keyboard=None):
+        """
+        Edit a message, merged with other edits to it.
+
+        :return: concurrent.futures.Future of the ``Bot.edit_message`` result
+        """
+        key = (str(chat_id), message_id)
+        with self._cond:
+            if self._closed:
+                raise RuntimeError('Coalescer is closed')
+            self.requested += 1
+            e = self._pending.get(key)
+            if e is not None:
+                if data is not None:
+                    e.data = data
+                if inline_keyboard is not None:
+                    e.inline_keyboard = inline_keyboard
+                return e.future
+
+            now = time.time()
+            last = self._sent.get(key)
+            due = now if last is None else max(now, last + self._window)
+            e = self._pending[key] = _Edit(chat_id, message_id, data, inline_keyboard,
+                                           next(self._sequence))
+            heapq.heappush(self._dueq, (due, e.seq, key))
+            if self._dueq[0][1] == e.seq:
+                self._cond.notify()
+            return e.future
+
+    def delete_message(self, chat_id, message_id):
+        """
+        Delete a message, dropping its pending edit.
+
+        :return: concurrent.futures.Future of the ``Bot.delete_message`` result
+        """
+        key = (str(chat_id), message_id)
+        with self._cond:
+            if self._closed:
+                raise RuntimeError('Coalescer is closed')
+            e = self._pending.pop(key, None)
+            if e is not None and e.future.cancel():
+                self.cancelled += 1
+            self._sent.pop(key, None)
+        # same partition as the edits, so it goes after any being sent
+        return self._executor.submit(chat_id, self._bot.delete_message, chat_id, message_id)
+
+    def _run(self):
+        while 1:
+            with self._cond:
+                while 1:
+                    if self._closed and not self._dueq:
+                        return
+                    now = time.time()
+                    if self._dueq and self._dueq[0][0] <= now:
+                        _, seq, key = heapq.heappop(self._dueq)
+                        e = self._pending.get(key)
+                        if e is None or e.seq != seq:
+                            continue  # deleted meanwhile
+                        del self._pending[key]
+                        self._sent[key] = now
+                        self._sent.move_to_end(key)
+                        self.sent += 1
+                        break
+                    self._forget(now)
+                    self._cond.wait(self._dueq[0][0] - now if self._dueq else None)
+            self._executor.submit(e.chat_id, self._send, e)
+
+    def _forget(self, now):
+        # Messages not edited for a window are sent to right away again.
+        sent = self._sent
+        while sent and now - next(iter(sent.values())) >= self._window:
+            sent.popitem(last=False)
+
+    def _send(self, e):
+        if not e.future.set_running_or_notify_cancel():
+            return
+        try:
+            result = self._bot.edit_message(e.chat_id, e.message_id, e.data, e.inline_keyboard)
+        except Exception as ex:
+            e.future.set_exception(ex)
+        else:
+            e.future.set_result(result)
+
+    def flush(self):
+        """Send every pending edit now, and wait for them."""
+        with self._cond:
+            futures = [e.future for e in self._pending.values()]
+            self._dueq = [(0, seq, key) for _, seq, key in self._dueq]
+            heapq.heapify(self._dueq)
+            self._cond.notify()
+        concurrent.futures.wait(futures)
+
+    def stats(self):
+        """
+        :return: dict with edits ``requested``, edit requests ``sent``,
+            edits ``coalesced`` into others, ``cancelled`` by a delete and
+            still ``pending``
+        """
+        with self._cond:
+            return dict(requested=self.requested, sent=self.sent, cancelled=self.cancelled,
+                        pending=len(self._pending),
+                        coalesced=self.requested - self.sent - self.cancelled - len(self._pending))
+
+    def close(self):
+        """Send pending edits and stop."""
+        self.flush()
+        with self._cond:
+            self._closed = True
+            self._cond.notify()
+        self._thread.join()
+        self._executor.shutdown()
@@ -0,0 +1,80 @@
+# -*- coding: utf-8 -*-
+"""
+JSON encoding and decoding for everything gappy sends and receives.
+
+The fastest library installed is used: ``orjson``, then ``ujson``, then the
+standard ``json`` module. It is imported on first use; call ``use`` to pick
+one. ``dumps`` always gives compact text; ``loads`` takes ``str`` or
+``bytes``, so response bodies are parsed without being decoded to text first.
+"""
+
+
+def _std():
+    import json
+    return json.JSONEncoder(separators=(',', ':')).encode, json.loads
+
+
+def _orjson():
+    import orjson
+    encode = orjson.dumps
+    fallback = _std()[0]
+    option = orjson.OPT_NON_STR_KEYS
+
+    def dumps(obj):
+        try:
+            return encode(obj, option=option).decode('utf-8')
+        except TypeError:  # e.g. integers beyond 64 bits
+            return fallback(obj)
+    return dumps, orjson.loads
+
+
+def _ujson():
+    import ujson
+    encode = ujson.dumps
+    fallback = _std()[0]
+
+    def dumps(obj):
+        try:
+            return encode(obj, escape_forward_slashes=False)
+        except (TypeError, OverflowError):
+            return fallback(obj)
+    return dumps, ujson.loads
+
+
+_backends = [('orjson', _orjson), ('ujson', _ujson), ('json', _std)]
+
+backend = None
+
+
+# Until a library is picked, on first use, these stand in for its functions.
+def dumps(obj):
+    use()
+    return dumps(obj)
+
+
+def loads(text):
+    use()
+    return loads(text)
+
+
+def use(name=None):
+    """
+    Switch JSON library.
+
+    :param name: ``orjson``, ``ujson`` or ``json``; the fastest one
+        installed if not given
+    :raise ImportError: if the library asked for is not installed
+    """
+    global backend, dumps, loads
+    for candidate, load in _backends:
+        if name is not None and candidate != name:
+            continue
+        try:
+            dumps, loads = load()
+        except ImportError:
+            if name is not None:
+                raise
+            continue
+        backend = candidate
+        return
+    raise ValueError('Unknown JSON library: %r' % (name,))
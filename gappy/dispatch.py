@@ -0,0 +1,174 @@
+# -*- coding: utf-8 -*-
+import queue
+import itertools
+import threading
+import concurrent.futures
+
+
+# Bot methods taking a chat id first and making one call to that chat; the
+# ones `Dispatcher` and `gappy.outbox.Outbox` stand in for.
+chat_methods = frozenset([
+    'send_text', 'send_image', 'send_audio', 'send_video', 'send_file', 'send_voice',
+    'send_action', 'send_location', 'send_contact', 'send_invoice', 'send_template',
+    'edit_message', 'delete_message', 'answer_callback',
+    'pay_verify', 'pay_inquiry', 'request_wallet_charge',
+])
+
+
+def chat_key(data):
+    """Partition key of a message-like ``dict``: its ``chat_id``, if any."""
+    return data.get('chat_id') if isinstance(data, dict) else None
+
+
+class PartitionedExecutor(object):
+    """
+    Run tasks on a fixed set of worker threads, each fed by its own queue.
+
+    Tasks submitted with the same key always land on the same worker and so
+    run one after another, in submission order. Tasks without a key are
+    spread over the workers round-robin.
+
+    Queues are bounded: once a worker has ``maxsize`` tasks waiting,
+    ``submit`` blocks until it catches up, or raises ``queue.Full`` after
+    ``timeout`` seconds if one is given.
+    """
+
+    def __init__(self, workers=4, maxsize=1024, name='gappy-worker', timeout=None):
+        if workers < 1:
+            raise ValueError('At least one worker is required')
+
+        self._queues = [queue.Queue(maxsize) for _ in range(workers)]
+        self._peaks = [0] * workers
+        self._timeout = timeout
+        self._roundrobin = itertools.count()
+        self._lock = threading.Lock()
+        self._submitted = 0
+        self._completed = 0
+        self._failed = 0
+        self._threads = []
+        for i, q in enumerate(self._queues):
+            th = threading.Thread(target=self._work, args=(q,), name='%s-%d' % (name, i))
+            th.daemon = True
+            th.start()
+            self._threads.append(th)
+
+    def _partition(self, key):
+        if key is None:
+            return next(self._roundrobin) % len(self._queues)
+        # `str` so that chat 123 and chat '123' share a worker
+        return hash(str(key)) % len(self._queues)
+
+    def _work(self, q):
+        while 1:
+            task = q.get()
+            if task is None:
+                return
+
+            future, fn, args, kwargs = task
+            if future.set_running_or_notify_cancel():
+                try:
+                    result = fn(*args, **kwargs)
+                except BaseException as e:
+                    with self._lock:
+                        self._failed += 1
+                    future.set_exception(e)
+                else:
+                    with self._lock:
+                        self._completed += 1
+                    future.set_result(result)
+
+    def submit(self, key, fn, *args, **kwargs):
+        """
+        Schedule ``fn(*args, **kwargs)`` on the worker owning ``key``.
+
+        :return: concurrent.futures.Future
+        """
+        future = concurrent.futures.Future()
+        i = self._partition(key)
+        q = self._queues[i]
+        q.put((future, fn, args, kwargs), timeout=self._timeout)
+        depth = q.qsize()
+        with self._lock:
+            self._submitted += 1
+            if depth > self._peaks[i]:
+                self._peaks[i] = depth
+        return future
+
+    def depths(self):
+        """Number of tasks waiting in each partition."""
+        return [q.qsize() for q in self._queues]
+
+    def stats(self):
+        """
+        Snapshot of executor counters.
+
+        :return: dict with ``submitted``, ``completed``, ``failed``,
+            ``depths`` (tasks waiting per partition) and ``peak_depths``
+            (most tasks ever waiting per partition)
+        """
+        with self._lock:
+            return dict(submitted=self._submitted,
+                        completed=self._completed,
+                        failed=self._failed,
+                        depths=self.depths(),
+                        peak_depths=list(self._peaks))
+
+    def shutdown(self, wait=True):
+        """Stop the workers once they have drained their queues."""
+        for q in self._queues:
+            q.put(None)
+        if wait:
+            for th in self._threads:
+                th.join()
+
+
+class Dispatcher(object):
+    """
+    Send through a bot from many threads, in order within each chat.
+
+    Every method of the bot sending to a chat, listed in ``chat_methods``,
+    is available on the dispatcher; it queues the call on the worker owning that chat and
+    returns a ``concurrent.futures.Future`` of its result. Calls to one chat
+    run strictly one after another, in the order they were made, while
+    different chats are served in parallel.
+    """
+
+    def __init__(self, bot, workers=8, maxsize=1024, timeout=None):
+        """
+        :param bot: a ``gappy.Bot``
+        :param workers: number of partitions, each served by one thread
+        :param maxsize: calls a partition may have waiting before callers block
+        :param timeout: seconds a caller may block before ``queue.Full`` is raised
+        """
+        self._bot = bot
+        self._executor = PartitionedExecutor(workers, maxsize, 'gappy-dispatch', timeout)
+
+    def submit(self, chat_id, fn, *args, **kwargs):
+        """
+        Run ``fn(*args, **kwargs)`` in the partition of ``chat_id``.
+
+        :return: concurrent.futures.Future
+        """
+        return self._executor.submit(chat_id, fn, *args, **kwargs)
+
+    def __getattr__(self, name):
+        if name not in chat_methods:
+            raise AttributeError('%r object has no attribute %r' % (type(self).__name__, name))
+        fn = getattr(self._bot, name)
+
+        def call(chat_id, *args, **kwargs):
+            return self._executor.submit(chat_id, fn, chat_id, *args, **kwargs)
+        call.__name__ = name
+        call.__doc__ = fn.__doc__
+        return call
+
+    def depths(self):
+        """Number of calls waiting in each partition."""
+        return self._executor.depths()
+
+    def stats(self):
+        return self._executor.stats()
+
+    def shutdown(self, wait=True):
+        """Stop the workers once queued calls are made."""
+        self._executor.shutdown(wait)
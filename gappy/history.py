@@ -0,0 +1,65 @@
+# -*- coding: utf-8 -*-
+import threading
+import collections
+
+
+class MessageHistory(object):
+    """
+    The last few messages sent to each chat.
+
+    Every chat gets a ring buffer of its ``per_chat`` latest messages. Chats
+    are kept in least-recently-sent order and, past ``max_chats``, the one
+    not written to for longest is forgotten, so memory stays bounded however
+    many users a bot talks to.
+
+    Writes take a lock; reads do not, relying on single dictionary and
+    deque operations being atomic.
+    """
+
+    def __init__(self, per_chat=10, max_chats=10000):
+        self._per_chat = per_chat
+        self._max_chats = max_chats
+        self._chats = collections.OrderedDict()
+        self._last = None
+        self._lock = threading.Lock()
+
+    def record(self, params):
+        """Remember a sent message, given as its API payload."""
+        key = str(params.get('chat_id'))
+        with self._lock:
+            ring = self._chats.get(key)
+            if ring is None:
+                ring = self._chats[key] = collections.deque(maxlen=self._per_chat)
+                if len(self._chats) > self._max_chats:
+                    self._chats.popitem(last=False)
+            else:
+                self._chats.move_to_end(key)
+            ring.append(params)
+            self._last = params
+
+    def last(self, chat_id=None):
+        """
+        :param chat_id: chat to look in; any chat if not given
+        :return: payload of the last message sent, or ``None``
+        """
+        if chat_id is None:
+            return self._last
+        ring = self._chats.get(str(chat_id))
+        try:
+            return ring[-1]
+        except (TypeError, IndexError):
+            return None
+
+    def recent(self, chat_id, n=None):
+        """
+        :return: list of up to ``n`` payloads last sent to ``chat_id``, oldest first
+        """
+        ring = self._chats.get(str(chat_id))
+        if ring is None:
+            return []
+        messages = list(ring)
+        return messages if n is None else messages[-n:] if n > 0 else []
+
+    def __len__(self):
+        """Number of chats remembered."""
+        return len(self._chats)
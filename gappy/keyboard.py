@@ -0,0 +1,132 @@
+# -*- coding: utf-8 -*-
+"""
+Keyboards and forms built once and sent many times.
+
+Each object checks its structure and encodes its JSON when it is made, and
+is passed to the API as that text, so a menu attached to every message is
+never encoded again. Objects are immutable: rows are tuples and buttons and
+fields read-only mappings.
+"""
+import types
+from . import codec
+from . import _prebuilt
+
+
+def _copy(item, what):
+    if not isinstance(item, dict):
+        raise ValueError('%s must be a dict, not %r' % (what, item))
+    return {k: v for k, v in item.items() if v is not None}
+
+
+class _Prebuilt(object):
+    __slots__ = ('_items', 'json')
+
+    def __init__(self, items, json):
+        object.__setattr__(self, '_items', items)
+        object.__setattr__(self, 'json', json)
+
+    def __setattr__(self, name, value):
+        raise AttributeError('%s is immutable' % type(self).__name__)
+
+    def __eq__(self, other):
+        return type(self) is type(other) and self.json == other.json
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash(self.json)
+
+    def __str__(self):
+        return self.json
+
+    def __repr__(self):
+        return '%s(%s)' % (type(self).__name__, self.json)
+
+
+def _rows(rows, what, required):
+    if not isinstance(rows, (list, tuple)) or not rows:
+        raise ValueError('Keyboard must be a non-empty list of rows')
+    plain, frozen = [], []
+    for row in rows:
+        if not isinstance(row, (list, tuple)) or not row:
+            raise ValueError('Keyboard row must be a non-empty list, not %r' % (row,))
+        buttons = [_copy(b, what) for b in row]
+        for b in buttons:
+            for key in required:
+                if key not in b:
+                    raise ValueError('%s needs a %r: %r' % (what, key, b))
+        plain.append(buttons)
+        frozen.append(tuple(types.MappingProxyType(b) for b in buttons))
+    return plain, tuple(frozen)
+
+
+class InlineKeyboard(_Prebuilt):
+    """
+    Buttons shown under a message.
+
+    :param rows: list of rows, each a list of buttons such as
+        ``{'text': 'Yes', 'cb_data': 'yes'}``
+    """
+
+    __slots__ = ()
+
+    def __init__(self, rows):
+        plain, frozen = _rows(rows, 'Button', ('text',))
+        super(InlineKeyboard, self).__init__(frozen, codec.dumps(plain))
+
+    @property
+    def rows(self):
+        return self._items
+
+
+class ReplyKeyboard(_Prebuilt):
+    """
+    Keyboard replacing the user's, as made by ``Bot.reply_keyboard``.
+
+    :param rows: list of rows, each a list of buttons
+    :param once: hide the keyboard once a button is pressed
+    :param selective: boolean
+    """
+
+    __slots__ = ('once', 'selective')
+
+    def __init__(self, rows, once=True, selective=False):
+        plain, frozen = _rows(rows, 'Button', ())
+        text = codec.dumps(dict(keyboard=codec.dumps(plain), once=once, selective=selective))
+        super(ReplyKeyboard, self).__init__(frozen, text)
+        object.__setattr__(self, 'once', once)
+        object.__setattr__(self, 'selective', selective)
+
+    @property
+    def rows(self):
+        return self._items
+
+
+class Form(_Prebuilt):
+    """
+    Form attached to a message.
+
+    :param fields: list of fields such as
+        ``{'name': 'email', 'type': 'text', 'label': 'Email'}``
+    """
+
+    __slots__ = ()
+
+    def __init__(self, fields):
+        if not isinstance(fields, (list, tuple)) or not fields:
+            raise ValueError('Form must be a non-empty list of fields')
+        plain = [_copy(f, 'Field') for f in fields]
+        for f in plain:
+            if 'name' not in f or 'type' not in f:
+                raise ValueError('Field needs a name and a type: %r' % (f,))
+        super(Form, self).__init__(tuple(types.MappingProxyType(f) for f in plain), codec.dumps(plain))
+
+    @property
+    def fields(self):
+        return self._items
+
+
+# Types `gappy._rectify` sends as their `json`.
+prebuilt = frozenset([InlineKeyboard, ReplyKeyboard, Form])
+_prebuilt.update(prebuilt)
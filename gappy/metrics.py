@@ -0,0 +1,111 @@
+# -*- coding: utf-8 -*-
+import bisect
+import threading
+
+
+# Upper bounds, in seconds, of the latency histogram buckets.
+_default_buckets = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class _MethodStats(object):
+    __slots__ = ('counts', 'total', 'sum', 'bytes_out', 'bytes_in', 'errors')
+
+    def __init__(self, buckets):
+        self.counts = [0] * (len(buckets) + 1)  # the last one is +Inf
+        self.total = 0
+        self.sum = 0.0
+        self.bytes_out = 0
+        self.bytes_in = 0
+        self.errors = {}
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+class MetricsCollector(object):
+    """
+    Count API calls, bytes and errors, and bucket latencies, per API method.
+
+    Install it on a bot with ``Bot.add_metrics``; ``observe`` is then run
+    after every API call and upload. Errors are counted by their
+    ``GapError`` description, or by exception type for other failures.
+    """
+
+    def __init__(self, buckets=_default_buckets):
+        self._buckets = tuple(sorted(buckets))
+        self._methods = {}
+        self._lock = threading.Lock()
+
+    def observe(self, ob):
+        """Record a ``gappy.api.Observation``."""
+        with self._lock:
+            m = self._methods.get(ob.method)
+            if m is None:
+                m = self._methods[ob.method] = _MethodStats(self._buckets)
+            m.counts[bisect.bisect_left(self._buckets, ob.elapsed)] += 1
+            m.total += 1
+            m.sum += ob.elapsed
+            m.bytes_out += ob.bytes_out or 0
+            m.bytes_in += ob.bytes_in or 0
+            if ob.error is not None:
+                reason = getattr(ob.error, 'description', None) or type(ob.error).__name__
+                m.errors[reason] = m.errors.get(reason, 0) + 1
+
+    def snapshot(self):
+        """
+        :return: dict mapping each API method to its ``count``, ``errors``
+            (by reason), ``bytes_out``, ``bytes_in``, latency ``sum`` and
+            ``histogram`` (cumulative count per bucket upper bound)
+        """
+        with self._lock:
+            d = {}
+            for method, m in self._methods.items():
+                cumulative, histogram = 0, []
+                for bound, count in zip(self._buckets + (float('inf'),), m.counts):
+                    cumulative += count
+                    histogram.append((bound, cumulative))
+                d[method] = dict(count=m.total, errors=dict(m.errors), bytes_out=m.bytes_out,
+                                 bytes_in=m.bytes_in, sum=m.sum, histogram=histogram)
+            return d
+
+    def prometheus(self, prefix='gappy'):
+        """
+        :return: the metrics in the Prometheus text exposition format
+        """
+        snapshot = self.snapshot()
+        lines = []
+
+        def family(name, type, help):
+            lines.append('# HELP %s_%s %s' % (prefix, name, help))
+            lines.append('# TYPE %s_%s %s' % (prefix, name, type))
+
+        family('requests_total', 'counter', 'API calls made.')
+        for method, m in sorted(snapshot.items()):
+            lines.append('%s_requests_total{method="%s"} %d' % (prefix, _escape(method), m['count']))
+
+        family('request_errors_total', 'counter', 'API calls failed, by reason.')
+        for method, m in sorted(snapshot.items()):
+            for reason, count in sorted(m['errors'].items()):
+                lines.append('%s_request_errors_total{method="%s",reason="%s"} %d'
+                             % (prefix, _escape(method), _escape(reason), count))
+
+        family('request_duration_seconds', 'histogram', 'Latency of API calls.')
+        for method, m in sorted(snapshot.items()):
+            label = _escape(method)
+            for bound, count in m['histogram']:
+                le = '+Inf' if bound == float('inf') else repr(bound)
+                lines.append('%s_request_duration_seconds_bucket{method="%s",le="%s"} %d'
+                             % (prefix, label, le, count))
+            lines.append('%s_request_duration_seconds_sum{method="%s"} %r' % (prefix, label, m['sum']))
+            lines.append('%s_request_duration_seconds_count{method="%s"} %d' % (prefix, label, m['count']))
+
+        family('sent_bytes_total', 'counter', 'Request body bytes sent.')
+        for method, m in sorted(snapshot.items()):
+            lines.append('%s_sent_bytes_total{method="%s"} %d' % (prefix, _escape(method), m['bytes_out']))
+
+        family('received_bytes_total', 'counter', 'Response body bytes received.')
+        for method, m in sorted(snapshot.items()):
+            lines.append('%s_received_bytes_total{method="%s"} %d' % (prefix, _escape(method), m['bytes_in']))
+
+        return '\n'.join(lines) + '\n'
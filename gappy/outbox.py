@@ -0,0 +1,362 @@
+# -*- coding: utf-8 -*-
+"""
+Durable, at-least-once delivery of API calls.
+
+An ``Outbox`` writes every call to an SQLite table before it is sent, and
+marks it done once Gap has answered. Calls still waiting when the process
+dies are sent again when an outbox is opened on the same file, so a call may
+reach Gap twice but is never lost.
+
+Writes are group-committed: one thread commits whatever calls and
+acknowledgements have piled up in one transaction, while callers wait for
+the commit holding their call. Another thread reads the pending calls back
+from the table, a page at a time, and hands them to a pool of sending
+threads, in order within each chat; when those fall behind, say while Gap is
+down, calls wait on disk and committing goes on.
+
+Each call has an idempotency key. A call is not queued again while a call
+with the same key is pending or was finished less than ``retain`` seconds
+ago.
+
+Parameters are encoded by ``put``, so a call that cannot be stored fails on
+its own. A commit that fails is tried again a few times; calls of a batch
+that still could not be written are reported to the ``on_failed`` handlers,
+and raised to callers waiting for them.
+"""
+import copy
+import time
+import uuid
+import sqlite3
+import threading
+import collections
+from . import dispatch
+from . import exception
+from . import ratelimit
+from .store import _dumps, _loads
+
+
+PENDING, DELIVERED, FAILED = 0, 1, 2
+
+# Seconds to wait before each new attempt at a failed commit.
+_COMMIT_RETRIES = (0.05, 0.2, 1.0)
+
+# Pending calls read from the table at once to be sent.
+_FEED_PAGE = 256
+
+Entry = collections.namedtuple('Entry', ['key', 'method', 'params'])
+
+
+class _Batch(object):
+    __slots__ = ('entries', 'done', 'error')
+
+    def __init__(self):
+        self.entries = []
+        self.done = False
+        self.error = None
+
+
+class _Captured(Exception):
+    def __init__(self, method, params):
+        super(_Captured, self).__init__(method, params)
+
+
+def _capture(method, params=None, **kwargs):
+    raise _Captured(method, params)
+
+
+class Outbox(object):
+    """
+    Every method of the bot sending to a chat, listed in
+    ``gappy.dispatch.chat_methods``, is available on the outbox, with an
+    extra ``key`` keyword for its idempotency key; it queues the call and
+    returns the key. Use ``put`` to queue a raw API call.
+    """
+
+    def __init__(self, bot, path, workers=4, maxsize=1024, retry=None, fsync=False, retain=86400):
+        """
+        :param bot: a ``gappy.Bot`` making the calls
+        :param path: SQLite database file
+        :param workers: number of sending threads
+        :param maxsize: calls a sending thread may have waiting
+        :param retry: a ``gappy.ratelimit.RetryPolicy`` for failed sends;
+            ``GapError`` is final and not retried
+        :param fsync: sync every commit to disk, to survive power loss as
+            well as crashes
+        :param retain: seconds keys of finished calls are remembered
+        """
+        self._bot = bot
+        self._recorder = copy.copy(bot)
+        self._recorder._api_request = _capture
+        self._retry = retry if retry is not None else ratelimit.RetryPolicy(retries=10, backoff=1, max_backoff=60)
+        self._retain = retain
+
+        self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._db_lock = threading.Lock()
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute('PRAGMA synchronous=%s' % ('FULL' if fsync else 'NORMAL'))
+        self._db.execute('CREATE TABLE IF NOT EXISTS outbox '
+                         '(seq INTEGER PRIMARY KEY, key TEXT NOT NULL UNIQUE, method TEXT NOT NULL, '
+                         'params TEXT NOT NULL, state INTEGER NOT NULL, updated REAL, error TEXT)')
+        self._db.execute('CREATE INDEX IF NOT EXISTS outbox_pending ON outbox (seq) WHERE state = 0')
+        self._prune()
+
+        self._cond = threading.Condition()
+        self._batch = _Batch()
+        self._writing = None
+        self._acks = []
+        self._closing = False
+        self._stop = threading.Event()
+        self._fresh = threading.Event()
+        self._on_delivered = []
+        self._on_failed = []
+        self._counts = dict(queued=0, duplicate=0, delivered=0, failed=0, retried=0, commits=0)
+
+        self._executor = dispatch.PartitionedExecutor(workers, maxsize, 'gappy-outbox')
+        self._committer = threading.Thread(target=self._commit_loop, name='gappy-outbox-commit')
+        self._committer.daemon = True
+        self._committer.start()
+        self._feeder = threading.Thread(target=self._feed_loop, name='gappy-outbox-feed')
+        self._feeder.daemon = True
+        self._feeder.start()
+
+    def _prune(self):
+        with self._db_lock, self._db:
+            self._db.execute('DELETE FROM outbox WHERE state != 0 AND updated < ?',
+                             (time.time() - self._retain,))
+        self._pruned = time.time()
+
+    def put(self, method, params, key=None, wait=True):
+        """
+        Queue an API call.
+
+        :param method: API method, e.g. ``sendMessage``
+        :param params: dict of its parameters
+        :param key: idempotency key; a random one if not given
+        :param wait: return only once the call is on disk
+        :return: the key
+        :raise TypeError: if ``params`` cannot be encoded as JSON
+        """
+        given = key is not None
+        entry = Entry(str(key) if given else uuid.uuid4().hex, method, params)
+        text = _dumps(params)
+        with self._cond:
+            if self._closing:
+                raise RuntimeError('Outbox is closed')
+            batch = self._batch
+            batch.entries.append((entry, given, text))
+            self._cond.notify_all()
+            if wait:
+                while not batch.done:
+                    self._cond.wait()
+        if batch.error is not None:
+            raise batch.error
+        return entry.key
+
+    def flush(self):
+        """Wait until every call queued so far is on disk."""
+        with self._cond:
+            batch = self._batch if self._batch.entries else self._writing
+            self._cond.notify_all()
+            while batch is not None and not batch.done:
+                self._cond.wait()
+
+    def _commit_loop(self):
+        while 1:
+            with self._cond:
+                while not self._batch.entries and not self._acks and not self._closing:
+                    self._cond.wait()
+                batch, self._batch = self._batch, _Batch()
+                self._writing = batch
+                acks, self._acks = self._acks, []
+                closing = self._closing
+
+            fresh = []
+            for delay in _COMMIT_RETRIES + (None,):
+                try:
+                    fresh = self._write(batch.entries, acks)
+                except Exception as e:
+                    batch.error = e
+                    if delay is None:
+                        break
+                    time.sleep(delay)
+                else:
+                    batch.error = None
+                    break
+            with self._cond:
+                batch.done = True
+                if batch.error is None and (batch.entries or acks):
+                    self._counts['commits'] += 1
+                    self._counts['queued'] += len(fresh)
+                    self._counts['duplicate'] += len(batch.entries) - len(fresh)
+                elif batch.error is not None:
+                    # Lost acks only mean calls are sent again on the next run.
+                    self._counts['failed'] += len(batch.entries)
+                self._cond.notify_all()
+
+            if batch.error is not None:
+                for entry, _, _ in batch.entries:
+                    self._report(self._on_failed, entry, batch.error)
+            if fresh:
+                self._fresh.set()
+
+            if time.time() - self._pruned > 60:
+                self._prune()
+            if closing and not batch.entries and not acks:
+                return
+
+    def _write(self, entries, acks):
+        if not entries and not acks:
+            return []
+        with self._db_lock, self._db:
+            self._db.execute('BEGIN')
+            fresh, seen = [], set()
+            given = [entry.key for entry, explicit, _ in entries if explicit]
+            for i in range(0, len(given), 500):
+                chunk = given[i:i + 500]
+                seen.update(key for key, in self._db.execute(
+                    'SELECT key FROM outbox WHERE key IN (%s)' % ','.join('?' * len(chunk)), chunk))
+            rows = []
+            for entry, explicit, text in entries:
+                if explicit:
+                    if entry.key in seen:
+                        continue
+                    seen.add(entry.key)
+                fresh.append(entry)
+                rows.append((entry.key, entry.method, text))
+            self._db.executemany('INSERT INTO outbox (key, method, params, state) VALUES (?, ?, ?, 0)', rows)
+            self._db.executemany('UPDATE outbox SET state = ?, updated = ?, error = ? WHERE key = ?', acks)
+        return fresh
+
+    def _feed_loop(self):
+        # Calls are committed in `seq` order, so those after the last one
+        # handed out are the ones left to send, including a previous run's.
+        last = 0
+        while not self._stop.is_set():
+            self._fresh.clear()
+            with self._db_lock:
+                rows = self._db.execute('SELECT seq, key, method, params FROM outbox '
+                                        'WHERE state = 0 AND seq > ? ORDER BY seq LIMIT ?',
+                                        (last, _FEED_PAGE)).fetchall()
+            if not rows:
+                if not self._committer.is_alive():
+                    return
+                self._fresh.wait()
+                continue
+            for seq, key, method, params in rows:
+                if self._stop.is_set():
+                    return
+                # blocks while the senders are behind
+                self._submit(Entry(key, method, _loads(params)))
+                last = seq
+
+    def _submit(self, entry):
+        self._executor.submit(dispatch.chat_key(entry.params), self._deliver, entry)
+
+    def _deliver(self, entry):
+        attempt = 0
+        while not self._stop.is_set():
+            try:
+                result = self._bot._api_request(entry.method, entry.params)
+            except exception.GapError as e:
+                self._finish(entry, FAILED, None, e)
+                return
+            except Exception as e:
+                if attempt >= self._retry.retries:
+                    self._finish(entry, FAILED, None, e)
+                    return
+                with self._cond:
+                    self._counts['retried'] += 1
+                self._stop.wait(self._retry.delay(attempt, getattr(getattr(e, 'response', None), 'headers', None)))
+                attempt += 1
+            else:
+                self._finish(entry, DELIVERED, result, None)
+                return
+        # left pending, to be sent again when the outbox is next opened
+
+    def _finish(self, entry, state, result, error):
+        with self._cond:
+            self._acks.append((state, time.time(), None if error is None else repr(error), entry.key))
+            self._counts['delivered' if state == DELIVERED else 'failed'] += 1
+            self._cond.notify_all()
+        if state == DELIVERED:
+            self._report(self._on_delivered, entry, result)
+        else:
+            self._report(self._on_failed, entry, error)
+
+    @staticmethod
+    def _report(handlers, entry, outcome):
+        for fn in handlers:
+            try:
+                fn(entry, outcome)
+            except Exception:
+                pass
+
+    def on_delivered(self, fn):
+        """
+        Call ``fn(entry, result)`` after each call Gap accepted.
+
+        May be used as a decorator.
+        """
+        self._on_delivered.append(fn)
+        return fn
+
+    def on_failed(self, fn):
+        """
+        Call ``fn(entry, error)`` after each call given up on.
+
+        May be used as a decorator.
+        """
+        self._on_failed.append(fn)
+        return fn
+
+    def __getattr__(self, name):
+        if name not in dispatch.chat_methods:
+            raise AttributeError('%r object has no attribute %r' % (type(self).__name__, name))
+        fn = getattr(self._recorder, name)
+
+        def call(*args, **kwargs):
+            key = kwargs.pop('key', None)
+            wait = kwargs.pop('wait', True)
+            try:
+                return fn(*args, **kwargs)
+            except _Captured as c:
+                method, params = c.args
+                return self.put(method, params, key, wait)
+        call.__name__ = name
+        call.__doc__ = fn.__doc__
+        return call
+
+    def pending(self):
+        """Number of calls on disk and not yet finished."""
+        with self._db_lock:
+            return self._db.execute('SELECT COUNT(*) FROM outbox WHERE state = 0').fetchone()[0]
+
+    def stats(self):
+        """
+        :return: dict with calls ``queued``, ``duplicate`` (ignored for their
+            key), ``delivered``, ``failed``, ``retried``, transactions
+            ``commits`` and the sending threads' ``workers`` stats
+        """
+        with self._cond:
+            d = dict(self._counts)
+        d['workers'] = self._executor.stats()
+        return d
+
+    def close(self, wait=True):
+        """
+        Stop taking calls and shut down.
+
+        :param wait: send every queued call first; otherwise calls not yet
+            sent stay on disk for the next run
+        """
+        with self._cond:
+            self._closing = True
+            self._cond.notify_all()
+        if not wait:
+            self._stop.set()
+        self._committer.join()
+        self._fresh.set()
+        self._feeder.join()
+        self._executor.shutdown(True)
+        self._write([], self._acks)
+        self._db.close()
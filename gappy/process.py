@@ -0,0 +1,235 @@
+# -*- coding: utf-8 -*-
+"""
+Run handlers in worker processes, for CPU-bound work the GIL would serialize.
+
+``ProcessExecutor`` has the ``submit(key, fn, *args)`` interface of
+``gappy.dispatch.PartitionedExecutor``: tasks with the same key go to the
+same process and run in order. Functions and arguments are pickled, so
+handlers must be module-level functions. Each process gets its own bot by
+creating one in ``initializer``, so sends from handlers go over that
+process's own connection pool.
+
+A process that dies is started again, with a new queue: the tasks it had
+queued or running fail, and later tasks for its keys go to the new one.
+"""
+import os
+import time
+import queue
+import pickle
+import itertools
+import threading
+import multiprocessing
+import multiprocessing.connection
+import concurrent.futures
+
+
+def _work(index, tasks, results, initializer, initargs):
+    if initializer is not None:
+        initializer(*initargs)
+    while 1:
+        task = tasks.get()
+        if task is None:
+            results.put((index, None, None, None, None))
+            return
+
+        id, payload = task
+        start = time.perf_counter()
+        try:
+            fn, args, kwargs = pickle.loads(payload)
+            result, ok = fn(*args, **kwargs), True
+        except BaseException as e:
+            result, ok = e, False
+        elapsed = time.perf_counter() - start
+        try:
+            data = pickle.dumps(result)
+        except Exception as e:
+            data, ok = pickle.dumps(RuntimeError('Cannot send back %r: %s' % (result, e))), False
+        results.put((index, id, ok, data, elapsed))
+
+
+class ProcessExecutor(object):
+    """
+    :param processes: number of worker processes, the number of CPUs by default
+    :param maxsize: tasks a process may have queued before ``submit`` blocks
+    :param initializer: called with ``initargs`` in each process on start,
+        e.g. to create the process's ``gappy.Bot``
+    :param timeout: seconds ``submit`` may block before ``queue.Full`` is raised
+    :param context: ``multiprocessing`` start method, e.g. ``spawn``
+    """
+
+    def __init__(self, processes=None, maxsize=1024, initializer=None, initargs=(),
+                 timeout=None, context=None, name='gappy-process'):
+        n = processes or os.cpu_count() or 1
+        self._ctx = ctx = multiprocessing.get_context(context)
+        self._initializer = initializer
+        self._initargs = initargs
+        self._name = name
+        self._timeout = timeout
+        self._tasks = [ctx.Queue() for _ in range(n)]
+        self._slots = [threading.Semaphore(maxsize) for _ in range(n)]
+        self._results = ctx.Queue()
+        self._futures = {}
+        self._ids = itertools.count()
+        self._roundrobin = itertools.count()
+        self._lock = threading.Lock()
+        self._submitted = [0] * n
+        self._completed = [0] * n
+        self._failed = [0] * n
+        self._busy = [0.0] * n
+        self._restarts = 0
+        self._started = time.time()
+        self._closed = False
+
+        self._processes = [self._start(i) for i in range(n)]
+        self._running = set(range(n))
+        self._collector = threading.Thread(target=self._collect, name='%s-results' % name)
+        self._collector.daemon = True
+        self._collector.start()
+
+    def _start(self, i):
+        p = self._ctx.Process(target=_work,
+                              args=(i, self._tasks[i], self._results, self._initializer, self._initargs),
+                              name='%s-%d' % (self._name, i))
+        p.daemon = True
+        p.start()
+        return p
+
+    def _partition(self, key):
+        if key is None:
+            return next(self._roundrobin) % len(self._tasks)
+        # `str` so that chat 123 and chat '123' share a process
+        return hash(str(key)) % len(self._tasks)
+
+    def submit(self, key, fn, *args, **kwargs):
+        """
+        Schedule ``fn(*args, **kwargs)`` on the process owning ``key``.
+
+        :return: concurrent.futures.Future
+        :raise pickle.PicklingError: if the call cannot be sent to a process
+        """
+        if self._closed:
+            raise RuntimeError('Executor is shut down')
+        payload = pickle.dumps((fn, args, kwargs))
+        i = self._partition(key)
+        if not self._slots[i].acquire(timeout=self._timeout):
+            raise queue.Full
+        future = concurrent.futures.Future()
+        future.set_running_or_notify_cancel()
+        id = next(self._ids)
+        with self._lock:
+            self._futures[id] = (future, i)
+            self._submitted[i] += 1
+            # under the lock, so it cannot go to a queue `_reap` is replacing
+            self._tasks[i].put((id, payload))
+        return future
+
+    def _collect(self):
+        reader = self._results._reader
+        while self._running:
+            with self._lock:
+                sentinels = [self._processes[i].sentinel for i in self._running]
+            # woken by a result as well as by a process ending, however
+            # busy the others keep the queue
+            ready = multiprocessing.connection.wait([reader] + sentinels, timeout=1)
+            while 1:
+                try:
+                    item = self._results.get(False)
+                except queue.Empty:
+                    break
+                self._handle(*item)
+            # a process's results are all in the pipe before it ends, and
+            # were just read, so what is left in flight is lost
+            if ready != [reader]:
+                self._reap()
+
+    def _handle(self, i, id, ok, data, elapsed):
+        if id is None:
+            self._running.discard(i)
+            return
+
+        with self._lock:
+            future, _ = self._futures.pop(id, (None, None))
+            if future is None:
+                return  # failed already, its process died
+            self._busy[i] += elapsed
+            if ok:
+                self._completed[i] += 1
+            else:
+                self._failed[i] += 1
+        self._slots[i].release()
+        try:
+            result = pickle.loads(data)
+        except Exception as e:
+            result, ok = RuntimeError('Cannot read the result: %r' % e), False
+        if ok:
+            future.set_result(result)
+        else:
+            future.set_exception(result)
+
+    def _reap(self):
+        # Fail the tasks of processes that died without saying goodbye, and
+        # start them again unless shutting down.
+        for i in list(self._running):
+            if self._processes[i].is_alive():
+                continue
+            with self._lock:
+                lost = [(id, f) for id, (f, j) in self._futures.items() if j == i]
+                for id, _ in lost:
+                    del self._futures[id]
+                self._failed[i] += len(lost)
+                if self._closed:
+                    self._running.discard(i)
+                else:
+                    # the old queue may be broken by a process killed reading it
+                    self._tasks[i] = self._ctx.Queue()
+                    self._processes[i] = self._start(i)
+                    self._restarts += 1
+            for _ in lost:
+                self._slots[i].release()
+            for _, future in lost:
+                future.set_exception(RuntimeError('Worker process %d died' % i))
+
+    def depths(self):
+        """Number of tasks queued or running in each process."""
+        with self._lock:
+            return [s - c - f for s, c, f in zip(self._submitted, self._completed, self._failed)]
+
+    def stats(self):
+        """
+        :return: dict with ``submitted``, ``completed`` and ``failed`` task
+            counts, per-process ``depths``, ``busy`` seconds and
+            ``utilization`` (busy share of the time since start), the
+            number of processes ``alive`` and of ``restarts``
+        """
+        elapsed = max(time.time() - self._started, 1e-9)
+        with self._lock:
+            return dict(submitted=sum(self._submitted),
+                        completed=sum(self._completed),
+                        failed=sum(self._failed),
+                        depths=[s - c - f for s, c, f in
+                                zip(self._submitted, self._completed, self._failed)],
+                        busy=list(self._busy),
+                        utilization=[b / elapsed for b in self._busy],
+                        alive=sum(p.is_alive() for p in self._processes),
+                        restarts=self._restarts)
+
+    def shutdown(self, wait=True, timeout=None):
+        """
+        Stop the processes once they have run the tasks queued.
+
+        :param wait: block until they are done
+        :param timeout: seconds to wait before terminating the ones left
+        """
+        with self._lock:
+            self._closed = True
+            for q in self._tasks:
+                q.put(None)
+        if not wait:
+            return
+        deadline = None if timeout is None else time.time() + timeout
+        for p in self._processes:
+            p.join(None if deadline is None else max(0, deadline - time.time()))
+            if p.is_alive():
+                p.terminate()
+                p.join()
+        self._collector.join()
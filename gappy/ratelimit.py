@@ -0,0 +1,139 @@
+# -*- coding: utf-8 -*-
+import time
+import random
+import threading
+import collections
+import email.utils
+
+
+class TokenBucket(object):
+    """
+    Allow ``rate`` operations per second, with bursts of up to ``burst``.
+
+    Tokens are reserved rather than waited for under the lock: ``reserve``
+    takes them right away, letting the balance go negative, and returns how
+    long the caller has to wait before using them. Concurrent callers thus
+    line up without ever holding the lock while sleeping.
+    """
+
+    def __init__(self, rate, burst=None):
+        self._rate = float(rate)
+        self._burst = float(burst if burst is not None else max(rate, 1))
+        self._tokens = self._burst
+        self._stamp = time.monotonic()
+        self._lock = threading.Lock()
+
+    def reserve(self, tokens=1):
+        """
+        Take ``tokens`` from the bucket.
+
+        :return: seconds to wait before they may be used
+        """
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self._burst, self._tokens + (now - self._stamp) * self._rate)
+            self._stamp = now
+            self._tokens -= tokens
+            return -self._tokens / self._rate if self._tokens < 0 else 0.0
+
+    def acquire(self, tokens=1):
+        delay = self.reserve(tokens)
+        if delay > 0:
+            time.sleep(delay)
+
+
+class RateLimiter(object):
+    """
+    Throttle API calls globally and per chat.
+
+    :param rate: calls per second over all chats, or ``None`` for no limit
+    :param burst: calls allowed at once over all chats
+    :param per_chat_rate: calls per second to any one chat, or ``None``
+    :param per_chat_burst: calls allowed at once to any one chat
+    :param max_chats: per-chat buckets kept; the least recently used are
+        dropped first, which only ever makes a chat's limit more lenient
+    """
+
+    def __init__(self, rate=None, burst=None, per_chat_rate=None, per_chat_burst=None, max_chats=100000):
+        self._global = TokenBucket(rate, burst) if rate else None
+        self._per_chat_rate = per_chat_rate
+        self._per_chat_burst = per_chat_burst
+        self._max_chats = max_chats
+        self._chats = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def _chat_bucket(self, chat_id):
+        key = str(chat_id)
+        with self._lock:
+            bucket = self._chats.get(key)
+            if bucket is None:
+                bucket = self._chats[key] = TokenBucket(self._per_chat_rate, self._per_chat_burst)
+                if len(self._chats) > self._max_chats:
+                    self._chats.popitem(last=False)
+            else:
+                self._chats.move_to_end(key)
+            return bucket
+
+    def reserve(self, chat_id=None):
+        """
+        Reserve one call to ``chat_id``.
+
+        :return: seconds to wait before making it
+        """
+        delay = self._global.reserve() if self._global is not None else 0.0
+        if self._per_chat_rate and chat_id is not None:
+            delay = max(delay, self._chat_bucket(chat_id).reserve())
+        return delay
+
+    def acquire(self, chat_id=None):
+        """Block until one call to ``chat_id`` is allowed."""
+        delay = self.reserve(chat_id)
+        if delay > 0:
+            time.sleep(delay)
+
+
+class RetryPolicy(object):
+    """
+    Decide whether and when a failed API call is made again.
+
+    Calls are retried on connection errors and on the HTTP ``statuses``
+    given, up to ``retries`` times. A ``Retry-After`` header is honored up
+    to ``max_backoff`` seconds; otherwise the delay doubles on every attempt, from ``backoff`` up to
+    ``max_backoff`` seconds, and is randomized between half and all of it.
+    """
+
+    def __init__(self, retries=3, backoff=0.5, max_backoff=30, statuses=(429, 500, 502, 503, 504)):
+        self.retries = retries
+        self._backoff = backoff
+        self._max_backoff = max_backoff
+        self._statuses = frozenset(statuses)
+
+    def retryable(self, status):
+        return status in self._statuses
+
+    @staticmethod
+    def _retry_after(headers):
+        value = headers.get('Retry-After') if headers is not None else None
+        if not value:
+            return None
+        try:
+            return max(0.0, float(value))
+        except ValueError:
+            pass
+        try:
+            return max(0.0, email.utils.parsedate_to_datetime(value).timestamp() - time.time())
+        except (TypeError, ValueError):
+            return None
+
+    def delay(self, attempt, headers=None):
+        """
+        :param attempt: number of attempts failed so far, minus one
+        :param headers: headers of the failed response, if any
+        :return: seconds to wait before the next attempt
+        """
+        retry_after = self._retry_after(headers)
+        if retry_after is not None:
+            # never hold a sending thread for as long as the server asks
+            return min(self._max_backoff, retry_after)
+        d = min(self._max_backoff, self._backoff * 2 ** attempt)
+        return random.uniform(d / 2, d)
@@ -0,0 +1,146 @@
+# -*- coding: utf-8 -*-
+"""
+Recurring schedules for ``Bot.Scheduler``.
+
+A schedule gives the time of each occurrence after the one before, from
+the time it was meant to happen rather than the time it actually did, so
+occurrences never drift. Occurrences missed while the scheduler was busy or
+stopped are skipped, not fired in a burst.
+
+Schedules are stored by their ``spec``, e.g. ``every 60`` or
+``cron */5 * * * *``, and made again with ``parse``.
+"""
+import time
+import datetime
+
+
+class Every(object):
+    """Every ``seconds`` seconds."""
+
+    def __init__(self, seconds):
+        if seconds <= 0:
+            raise ValueError('Interval must be positive')
+        self.seconds = seconds
+        self.spec = 'every %r' % seconds
+
+    def next(self, when, now=None):
+        """
+        :param when: time of the last occurrence
+        :return: time of the first occurrence after ``when`` and ``now``
+        """
+        if now is None:
+            now = time.time()
+        when += self.seconds
+        if when <= now:
+            when += (int((now - when) // self.seconds) + 1) * self.seconds
+        return when
+
+
+def _field(text, low, high, names=None):
+    values = set()
+    for part in text.split(','):
+        part = part.lower()
+        step = 1
+        if '/' in part:
+            part, step = part.split('/')
+            step = int(step)
+            if step < 1:
+                raise ValueError('Bad step: %r' % text)
+        if part == '*':
+            first, last = low, high
+        else:
+            if names is not None:
+                for i, name in enumerate(names):
+                    part = part.replace(name, str(low + i))
+            if '-' in part:
+                first, last = map(int, part.split('-'))
+            else:
+                first = int(part)
+                last = high if step > 1 else first
+        if not low <= first <= last <= high:
+            raise ValueError('Out of range %d-%d: %r' % (low, high, text))
+        values.update(range(first, last + 1, step))
+    return frozenset(values)
+
+
+_months = ('jan', 'feb', 'mar', 'apr', 'may', 'jun', 'jul', 'aug', 'sep', 'oct', 'nov', 'dec')
+_days = ('sun', 'mon', 'tue', 'wed', 'thu', 'fri', 'sat')
+
+
+class Cron(object):
+    """
+    A cron expression: ``minute hour day-of-month month day-of-week``, in
+    local time.
+
+    Fields take ``*``, numbers, ranges ``a-b``, steps ``*/n`` or ``a-b/n``
+    and comma-separated lists; months and days of the week may be given by
+    their three-letter English names. Sunday is 0 or 7. As in cron, when
+    both days of the month and of the week are restricted, a day matching
+    either one is used.
+
+    Times are those of the wall clock: one falling in the hour skipped when
+    clocks go forward does not happen that day, and one in the hour
+    repeated when they go back happens twice.
+    """
+
+    def __init__(self, expr):
+        fields = expr.split()
+        if len(fields) != 5:
+            raise ValueError('Cron expression needs 5 fields: %r' % expr)
+        self.minutes = _field(fields[0], 0, 59)
+        self.hours = _field(fields[1], 0, 23)
+        self.days = _field(fields[2], 1, 31)
+        self.months = _field(fields[3], 1, 12, _months)
+        weekdays = _field(fields[4], 0, 7, _days)
+        # cron counts from Sunday = 0, `datetime.weekday` from Monday = 0
+        self.weekdays = frozenset((d - 1) % 7 for d in weekdays)
+        self._any_day = fields[2] == '*'
+        self._any_weekday = fields[4] == '*'
+        self.spec = 'cron ' + ' '.join(fields)
+
+    def _day_matches(self, d):
+        in_month = d.day in self.days
+        in_week = d.weekday() in self.weekdays
+        if self._any_day or self._any_weekday:
+            return in_month and in_week
+        return in_month or in_week
+
+    def next(self, when, now=None):
+        """
+        :param when: time of the last occurrence
+        :return: time of the first occurrence after ``when`` and ``now``
+        """
+        if now is None:
+            now = time.time()
+        # Walk real time, reading the local fields at each step, so that the
+        # hour repeated or skipped when clocks change is handled as it comes.
+        t = (int(max(when, now)) // 60 + 1) * 60
+        limit = datetime.datetime.fromtimestamp(t).year + 5
+        while 1:
+            d = datetime.datetime.fromtimestamp(t)
+            if d.year > limit:
+                break
+            if d.month not in self.months:
+                start = (d.replace(day=1, hour=0, minute=0) + datetime.timedelta(days=32)).replace(day=1)
+                t = max(t + 60, int(start.timestamp()))
+            elif not self._day_matches(d):
+                start = d.replace(hour=0, minute=0) + datetime.timedelta(days=1)
+                t = max(t + 60, int(start.timestamp()))
+            elif d.hour not in self.hours:
+                t += (60 - d.minute) * 60
+            elif d.minute not in self.minutes:
+                t += 60
+            else:
+                return float(t)
+        raise ValueError('%s never happens' % self.spec)
+
+
+def parse(spec):
+    """Schedule from its ``spec``."""
+    kind, _, rest = spec.partition(' ')
+    if kind == 'every':
+        seconds = float(rest)
+        return Every(int(seconds) if seconds.is_integer() else seconds)
+    if kind == 'cron':
+        return Cron(rest)
+    raise ValueError('Unknown schedule: %r' % spec)
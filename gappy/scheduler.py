@@ -0,0 +1,276 @@
+# -*- coding: utf-8 -*-
+"""
+``Bot.Scheduler``: emit data at given times, on a thread of its own.
+
+Imported when ``Bot.Scheduler`` is first used.
+"""
+import time
+import heapq
+import itertools
+import threading
+import collections
+from . import dispatch
+from . import exception
+from . import schedule
+
+
+class Scheduler(threading.Thread):
+    Event = collections.namedtuple('Event', ['timestamp', 'data'])
+    Event.__eq__ = lambda self, other: self.timestamp == other.timestamp
+    Event.__ne__ = lambda self, other: self.timestamp != other.timestamp
+    Event.__gt__ = lambda self, other: self.timestamp > other.timestamp
+    Event.__ge__ = lambda self, other: self.timestamp >= other.timestamp
+    Event.__lt__ = lambda self, other: self.timestamp < other.timestamp
+    Event.__le__ = lambda self, other: self.timestamp <= other.timestamp
+
+    # Once more than this many cancelled entries pile up, and they make up
+    # over half of the queue, the heap is rebuilt without them.
+    _compact_threshold = 1024
+
+    def __init__(self, workers=0, max_pending=1024, store=None, executor=None):
+        """
+        Reentrant lock to allow locked method calling locked method.
+
+        :param workers: if non-zero, due events are handed to this many
+            worker threads instead of being handled on the scheduler
+            thread. Events with the same ``chat_id`` go to the same
+            worker, so they are still handled in order; callables
+            producing event data are called on the scheduler thread to
+            learn theirs.
+        :param max_pending: events a worker may have waiting before the
+            scheduler thread blocks on it
+        :param store: a ``gappy.store.SQLiteStore`` or ``LogStore`` that
+            keeps queued events across restarts. Events already in the
+            store are queued again right away.
+        :param executor: a ``gappy.process.ProcessExecutor``, or any
+            object with its ``submit(key, fn, *args)``, to run the event
+            handler in, partitioned by ``chat_id``, as with ``workers``.
+        """
+        super(Scheduler, self).__init__()
+        # Heap of [timestamp, sequence, event] entries. A cancelled entry
+        # keeps its place with `event` set to None until it is popped.
+        self._eventq = []
+        self._entries = {}
+        self._sequence = itertools.count()
+        self._cancelled = 0
+        self._lock = threading.RLock()
+        self._wakeup = threading.Condition(self._lock)
+        self._event_handler = None
+        if executor is None and workers:
+            executor = dispatch.PartitionedExecutor(workers, max_pending)
+        self._executor = executor
+        self._store = store
+        if store is not None:
+            self._load_events()
+
+    def _load_events(self):
+        # Rows come back sorted by (timestamp, seq), which is already
+        # a valid heap.
+        last = -1
+        for seq, when, data, spec in self._store.load():
+            ev = self.Event(when, data)
+            entry = [when, seq, ev]
+            if spec is not None:
+                entry.append(schedule.parse(spec))
+            self._eventq.append(entry)
+            self._entries[id(ev)] = entry
+            last = max(last, seq)
+        self._sequence = itertools.count(last + 1)
+
+    def _locked(fn):
+        def k(self, *args, **kwargs):
+            with self._lock:
+                return fn(self, *args, **kwargs)
+        return k
+
+    @_locked
+    def _insert_event(self, data, when, recurrence=None):
+        ev = self.Event(when, data)
+        entry = [when, next(self._sequence), ev]
+        if recurrence is not None:
+            # Recurring entries carry their schedule as a fourth item.
+            entry.append(recurrence)
+        if self._store is not None:
+            self._store.add(entry[1], when, data, recurrence and recurrence.spec)
+        heapq.heappush(self._eventq, entry)
+        self._entries[id(ev)] = entry
+
+        # Only a new earliest deadline changes how long `run` must sleep.
+        if self._eventq[0] is entry:
+            self._wakeup.notify()
+        return ev
+
+    @_locked
+    def _remove_event(self, event):
+        # The entry keeps its event alive, so `id` is unique among entries.
+        entry = self._entries.pop(id(event), None)
+        if entry is None:
+            raise exception.EventNotFound(event)
+
+        if self._store is not None:
+            self._store.remove(entry[1])
+        entry[2] = None
+        self._cancelled += 1
+        if self._cancelled > self._compact_threshold and self._cancelled * 2 > len(self._eventq):
+            self._eventq = [e for e in self._eventq if e[2] is not None]
+            heapq.heapify(self._eventq)
+            self._cancelled = 0
+
+    def _drop_cancelled(self):
+        while self._eventq and self._eventq[0][2] is None:
+            heapq.heappop(self._eventq)
+            self._cancelled -= 1
+
+    def _pop(self):
+        entry = self._eventq[0]
+        ev = entry[2]
+        if len(entry) > 3:
+            # Recurring: the same entry moves to the next occurrence,
+            # counted from when this one was due, not from now.
+            entry[0] = entry[3].next(entry[0])
+            heapq.heapreplace(self._eventq, entry)
+            if self._store is not None:
+                self._store.add(entry[1], entry[0], ev.data, entry[3].spec)
+            return ev
+        heapq.heappop(self._eventq)
+        del self._entries[id(ev)]
+        if self._store is not None:
+            self._store.remove(entry[1])
+        return ev
+
+    @_locked
+    def _pop_expired_event(self):
+        self._drop_cancelled()
+        if not self._eventq:
+            return None
+
+        if self._eventq[0][0] <= time.time():
+            return self._pop()
+        else:
+            return None
+
+    @_locked
+    def _wait_expired_event(self):
+        while 1:
+            self._drop_cancelled()
+            delay = self._eventq[0][0] - time.time() if self._eventq else None
+            if delay is not None and delay <= 0:
+                return self._pop()
+
+            # Going idle is a good moment to write buffered changes out,
+            # and changes buffered meanwhile must not wait for long.
+            if self._store is not None:
+                if self._store.pending():
+                    self._store.flush()
+                if delay is None or delay > self._store.flush_interval:
+                    delay = self._store.flush_interval
+            self._wakeup.wait(delay)
+
+    def event_at(self, when, data):
+        """
+        Schedule some data to emit at an absolute timestamp.
+
+        :type when: int or float
+        :type data: dictionary
+        :return: an internal Event object
+        """
+        return self._insert_event(data, when)
+
+    def event_later(self, delay, data):
+        """
+        Schedule some data to emit after a number of seconds.
+
+        :type delay: int or float
+        :type data: dictionary
+        :return: an internal Event object
+        """
+        return self._insert_event(data, time.time() + delay)
+
+    def event_now(self, data):
+        """
+        Emit some data as soon as possible.
+
+        :type data: dictionary
+        :return: an internal Event object
+        """
+        return self._insert_event(data, time.time())
+
+    def event_every(self, seconds, data, start=None):
+        """
+        Schedule some data to emit every number of seconds, until cancelled.
+
+        :type seconds: int or float
+        :type data: dictionary
+        :param start: timestamp of the first time; ``seconds`` from now
+            if not given
+        :return: an internal Event object, for ``cancel``
+        """
+        every = schedule.Every(seconds)
+        return self._insert_event(data, time.time() + seconds if start is None else start, every)
+
+    def event_cron(self, expr, data):
+        """
+        Schedule some data to emit at the times of a cron expression,
+        until cancelled.
+
+        :param expr: e.g. ``*/15 9-17 * * mon-fri``; see ``gappy.schedule.Cron``
+        :type data: dictionary
+        :return: an internal Event object, for ``cancel``
+        """
+        cron = schedule.Cron(expr)
+        return self._insert_event(data, cron.next(time.time()), cron)
+
+    def cancel(self, event):
+        """
+        Cancel an event.
+
+        :type event: an internal Event object
+        """
+        self._remove_event(event)
+
+    def _emit(self, data):
+        if callable(data):
+            d = data()  # call the data-producing function
+            if d is not None:
+                self._event_handler(d)
+        else:
+            self._event_handler(data)
+
+    def run(self):
+        while 1:
+            e = self._wait_expired_event()
+            if self._executor is None:
+                self._emit(e.data)
+            else:
+                # Data-producing callables are called here, so that their
+                # data goes to the worker owning its chat, in order. Only the
+                # handler is sent to a process; it must be picklable, the
+                # callables need not be.
+                data = e.data() if callable(e.data) else e.data
+                if data is not None:
+                    self._executor.submit(dispatch.chat_key(data), self._event_handler, data)
+
+    def flush(self):
+        """Write buffered changes to the store, if any."""
+        if self._store is not None:
+            self._store.flush()
+
+    def stats(self):
+        """
+        Scheduler counters.
+
+        :return: dict with ``queued`` events and, in worker mode, the
+            ``workers`` stats of the executor
+        """
+        with self._lock:
+            d = dict(queued=len(self._entries))
+        if self._executor is not None:
+            d['workers'] = self._executor.stats()
+        return d
+
+    def run_as_thread(self):
+        self.daemon = True
+        self.start()
+
+    def on_event(self, fn):
+        self._event_handler = fn
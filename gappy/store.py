@@ -0,0 +1,215 @@
+# -*- coding: utf-8 -*-
+"""
+Durable event storage for ``Bot.Scheduler``.
+
+A store receives every event the scheduler queues or drops and hands them
+back on startup. Writes are buffered and written out in batches, either when
+``batch_size`` operations have piled up, when the oldest has waited
+``flush_interval`` seconds, or when the scheduler goes idle.
+
+Event data is stored as JSON. Callable data is stored by reference, as the
+import path of a module-level function, and imported again on load; lambdas,
+nested functions and bound methods cannot be stored. Recurring events also
+keep the ``spec`` of their ``gappy.schedule`` schedule, and are stored again
+with their next timestamp each time they fire.
+"""
+import os
+import json
+import time
+import sqlite3
+import itertools
+import importlib
+import threading
+
+
+_dumps = json.JSONEncoder(separators=(',', ':')).encode
+_loads = json.JSONDecoder().decode
+
+
+def _encode(data):
+    # No JSON text starts with '@', so it marks a function reference.
+    if callable(data):
+        name = getattr(data, '__qualname__', None)
+        module = getattr(data, '__module__', None)
+        if not name or not module or '<' in name or '.' in name:
+            raise ValueError('Only module-level functions can be stored, not %r' % (data,))
+        return '@%s:%s' % (module, name)
+    return _dumps(data)
+
+
+def _decode(text):
+    if text[0] == '@':
+        module, name = text[1:].split(':')
+        return getattr(importlib.import_module(module), name)
+    return _loads(text)
+
+
+def _encode_event(data, schedule):
+    # A schedule goes in front, marked by '%', which no JSON text starts with.
+    text = _encode(data)
+    return text if schedule is None else '%%%s\t%s' % (schedule, text)
+
+
+def _decode_event(text):
+    """:return: tuple of data and schedule spec"""
+    if text[0] == '%':
+        schedule, text = text[1:].split('\t', 1)
+        return _decode(text), schedule
+    return _decode(text), None
+
+
+class _BatchedStore(object):
+    def __init__(self, batch_size, flush_interval):
+        self._batch_size = batch_size
+        self.flush_interval = flush_interval
+        self._pending = []
+        self._oldest = None
+        self._lock = threading.Lock()
+
+    def _buffer(self, op):
+        with self._lock:
+            if not self._pending:
+                self._oldest = time.time()
+            self._pending.append(op)
+            due = (len(self._pending) >= self._batch_size or
+                   time.time() - self._oldest >= self.flush_interval)
+        if due:
+            self.flush()
+
+    def add(self, seq, timestamp, data, schedule=None):
+        """
+        Record a queued event, or the next time of a recurring one.
+
+        :param schedule: ``spec`` of the schedule of a recurring event
+        :raise ValueError: if ``data`` cannot be stored
+        """
+        self._buffer((seq, timestamp, _encode_event(data, schedule)))
+
+    def remove(self, seq):
+        """Record that an event was cancelled or emitted."""
+        self._buffer((seq, None, None))
+
+    def pending(self):
+        return len(self._pending)
+
+    def flush(self):
+        """Write all buffered operations out."""
+        with self._lock:
+            ops, self._pending = self._pending, []
+            if ops:
+                self._write(ops)
+
+    def close(self):
+        self.flush()
+
+
+class SQLiteStore(_BatchedStore):
+    """Keep scheduler events in an SQLite table indexed by timestamp."""
+
+    def __init__(self, path, batch_size=1000, flush_interval=1.0):
+        super(SQLiteStore, self).__init__(batch_size, flush_interval)
+        self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute('PRAGMA synchronous=NORMAL')
+        self._db.execute('CREATE TABLE IF NOT EXISTS events '
+                         '(seq INTEGER PRIMARY KEY, timestamp REAL NOT NULL, data TEXT NOT NULL)')
+        self._db.execute('CREATE INDEX IF NOT EXISTS events_timestamp ON events (timestamp, seq)')
+
+    def _write(self, ops):
+        with self._db:
+            self._db.execute('BEGIN')
+            # Runs of inserts and of deletes go in one statement each;
+            # the order of the runs is kept.
+            for deleting, run in itertools.groupby(ops, key=lambda op: op[1] is None):
+                if deleting:
+                    self._db.executemany('DELETE FROM events WHERE seq = ?',
+                                         ((seq,) for seq, _, _ in run))
+                else:
+                    self._db.executemany('INSERT OR REPLACE INTO events VALUES (?, ?, ?)', run)
+
+    def load(self):
+        """
+        Stored events, earliest first.
+
+        :return: iterator of ``(seq, timestamp, data, schedule)``
+        """
+        self.flush()
+        cursor = self._db.execute('SELECT seq, timestamp, data FROM events ORDER BY timestamp, seq')
+        for seq, timestamp, data in cursor:
+            yield (seq, timestamp) + _decode_event(data)
+
+    def close(self):
+        super(SQLiteStore, self).close()
+        self._db.close()
+
+
+class LogStore(_BatchedStore):
+    """
+    Keep scheduler events in an append-only log file.
+
+    Each line is ``+ seq timestamp data`` or ``- seq``. The log is compacted
+    when it is loaded, so it only grows with the traffic of one run.
+    """
+
+    def __init__(self, path, batch_size=1000, flush_interval=1.0, fsync=False):
+        super(LogStore, self).__init__(batch_size, flush_interval)
+        self._path = path
+        self._fsync = fsync
+        self._file = open(path, 'a', encoding='utf-8')
+
+    def _write(self, ops):
+        lines = []
+        for seq, timestamp, data in ops:
+            if timestamp is None:
+                lines.append('- %d\n' % seq)
+            else:
+                lines.append('+ %d %r %s\n' % (seq, timestamp, data))
+        self._file.write(''.join(lines))
+        self._file.flush()
+        if self._fsync:
+            os.fsync(self._file.fileno())
+
+    def _replay(self):
+        events = {}
+        with open(self._path, encoding='utf-8') as f:
+            for line in f:
+                if not line.endswith('\n'):
+                    break  # torn write from a crash
+                if line[0] == '+':
+                    _, seq, timestamp, data = line.split(' ', 3)
+                    events[int(seq)] = (float(timestamp), data[:-1])
+                elif line[0] == '-':
+                    events.pop(int(line[2:]), None)
+        return events
+
+    def load(self):
+        """
+        Stored events, earliest first.
+
+        :return: iterator of ``(seq, timestamp, data, schedule)``
+        """
+        with self._lock:
+            if self._pending:
+                self._write(self._pending)
+                self._pending = []
+            self._file.close()
+
+            events = self._replay()
+            ordered = sorted(events.items(), key=lambda item: (item[1][0], item[0]))
+
+            # rewrite the log with live events only
+            tmp = self._path + '.tmp'
+            with open(tmp, 'w', encoding='utf-8') as f:
+                f.writelines('+ %d %r %s\n' % (seq, timestamp, data)
+                             for seq, (timestamp, data) in ordered)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp, self._path)
+            self._file = open(self._path, 'a', encoding='utf-8')
+
+        for seq, (timestamp, data) in ordered:
+            yield (seq, timestamp) + _decode_event(data)
+
+    def close(self):
+        super(LogStore, self).close()
+        self._file.close()
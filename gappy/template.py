@@ -0,0 +1,50 @@
+# -*- coding: utf-8 -*-
+import string
+
+
+class Template(object):
+    """
+    A message sent to many chats, with a few words changed for each.
+
+    The payload - type, keyboards and form - is built and encoded once;
+    rendering copies it and fills in the chat and the text.
+
+    :param text: ``str.format`` pattern with named fields, e.g.
+        ``'Hello {name}, your order {order} has shipped'``
+    :param reply_keyboard: string
+    :param inline_keyboard: array or ``gappy.keyboard.InlineKeyboard``
+    :param form: json or ``gappy.keyboard.Form``
+    """
+
+    __slots__ = ('text', 'fields', '_static')
+
+    def __init__(self, text, reply_keyboard=None, inline_keyboard=None, form=None):
+        from . import _message_payload
+        fields = set()
+        for _, name, _, _ in string.Formatter().parse(text):
+            if name is None:
+                continue
+            name = name.split('.')[0].split('[')[0]
+            if not name or name.isdigit():
+                raise ValueError('Template fields must be named: %r' % text)
+            fields.add(name)
+        self.text = text
+        self.fields = frozenset(fields)
+        self._static = _message_payload(None, 'text', None, reply_keyboard, inline_keyboard, form)
+        if not fields:
+            self._static['data'] = text.format()  # still unescapes braces
+
+    def render(self, chat_id, variables=None):
+        """
+        :param variables: dict of values for the fields of the text
+        :return: dict of the ``sendMessage`` parameters
+        :raise KeyError: if a field has no value
+        """
+        p = self._static.copy()
+        p['chat_id'] = chat_id
+        if self.fields:
+            p['data'] = self.text.format_map(variables or {})
+        return p
+
+    def __repr__(self):
+        return 'Template(%r)' % self.text
@@ -0,0 +1,414 @@
+# -*- coding: utf-8 -*-
+import io
+import os
+import json
+import time
+import uuid
+import sqlite3
+import hashlib
+import threading
+import collections
+import concurrent.futures
+from . import codec, ratelimit
+
+
+class MultipartStream(object):
+    """
+    A ``multipart/form-data`` body holding a single file, produced lazily.
+
+    The file is read ``chunk_size`` bytes at a time while the body is being
+    sent, so memory use stays bounded whatever the size of the file.
+    ``file`` may be a path, a binary file object, ``bytes``, ``bytearray`` or
+    ``memoryview``; buffers are sliced without copying. A path is opened only
+    while the body is being produced and closed right after, or on ``close``.
+    File objects belong to the caller and are left open.
+
+    Iterating again starts the body over, so a failed upload may be retried
+    as long as a file object is seekable.
+
+    ``meter``, if given, is called with the size of each chunk before it is
+    sent, and may block to slow the upload down.
+    """
+
+    def __init__(self, field, file, chunk_size=65536, filename=None, meter=None):
+        self._file = file
+        self._chunk_size = chunk_size
+        self._meter = meter
+        self._body = None
+
+        boundary = uuid.uuid4().hex
+        if filename is None:
+            name = file if isinstance(file, (str, os.PathLike)) else getattr(file, 'name', None)
+            filename = os.path.basename(os.fspath(name)) if isinstance(name, (str, os.PathLike)) else field
+        self._head = ('--%s\r\n'
+                      'Content-Disposition: form-data; name="%s"; filename="%s"\r\n'
+                      'Content-Type: application/octet-stream\r\n\r\n'
+                      % (boundary, field, filename.replace('"', '%22'))).encode('utf-8')
+        self._tail = ('\r\n--%s--\r\n' % boundary).encode('ascii')
+        self.content_type = 'multipart/form-data; boundary=%s' % boundary
+
+        if isinstance(file, (bytes, bytearray, memoryview)):
+            self._view = memoryview(file).cast('B')
+            size = self._view.nbytes
+        else:
+            self._view = None
+            size = self._file_size(file)
+        self._start = file.tell() if hasattr(file, 'seekable') and file.seekable() else None
+
+        # Read by `requests` for the Content-Length header; an unknown size
+        # makes it fall back to chunked transfer encoding.
+        self.len = len(self._head) + size + len(self._tail) if size is not None else None
+
+    @staticmethod
+    def _file_size(file):
+        if isinstance(file, (str, os.PathLike)):
+            return os.path.getsize(file)
+        try:
+            if file.seekable():
+                return os.fstat(file.fileno()).st_size - file.tell()
+        except (AttributeError, OSError, io.UnsupportedOperation):
+            pass
+        try:
+            pos = file.tell()
+            end = file.seek(0, io.SEEK_END)
+            file.seek(pos)
+            return end - pos
+        except (AttributeError, OSError, io.UnsupportedOperation):
+            return None
+
+    def __iter__(self):
+        self.close()
+        self._body = self._produce() if self._meter is None else self._metered(self._produce())
+        return self._body
+
+    def _metered(self, body):
+        meter = self._meter
+        try:
+            for chunk in body:
+                meter(len(chunk))
+                yield chunk
+        finally:
+            body.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def _produce(self):
+        yield self._head
+        size = self._chunk_size
+        if self._view is not None:
+            for i in range(0, self._view.nbytes, size):
+                yield self._view[i:i + size]
+        elif isinstance(self._file, (str, os.PathLike)):
+            with open(self._file, 'rb') as f:
+                for chunk in iter(lambda: f.read(size), b''):
+                    yield chunk
+        else:
+            if self._start is not None:
+                self._file.seek(self._start)
+            for chunk in iter(lambda: self._file.read(size), b''):
+                yield chunk
+        yield self._tail
+
+    def close(self):
+        """Release the file opened for the body being produced, if any."""
+        if self._body is not None:
+            self._body.close()
+            self._body = None
+
+
+class UploadCache(object):
+    """
+    Remember the descriptors Gap returns for uploaded files.
+
+    Entries are keyed by content type and SHA-256 of the file content, so the
+    same bytes are uploaded once however they are passed in. For paths, the
+    hash is remembered by path, mtime and size, so an unchanged file is not
+    even read again.
+
+    The cache keeps up to ``maxsize`` entries in memory, evicting the least
+    recently used, and drops entries older than ``ttl`` seconds. With ``path``
+    set, entries are also kept in an SQLite file and survive restarts.
+    """
+
+    def __init__(self, maxsize=1024, ttl=86400, path=None):
+        self._maxsize = maxsize
+        self._ttl = ttl
+        self._entries = collections.OrderedDict()  # key -> (expires, descriptor)
+        self._hashes = collections.OrderedDict()   # (path, mtime, size) -> digest
+        self._lock = threading.Lock()
+        self._db = None
+        if path is not None:
+            self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+            self._db.execute('CREATE TABLE IF NOT EXISTS uploads '
+                             '(key TEXT PRIMARY KEY, expires REAL NOT NULL, descriptor TEXT NOT NULL)')
+
+    def _digest(self, file, chunk_size):
+        if isinstance(file, (bytes, bytearray, memoryview)):
+            return hashlib.sha256(file).hexdigest()
+
+        if isinstance(file, (str, os.PathLike)):
+            st = os.stat(file)
+            stamp = (os.path.realpath(file), st.st_mtime_ns, st.st_size)
+            with self._lock:
+                digest = self._hashes.get(stamp)
+                if digest is not None:
+                    self._hashes.move_to_end(stamp)
+                    return digest
+            h = hashlib.sha256()
+            with open(file, 'rb') as f:
+                for chunk in iter(lambda: f.read(chunk_size), b''):
+                    h.update(chunk)
+            digest = h.hexdigest()
+            with self._lock:
+                self._hashes[stamp] = digest
+                if len(self._hashes) > self._maxsize:
+                    self._hashes.popitem(last=False)
+            return digest
+
+        # A file object is hashed only if it can be rewound for the upload.
+        try:
+            if not file.seekable():
+                return None
+        except AttributeError:
+            return None
+        start = file.tell()
+        h = hashlib.sha256()
+        for chunk in iter(lambda: file.read(chunk_size), b''):
+            h.update(chunk)
+        file.seek(start)
+        return h.hexdigest()
+
+    def key(self, content_type, file, chunk_size=65536):
+        """
+        Cache key of a file, or ``None`` if it cannot be cached.
+
+        :param content_type: string
+        :param file: path, binary file object, bytes or memoryview
+        """
+        digest = self._digest(file, chunk_size)
+        return None if digest is None else '%s:%s' % (content_type, digest)
+
+    def get(self, key):
+        """
+        :return: the descriptor stored under ``key``, or ``None``
+        """
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                if entry[0] > now:
+                    self._entries.move_to_end(key)
+                    return dict(entry[1])
+                del self._entries[key]
+
+            if self._db is not None:
+                row = self._db.execute('SELECT expires, descriptor FROM uploads WHERE key = ?',
+                                       (key,)).fetchone()
+                if row is not None and row[0] > now:
+                    descriptor = json.loads(row[1])
+                    self._remember(key, row[0], descriptor)
+                    return dict(descriptor)
+        return None
+
+    def _remember(self, key, expires, descriptor):
+        self._entries[key] = (expires, descriptor)
+        self._entries.move_to_end(key)
+        if len(self._entries) > self._maxsize:
+            self._entries.popitem(last=False)
+
+    def put(self, key, descriptor):
+        """Store the descriptor of an uploaded file."""
+        expires = time.time() + self._ttl
+        descriptor = dict(descriptor)
+        with self._lock:
+            self._remember(key, expires, descriptor)
+            if self._db is not None:
+                self._db.execute('INSERT OR REPLACE INTO uploads VALUES (?, ?, ?)',
+                                 (key, expires, json.dumps(descriptor)))
+                self._db.execute('DELETE FROM uploads WHERE expires <= ?', (time.time(),))
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._hashes.clear()
+            if self._db is not None:
+                self._db.execute('DELETE FROM uploads')
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class UploadManager(object):
+    """
+    Upload files on a pool of threads, within a total bandwidth.
+
+    A file asked for while it is being uploaded is not sent again: the
+    request waits for the upload in flight and gets its result. Paths are
+    told apart by their real path, modification time and size, and buffers
+    by identity, the very same object; file objects are always uploaded on
+    their own. The bot's upload cache, if any, is used as by
+    ``Bot.upload_file``, from the uploading threads, so files and buffers
+    are only ever read, and hashed, there.
+
+    Once ``maxsize`` uploads are waiting for a thread, ``upload_file``
+    blocks until one starts.
+    """
+
+    # Seconds `bytes_per_second` is averaged over.
+    RATE_WINDOW = 5.0
+
+    def __init__(self, bot, workers=4, bandwidth=None, maxsize=1024):
+        """
+        :param bot: a ``gappy.Bot``
+        :param workers: number of files uploaded at once
+        :param bandwidth: bytes per second over all uploads, or ``None``
+        :param maxsize: uploads that may wait for a thread
+        """
+        self._bot = bot
+        self._cache = bot._upload_cache
+        self._bucket = ratelimit.TokenBucket(bandwidth) if bandwidth else None
+        self._slots = threading.Semaphore(workers + maxsize)
+        self._executor = concurrent.futures.ThreadPoolExecutor(workers, 'gappy-upload')
+        self._inflight = {}
+        self._samples = collections.deque()
+        self._lock = threading.Lock()
+        self._queued = 0
+        self._active = 0
+        self.uploaded = 0
+        self.failed = 0
+        self.shared = 0
+        self.cached = 0
+        self.bytes_sent = 0
+
+    @staticmethod
+    def _flight_key(content_type, file, token):
+        # Cheap enough for the caller's thread: nothing is read. The upload
+        # holds on to a buffer while it is in flight, so its id is not reused.
+        if isinstance(file, (bytes, bytearray, memoryview)):
+            return content_type, token, id(file), len(file)
+        if isinstance(file, (str, os.PathLike)):
+            st = os.stat(file)
+            return content_type, token, os.path.realpath(file), st.st_mtime_ns, st.st_size
+        return None
+
+    def upload_file(self, content_type, file, desc=None, token=None):
+        """
+        Upload a file in the background.
+
+        :param content_type: string
+        :param file: path, binary file object, bytes or memoryview
+        :param desc: string
+        :param token: bot account to upload with, as for ``Bot.upload_file``
+        :return: concurrent.futures.Future of what ``Bot.upload_file`` returns
+        :raise RuntimeError: if the manager is closed
+        """
+        key = self._flight_key(content_type, file, token)
+        with self._lock:
+            upload = self._inflight.get(key) if key is not None else None
+            start = upload is None
+            if start:
+                upload = concurrent.futures.Future()
+                if key is not None:
+                    self._inflight[key] = upload
+                self._queued += 1
+            else:
+                self.shared += 1
+
+        if start:
+            self._slots.acquire()
+            try:
+                self._executor.submit(self._run, key, content_type, file, token, upload)
+            except Exception as e:
+                with self._lock:
+                    self._queued -= 1
+                    if key is not None:
+                        del self._inflight[key]
+                self._slots.release()
+                upload.set_exception(e)  # for requests that joined it meanwhile
+                raise
+        result = concurrent.futures.Future()
+        upload.add_done_callback(lambda f: self._finish(f, result, content_type, desc))
+        return result
+
+    def _run(self, key, content_type, file, token, upload):
+        with self._lock:
+            self._queued -= 1
+            self._active += 1
+        try:
+            cached, p = None, None
+            if self._cache is not None:
+                cached = self._bot._upload_key(self._cache, content_type, file, token)
+                if cached is not None:
+                    p = self._cache.get(cached)
+            if p is not None:
+                with self._lock:
+                    self.cached += 1
+            else:
+                p = self._bot._upload(content_type, file, self._meter, token)
+                if cached is not None:
+                    self._cache.put(cached, p)
+                with self._lock:
+                    self.uploaded += 1
+        except Exception as e:
+            with self._lock:
+                self.failed += 1
+            upload.set_exception(e)
+        else:
+            upload.set_result(p)
+        finally:
+            with self._lock:
+                self._active -= 1
+                if key is not None:
+                    del self._inflight[key]
+            self._slots.release()
+
+    def _meter(self, size):
+        if self._bucket is not None:
+            self._bucket.acquire(size)
+        now = time.monotonic()
+        with self._lock:
+            self.bytes_sent += size
+            self._samples.append((now, size))
+            self._prune(now)
+
+    def _prune(self, now):
+        samples = self._samples
+        while samples and samples[0][0] <= now - self.RATE_WINDOW:
+            samples.popleft()
+
+    @staticmethod
+    def _resolve(result, content_type, desc, p):
+        p = dict(p)
+        if desc:
+            p.update({'desc': desc})
+        result.set_result((content_type, codec.dumps(p)))
+
+    def _finish(self, upload, result, content_type, desc):
+        e = upload.exception()
+        if e is not None:
+            result.set_exception(e)
+        else:
+            self._resolve(result, content_type, desc, upload.result())
+
+    def stats(self):
+        """
+        :return: dict with uploads ``queued`` for a thread and ``active``,
+            files ``uploaded`` and ``failed``, requests ``shared`` with an
+            upload in flight or served from the ``cached`` descriptors,
+            ``bytes`` sent and ``bytes_per_second`` over the last
+            ``RATE_WINDOW`` seconds
+        """
+        with self._lock:
+            self._prune(time.monotonic())
+            return dict(queued=self._queued, active=self._active,
+                        uploaded=self.uploaded, failed=self.failed,
+                        shared=self.shared, cached=self.cached, bytes=self.bytes_sent,
+                        bytes_per_second=sum(n for _, n in self._samples) / self.RATE_WINDOW)
+
+    def close(self, wait=True):
+        """Stop once the uploads queued are done, waiting for them if ``wait``."""
+        self._executor.shutdown(wait)
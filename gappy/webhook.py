@@ -0,0 +1,257 @@
+# -*- coding: utf-8 -*-
+"""
+Receive Gap updates over HTTP and handle them off the request path.
+
+``Webhook`` answers every POST with ``OK`` as soon as the update is parsed
+and queued; a pool of worker threads takes updates off the queue, a batch
+at a time, and routes each to the handler registered for its type. When the
+queue is full the endpoint answers ``503`` rather than stalling, so Gap can
+deliver the update again later.
+
+The same receiver can be mounted as a WSGI app (``webhook.wsgi_app``), an
+ASGI app (``webhook.asgi_app``) or served by the standard library
+(``webhook.serve``).
+"""
+import json
+import queue
+import threading
+import collections
+import urllib.parse
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+
+
+Update = collections.namedtuple('Update', ['type', 'chat_id', 'data', 'fields'])
+
+
+def parse_update(body, content_type=''):
+    """
+    Turn the body of a webhook call into an ``Update``.
+
+    :param body: bytes, urlencoded form or JSON
+    :param content_type: value of the Content-Type header
+    :raise ValueError: if the body is not a Gap update
+    """
+    if content_type.startswith('application/json'):
+        fields = json.loads(body.decode('utf-8'))
+        if not isinstance(fields, dict):
+            raise ValueError('Update must be a JSON object')
+    else:
+        fields = dict(urllib.parse.parse_qsl(body.decode('utf-8'), keep_blank_values=True))
+    if 'type' not in fields or 'chat_id' not in fields:
+        raise ValueError('Update needs a type and a chat_id')
+    return Update(fields['type'], fields['chat_id'], fields.get('data'), fields)
+
+
+class Webhook(object):
+    """
+    :param workers: number of threads running handlers
+    :param maxsize: updates allowed to wait for a worker
+    :param batch: updates a worker takes off the queue at once
+    :param executor: a ``gappy.process.ProcessExecutor``, or any object with
+        its ``submit(key, fn, *args)``, to run handlers in, partitioned by
+        ``chat_id``; the worker threads then only hand updates over
+    """
+
+    def __init__(self, workers=4, maxsize=10000, batch=32, executor=None):
+        self._queue = queue.Queue(maxsize)
+        self._batch = batch
+        self._executor = executor
+        self._handlers = {}
+        self._default = None
+        self._lock = threading.Lock()
+        self.received = 0
+        self.dropped = 0
+        self.handled = 0
+        self.failed = 0
+        self._threads = []
+        for i in range(workers):
+            th = threading.Thread(target=self._work, name='gappy-webhook-%d' % i)
+            th.daemon = True
+            th.start()
+            self._threads.append(th)
+
+    def on(self, type=None):
+        """
+        Decorator registering a handler for one message type.
+
+        Without a type, the handler gets every update no other handler takes.
+
+        :param type: text, image, triggerButton, join, leave, ...
+        """
+        def register(fn):
+            if type is None:
+                self._default = fn
+            else:
+                self._handlers[type] = fn
+            return fn
+        return register
+
+    def feed(self, body, content_type=''):
+        """
+        Parse a webhook body and queue the update.
+
+        :return: ``False`` if the queue is full and the update was dropped
+        :raise ValueError: if the body is not a Gap update
+        """
+        update = parse_update(body, content_type)
+        try:
+            self._queue.put_nowait(update)
+        except queue.Full:
+            with self._lock:
+                self.dropped += 1
+            return False
+        with self._lock:
+            self.received += 1
+        return True
+
+    def _work(self):
+        while 1:
+            updates = [self._queue.get()]
+            try:
+                while len(updates) < self._batch:
+                    updates.append(self._queue.get_nowait())
+            except queue.Empty:
+                pass
+
+            handled = failed = 0
+            stop = False
+            for update in updates:
+                if update is None:
+                    if stop:
+                        self._queue.put(None)  # leave it for another worker
+                    stop = True
+                    continue
+                fn = self._handlers.get(update.type, self._default)
+                if fn is None:
+                    continue
+                try:
+                    if self._executor is not None:
+                        self._executor.submit(update.chat_id, fn, update).add_done_callback(self._done)
+                        continue
+                    fn(update)
+                    handled += 1
+                except Exception:
+                    failed += 1
+            with self._lock:
+                self.handled += handled
+                self.failed += failed
+            if stop:
+                return
+
+    def _done(self, future):
+        with self._lock:
+            if future.exception() is None:
+                self.handled += 1
+            else:
+                self.failed += 1
+
+    def _respond(self, body, content_type):
+        try:
+            queued = self.feed(body, content_type)
+        except (ValueError, UnicodeDecodeError):
+            return 400, b'Bad Request'
+        return (200, b'OK') if queued else (503, b'Busy')
+
+    def wsgi_app(self, environ, start_response):
+        """WSGI application accepting webhook calls at any path."""
+        if environ['REQUEST_METHOD'] != 'POST':
+            start_response('405 Method Not Allowed', [('Content-Type', 'text/plain')])
+            return [b'Method Not Allowed']
+        try:
+            length = int(environ.get('CONTENT_LENGTH') or 0)
+        except ValueError:
+            length = 0
+        body = environ['wsgi.input'].read(length)
+        status, text = self._respond(body, environ.get('CONTENT_TYPE', ''))
+        start_response('%d %s' % (status, text.decode('ascii')),
+                       [('Content-Type', 'text/plain'), ('Content-Length', str(len(text)))])
+        return [text]
+
+    async def asgi_app(self, scope, receive, send):
+        """ASGI application accepting webhook calls at any path."""
+        if scope['type'] == 'lifespan':
+            while 1:
+                message = await receive()
+                if message['type'] == 'lifespan.startup':
+                    await send({'type': 'lifespan.startup.complete'})
+                elif message['type'] == 'lifespan.shutdown':
+                    await send({'type': 'lifespan.shutdown.complete'})
+                    return
+
+        if scope['method'] != 'POST':
+            status, text = 405, b'Method Not Allowed'
+        else:
+            chunks = []
+            more = True
+            while more:
+                message = await receive()
+                chunks.append(message.get('body', b''))
+                more = message.get('more_body', False)
+            headers = dict(scope.get('headers', []))
+            content_type = headers.get(b'content-type', b'').decode('latin-1')
+            status, text = self._respond(b''.join(chunks), content_type)
+
+        await send({'type': 'http.response.start', 'status': status,
+                    'headers': [(b'content-type', b'text/plain'),
+                                (b'content-length', str(len(text)).encode('ascii'))]})
+        await send({'type': 'http.response.body', 'body': text})
+
+    def serve(self, host='', port=8080):
+        """
+        Serve webhook calls with the standard library until interrupted.
+
+        Prefer a real WSGI or ASGI server in production.
+        """
+        server = self.make_server(host, port)
+        try:
+            server.serve_forever()
+        finally:
+            server.server_close()
+
+    def make_server(self, host='', port=8080):
+        """
+        :return: a threading ``http.server.HTTPServer``, not yet serving
+        """
+        webhook = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+            disable_nagle_algorithm = True
+
+            def log_message(self, format, *args):
+                pass
+
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+                status, text = webhook._respond(body, self.headers.get('Content-Type', ''))
+                self.send_response(status)
+                self.send_header('Content-Type', 'text/plain')
+                self.send_header('Content-Length', str(len(text)))
+                self.end_headers()
+                self.wfile.write(text)
+
+        class Server(ThreadingMixIn, HTTPServer):
+            daemon_threads = True
+
+        return Server((host, port), Handler)
+
+    def depth(self):
+        """Number of updates waiting for a worker."""
+        return self._queue.qsize()
+
+    def stats(self):
+        """
+        :return: dict with ``received``, ``dropped``, ``handled``, ``failed``
+            and current queue ``depth``
+        """
+        with self._lock:
+            return dict(received=self.received, dropped=self.dropped,
+                        handled=self.handled, failed=self.failed, depth=self.depth())
+
+    def close(self):
+        """Stop the workers once the queued updates are handled."""
+        for _ in self._threads:
+            self._queue.put(None)
+        for th in self._threads:
+            th.join()
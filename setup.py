@@ -6,6 +6,10 @@ here = path.abspath(path.dirname(__file__))
 
 install_requires = ['requests>=2.18']
 
+extras_require = {
+    'async': ['aiohttp>=3.3'],
+}
+
 # Parse version
 with open(path.join(here, 'gappy', '__init__.py')) as f:
     m = re.search(
@@ -22,7 +26,9 @@ setup(
     project_urls={
         "Source Code": "https://github.com/GapAPy/Gappy/",
     },
+    python_requires='>=3.7',
     install_requires=install_requires,
+    extras_require=extras_require,
     packages=find_packages(),
     version=version,
 
@@ -31,7 +37,7 @@ setup(
 ```
 pip3 install gappy
 ```
-compatible python version: 3.4+
+compatible python version: 3.7+
 
 ### How to use
 
@@ -79,9 +85,13 @@ if __name__ == '__main__':
 
         'License :: OSI Approved :: GNU General Public License (GPL)',
 
-        'Programming Language :: Python :: 3.4',
-        'Programming Language :: Python :: 3.5',
-        'Programming Language :: Python :: 3.6',
+        'Programming Language :: Python :: 3 :: Only',
+        'Programming Language :: Python :: 3.7',
+        'Programming Language :: Python :: 3.8',
+        'Programming Language :: Python :: 3.9',
+        'Programming Language :: Python :: 3.10',
+        'Programming Language :: Python :: 3.11',
+        'Programming Language :: Python :: 3.12',
     ],
     keywords='gap messenger bot api python wrapper',
 )
@@ -0,0 +1,293 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Benchmarks of gappy's hot paths, run against a local fake Gap server.
+
+    python test/benchmark.py [--quick] [--output results.json] [--compare old.json]
+
+Results are printed, and written as JSON with ``--output``, so runs on
+different commits can be compared with ``--compare``.
+"""
+import os
+import sys
+import gc
+import json
+import time
+import argparse
+import platform
+import tempfile
+import threading
+import subprocess
+import tracemalloc
+import multiprocessing
+
+import requests
+
+import gappy
+import gappy.codec
+import gappy.keyboard
+import gappy.template
+import fakegap
+
+
+def _serve(conn):
+    gap = fakegap.FakeGap(record=False)
+    gap.start()
+    conn.send(gap.url)
+    conn.recv()  # until told to stop
+    gap.stop()
+
+
+class _Server(object):
+    """The fake server, in its own process so that it does not share our GIL."""
+
+    def __enter__(self):
+        self._conn, child = multiprocessing.Pipe()
+        self._process = multiprocessing.Process(target=_serve, args=(child,), daemon=True)
+        self._process.start()
+        self.url = self._conn.recv()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self._conn.send(None)
+        self._process.join(5)
+
+
+def _percentile(samples, q):
+    samples = sorted(samples)
+    return samples[min(len(samples) - 1, int(q * len(samples)))]
+
+
+def _latency_stats(samples, elapsed):
+    return dict(n=len(samples), rps=len(samples) / elapsed,
+                p50_ms=_percentile(samples, 0.5) * 1e3,
+                p99_ms=_percentile(samples, 0.99) * 1e3)
+
+
+def bench_send_text(url, n):
+    bot = gappy.Bot('TOKEN', base_url=url, pool_size=16)
+    bot.send_text(0, 'warm up')
+    samples = []
+    start = time.perf_counter()
+    for i in range(n):
+        t = time.perf_counter()
+        bot.send_text(i, 'hello')
+        samples.append(time.perf_counter() - t)
+    serial = _latency_stats(samples, time.perf_counter() - start)
+
+    b = bot.broadcast(range(n), 'text', 'hello', workers=16)
+    b.run()
+    bot.close()
+    return {'send_text.serial': serial,
+            'send_text.broadcast16': dict(n=n, rps=b.rate)}
+
+
+def _timed_batches(fn, n, batch=100):
+    samples = []
+    start = time.perf_counter()
+    for _ in range(n // batch):
+        t = time.perf_counter()
+        for _ in range(batch):
+            fn()
+        samples.append((time.perf_counter() - t) / batch)
+    elapsed = time.perf_counter() - start
+    return dict(n=n, ops=n / elapsed,
+                p50_us=_percentile(samples, 0.5) * 1e6,
+                p99_us=_percentile(samples, 0.99) * 1e6)
+
+
+def bench_payload(n):
+    keyboard = [[{'text': 'Yes', 'cb_data': 'yes'}, {'text': 'No', 'cb_data': 'no'}]]
+    form = [{'name': 'email', 'type': 'text', 'label': 'Email'}]
+    inline = gappy.keyboard.InlineKeyboard(keyboard)
+    prebuilt_form = gappy.keyboard.Form(form)
+    params = dict(chat_id=1, type='text', data='hello', reply_keyboard=None,
+                  inline_keyboard=keyboard, form=form)
+    return {
+        'payload.rectify': _timed_batches(lambda: gappy._rectify(params), n),
+        'payload.encoder': _timed_batches(
+            lambda: gappy._message_payload(1, 'text', 'hello', None, keyboard, form), n),
+        'payload.encoder_prebuilt': _timed_batches(
+            lambda: gappy._message_payload(1, 'text', 'hello', None, inline, prebuilt_form), n),
+        'payload.encoder_fresh_keyboard': _timed_batches(
+            lambda: gappy._message_payload(1, 'text', 'hello', None, [[{'text': 'Yes', 'cb_data': 'yes'}]], None), n),
+    }
+
+
+def bench_template(n):
+    """Build the payloads of a personalized broadcast, per call and from a template."""
+    keyboard = gappy.keyboard.InlineKeyboard([[{'text': 'Track', 'cb_data': 'track'}]])
+    form = [{'name': 'rating', 'type': 'text', 'label': 'Rate us'}]
+    tpl = gappy.template.Template('Hello {name}, your order {order} has shipped',
+                                  inline_keyboard=keyboard, form=form)
+    variables = {'name': 'Sara', 'order': 1234}
+    compose = gappy.api._compose_fields
+
+    def per_call():
+        text = 'Hello %s, your order %s has shipped' % (variables['name'], variables['order'])
+        p = gappy._rectify(dict(chat_id=1, type='text', data=text, reply_keyboard=None,
+                                inline_keyboard=[[{'text': 'Track', 'cb_data': 'track'}]], form=form))
+        compose(('TOKEN', 'sendMessage', p))
+
+    def templated():
+        compose(('TOKEN', 'sendMessage', tpl.render(1, variables)))
+
+    return {'template.per_call': _timed_batches(per_call, n),
+            'template.render': _timed_batches(templated, n)}
+
+
+def _response(body):
+    r = requests.Response()
+    r.status_code = 200
+    r.headers['Content-Type'] = 'application/json'
+    r._content = body
+    return r
+
+
+def bench_parse(n):
+    """Parse a send result and the JSON document inside, as ``send_location`` does."""
+    body = json.dumps(json.dumps({'id': 123456789, 'type': 'location', 'data': 'x' * 200})).encode('utf-8')
+
+    def before():
+        # what `api._parse` and `send_location` did before `gappy.codec`
+        json.loads(json.loads(_response(body).text))['id']
+
+    results = {'parse.text_json': _timed_batches(before, n)}
+    backend = gappy.codec.backend
+    for name in ('json', 'ujson', 'orjson'):
+        try:
+            gappy.codec.use(name)
+        except ImportError:
+            continue
+        results['parse.%s' % name] = _timed_batches(
+            lambda: gappy._decoded(gappy.api._parse(_response(body)))['id'], n)
+    gappy.codec.use(backend)
+    return results
+
+
+def bench_scheduler(sizes):
+    results = {}
+    for n in sizes:
+        s = gappy.Bot.Scheduler()
+        now = time.time()
+        gc.collect()
+
+        start = time.perf_counter()
+        events = [s.event_at(now + 3600 + (i * 7919) % n, {'chat_id': i}) for i in range(n)]
+        insert = time.perf_counter() - start
+
+        start = time.perf_counter()
+        for ev in events[::2]:
+            s.cancel(ev)
+        cancel = time.perf_counter() - start
+
+        # move what is left into the past and let the scheduler fire it
+        s = gappy.Bot.Scheduler()
+        for i in range(n):
+            s.event_at(now - 1, i)
+        done = threading.Event()
+        fired = [0]
+
+        def handler(d):
+            fired[0] += 1
+            if fired[0] == n:
+                done.set()
+
+        s.on_event(handler)
+        start = time.perf_counter()
+        s.run_as_thread()
+        done.wait()
+        fire = time.perf_counter() - start
+
+        results['scheduler.%d' % n] = dict(
+            n=n,
+            insert_per_s=n / insert,
+            cancel_per_s=(n // 2 + n % 2) / cancel,
+            fire_per_s=n / fire)
+        del events, s
+    return results
+
+
+def bench_upload(url, size):
+    path = os.path.join(tempfile.mkdtemp(), 'upload.bin')
+    block = os.urandom(1 << 20)
+    with open(path, 'wb') as f:
+        for _ in range(size >> 20):
+            f.write(block)
+
+    bot = gappy.Bot('TOKEN', base_url=url)
+    start = time.perf_counter()
+    bot.upload_file('file', path)
+    elapsed = time.perf_counter() - start
+
+    tracemalloc.start()
+    bot.upload_file('file', path)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    os.remove(path)
+    bot.close()
+    return {'upload_file': dict(bytes=size, mb_per_s=size / elapsed / 1e6, peak_alloc_bytes=peak)}
+
+
+def _commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'],
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def _compare(old, new):
+    # Metrics where smaller is better; all others are rates.
+    lower = ('p50_ms', 'p99_ms', 'p50_us', 'p99_us', 'peak_alloc_bytes')
+    for name, result in sorted(new['results'].items()):
+        before = old['results'].get(name)
+        if before is None:
+            continue
+        for metric, value in sorted(result.items()):
+            if metric in ('n', 'bytes') or not before.get(metric):
+                continue
+            ratio = value / before[metric]
+            better = ratio < 1 if metric in lower else ratio > 1
+            print('%-40s %-18s %12.2f -> %12.2f  %+6.1f%% %s'
+                  % (name, metric, before[metric], value, (ratio - 1) * 100,
+                     '' if abs(ratio - 1) < 0.05 else ('better' if better else 'WORSE')))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--quick', action='store_true', help='smaller sizes, for a smoke run')
+    parser.add_argument('--output', '-o', help='write results as JSON to this file')
+    parser.add_argument('--compare', help='JSON results of an earlier run to compare with')
+    args = parser.parse_args(argv)
+
+    sends = 300 if args.quick else 3000
+    payloads = 10000 if args.quick else 200000
+    renders = 100000 if args.quick else 1000000
+    sizes = (10 ** 3, 10 ** 4) if args.quick else (10 ** 3, 10 ** 4, 10 ** 5, 10 ** 6)
+    upload_size = (16 if args.quick else 256) << 20
+
+    results = {}
+    results.update(bench_payload(payloads))
+    results.update(bench_parse(payloads))
+    results.update(bench_template(renders))
+    results.update(bench_scheduler(sizes))
+    with _Server() as server:
+        results.update(bench_send_text(server.url, sends))
+        results.update(bench_upload(server.url, upload_size))
+
+    report = dict(commit=_commit(), python=platform.python_version(),
+                  platform=platform.platform(), time=time.time(), results=results)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+    if args.compare:
+        with open(args.compare) as f:
+            _compare(json.load(f), report)
+    else:
+        json.dump(report, sys.stdout, indent=2, sort_keys=True)
+        print()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,126 @@
+# -*- coding: utf-8 -*-
+"""An in-process stand-in for api.gap.im, used by the tests and benchmarks."""
+import json
+import threading
+import itertools
+import urllib.parse
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+
+
+class _Server(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+    request_queue_size = 1024
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        pass
+
+    def setup(self):
+        BaseHTTPRequestHandler.setup(self)
+        self.server.gap.connected(self.client_address)
+
+    def _read_body(self):
+        if self.headers.get('Transfer-Encoding', '').lower() == 'chunked':
+            parts = []
+            while True:
+                size = int(self.rfile.readline().strip(), 16)
+                if size == 0:
+                    self.rfile.readline()
+                    break
+                parts.append(self.rfile.read(size))
+                self.rfile.readline()
+            return b''.join(parts)
+        return self.rfile.read(int(self.headers.get('Content-Length', 0)))
+
+    def do_POST(self):
+        gap = self.server.gap
+        method = self.path.strip('/')
+        body = self._read_body()
+        if self.headers.get('Content-Type', '').startswith('application/x-www-form-urlencoded'):
+            fields = dict(urllib.parse.parse_qsl(body.decode('utf-8')))
+        else:
+            fields = {}
+        gap.record(method, self.headers, fields, body)
+
+        status, payload, headers = gap.respond(method, fields)
+        # bytes are sent as they are, e.g. to fake an error page
+        data = payload if isinstance(payload, bytes) else json.dumps(payload).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        for k, v in headers.items():
+            self.send_header(k, v)
+        self.end_headers()
+        self.wfile.write(data)
+
+
+class FakeGap(object):
+    """
+    A threaded HTTP server speaking enough of the Gap Bot API for tests.
+
+    Every call is recorded in ``calls`` as ``(method, headers, fields, body)``,
+    and the address of every client connection in ``connections``.
+    Responses may be scripted per method with ``script(method, fn)``, where
+    ``fn(fields)`` returns ``(status, payload, headers)``; a ``bytes`` payload
+    is sent as the raw body.
+    """
+
+    def __init__(self, record=True):
+        self._server = _Server(('127.0.0.1', 0), _Handler)
+        self._server.gap = self
+        self._ids = itertools.count(1)
+        self._lock = threading.Lock()
+        self._scripts = {}
+        self._record = record
+        self.calls = []
+        self.connections = []
+        self.url = 'http://127.0.0.1:%d' % self._server.server_address[1]
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+
+    def start(self):
+        t = threading.Thread(target=self._server.serve_forever, daemon=True)
+        t.start()
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def script(self, method, fn):
+        self._scripts[method] = fn
+
+    def connected(self, address):
+        with self._lock:
+            self.connections.append(address)
+
+    def record(self, method, headers, fields, body):
+        if self._record:
+            with self._lock:
+                self.calls.append((method, dict(headers), fields, body))
+
+    def respond(self, method, fields):
+        if method in self._scripts:
+            return self._scripts[method](fields)
+        id = next(self._ids)
+        if method == 'upload':
+            return 200, {'SID': 'sid-%d' % id, 'type': 'file'}, {}
+        if method in ('location', 'contact', 'invoice'):
+            # Gap returns these bodies as JSON-encoded strings.
+            return 200, json.dumps({'id': id}), {}
+        if method in ('payVerify', 'payInquiry'):
+            return 200, json.dumps({'status': 'verified'}), {}
+        return 200, {'id': id}, {}
+
+    def methods(self):
+        with self._lock:
+            return [c[0] for c in self.calls]
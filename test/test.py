@@ -1,3 +1,984 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
+import os
+import sys
+import time
+import json
+import sqlite3
+import tempfile
+import subprocess
+import asyncio
+import datetime
+import threading
 import gappy
+import gappy.codec
+import gappy.history
+import gappy.template
+import gappy.keyboard
+import gappy.schedule
+import gappy.process
+import gappy.ratelimit
+import gappy.store
+import gappy.upload
+import gappy.webhook
+from gappy.aio import AsyncBot
+import fakegap
+
+
+def test_async_bot():
+    with fakegap.FakeGap() as gap:
+        async def main():
+            async with AsyncBot('TOKEN', base_url=gap.url) as bot:
+                sent = await asyncio.gather(*[bot.send_text(i, 'hello %d' % i) for i in range(50)])
+                edited = await bot.edit_message(1, sent[0]['id'], 'bye')
+                location = await bot.send_location(2, 35.7, 51.4)
+            return sent, edited, location
+
+        sent, edited, location = asyncio.run(main())
+
+    assert len({m['id'] for m in sent}) == 50
+    assert 'id' in edited
+    assert isinstance(location, int)
+    methods = gap.methods()
+    assert methods.count('sendMessage') == 50
+    assert gap.calls[0][1]['token'] == 'TOKEN'
+    assert gap.calls[-1][2]['type'] == 'location'
+
+
+def test_connection_reuse():
+    with fakegap.FakeGap() as gap:
+        bot = gappy.Bot('TOKEN', base_url=gap.url, pool_size=4)
+        for n in range(20):
+            bot.send_text(n, 'hi')
+        sequential = len(gap.connections)
+
+        def send(chat):
+            for _ in range(25):
+                bot.send_text(chat, 'hi')
+        threads = [threading.Thread(target=send, args=(chat,)) for chat in range(4)]
+        for th in threads:
+            th.start()
+        for th in threads:
+            th.join()
+        bot.close()
+
+    assert len(gap.calls) == 120
+    assert sequential == 1
+    assert len(gap.connections) <= 4, gap.connections
+
+
+def test_scheduler():
+    fired = []
+    done = threading.Event()
+    s = gappy.Bot.Scheduler()
+    s.on_event(lambda d: (fired.append((d, time.time())), d == 'last' and done.set()))
+
+    now = time.time()
+    s.event_later(0.2, 'last')
+    cancelled = s.event_later(0.05, 'cancelled')
+    s.event_later(0.1, 'second')
+    s.event_at(now, 'first')
+    s.cancel(cancelled)
+    try:
+        s.cancel(cancelled)
+    except gappy.exception.EventNotFound:
+        pass
+    else:
+        raise AssertionError('cancelled twice')
+
+    s.run_as_thread()
+    assert done.wait(2)
+    assert [d for d, _ in fired] == ['first', 'second', 'last']
+    # woken at the deadline rather than on a polling tick
+    assert fired[-1][1] - (now + 0.2) < 0.05
+
+
+def test_scheduler_workers():
+    handled = []
+    lock = threading.Lock()
+
+    def handler(d):
+        if d['chat_id'] == 'slow':
+            time.sleep(0.3)
+        with lock:
+            handled.append((d['chat_id'], d['n'], time.time()))
+
+    s = gappy.Bot.Scheduler(workers=4)
+    s.on_event(handler)
+    # chats that do not share a worker with the slow one
+    slow = s._executor._partition('slow')
+    chats = [c for c in range(100) if s._executor._partition(c) != slow][:3]
+
+    start = time.time()
+    s.event_now({'chat_id': 'slow', 'n': 0})
+    for n in range(21):
+        s.event_now({'chat_id': chats[n % 3], 'n': n})
+    s.run_as_thread()
+
+    deadline = time.time() + 2
+    while len(handled) < 22 and time.time() < deadline:
+        time.sleep(0.01)
+    assert len(handled) == 22
+    for i, chat in enumerate(chats):
+        assert [n for c, n, _ in handled if c == chat] == list(range(i, 21, 3))
+    # the slow handler does not hold back other chats
+    assert max(ts for c, _, ts in handled if c != 'slow') - start < 0.2
+    assert s.stats()['workers']['completed'] == 22
+
+    # a callable's data goes to the worker of its chat, after earlier events
+    handled[:] = []
+    s.event_now({'chat_id': 'slow', 'n': 0})
+    s.event_now(lambda: {'chat_id': 'slow', 'n': 1})
+    deadline = time.time() + 2
+    while len(handled) < 2 and time.time() < deadline:
+        time.sleep(0.01)
+    assert [n for _, n, _ in handled] == [0, 1]
+
+
+def remind():
+    return {'chat_id': 1, 'data': 'reminder'}
+
+
+def test_scheduler_store():
+    for store_class in (gappy.store.SQLiteStore, gappy.store.LogStore):
+        path = os.path.join(tempfile.mkdtemp(), 'events')
+        s = gappy.Bot.Scheduler(store=store_class(path, batch_size=10))
+        now = time.time()
+        for n in range(25):
+            s.event_at(now + 100 + n, {'chat_id': n})
+        s.cancel(s.event_at(now + 50, {'chat_id': 'cancelled'}))
+        s.event_at(now + 200, remind)
+        try:
+            s.event_at(now, lambda: None)
+        except ValueError:
+            pass
+        else:
+            raise AssertionError('lambda stored')
+        s.flush()
+
+        s = gappy.Bot.Scheduler(store=store_class(path))
+        events = [s._pop() for _ in range(26)]
+        assert [e.data['chat_id'] for e in events[:25]] == list(range(25))
+        assert events[-1].data is remind
+        assert not s._eventq
+        assert s.event_now({}) is not None
+
+
+def test_scheduler_recurring():
+    s = gappy.Bot.Scheduler()
+    fired = []
+    s.on_event(lambda data: fired.append(time.time()))
+    start = time.time() + 0.05
+    ev = s.event_every(0.05, {'chat_id': 1}, start=start)
+    s.run_as_thread()
+    time.sleep(0.5)
+    s.cancel(ev)
+    n = len(fired)
+    time.sleep(0.1)
+    assert len(fired) == n >= 8
+    # each occurrence is due at start + k * interval, whatever handling costs
+    assert all(0 <= at - (start + k * 0.05) < 0.03 for k, at in enumerate(fired))
+    assert not s._entries
+
+    # missed occurrences are skipped, not fired in a burst
+    every = gappy.schedule.Every(60)
+    assert every.next(1000, now=1010) == 1060
+    assert every.next(1000, now=1000 + 60 * 10 + 1) == 1000 + 60 * 11
+
+    def at(*args):
+        return time.mktime(datetime.datetime(*args).timetuple())
+    cron = gappy.schedule.Cron('*/15 9-17 * * mon-fri')
+    assert cron.next(at(2024, 3, 1, 9, 0), 0) == at(2024, 3, 1, 9, 15)  # a Friday
+    assert cron.next(at(2024, 3, 1, 17, 45), 0) == at(2024, 3, 4, 9, 0)
+    assert gappy.schedule.Cron('0 0 29 feb *').next(at(2024, 3, 1), 0) == at(2028, 2, 29)
+    assert gappy.schedule.Cron('30 8 1 * sun').next(at(2024, 3, 1, 9), 0) == at(2024, 3, 3, 8, 30)
+    assert gappy.schedule.parse(cron.spec).spec == cron.spec
+
+    # the hour repeated when clocks go back is walked through, not before
+    tz = os.environ.get('TZ')
+    os.environ['TZ'] = 'America/New_York'
+    time.tzset()
+    try:
+        start = datetime.datetime(2024, 11, 3, 5, 0, tzinfo=datetime.timezone.utc).timestamp()
+        every_minute = gappy.schedule.Cron('* * * * *')
+        for now in range(int(start), int(start) + 3 * 3600, 300):
+            assert every_minute.next(now, now) == now + 60
+        assert gappy.schedule.Cron('30 1 * * *').next(start + 2400, 0) == start + 5400  # 1:30 EST
+    finally:
+        if tz is None:
+            del os.environ['TZ']
+        else:
+            os.environ['TZ'] = tz
+        time.tzset()
+    for bad in ('* * *', '60 * * * *', '0 0 30 feb *'):
+        try:
+            gappy.schedule.Cron(bad).next(at(2024, 1, 1), 0)
+        except ValueError:
+            pass
+        else:
+            raise AssertionError(bad)
+
+    path = os.path.join(tempfile.mkdtemp(), 'events')
+    s = gappy.Bot.Scheduler(store=gappy.store.SQLiteStore(path))
+    s.event_every(3600, {'chat_id': 1}, start=time.time() - 1)
+    s.event_cron('0 9 * * *', remind)
+    s._pop()
+    s.flush()
+    s = gappy.Bot.Scheduler(store=gappy.store.SQLiteStore(path))
+    assert len(s._eventq) == 2
+    assert s._eventq[0][0] > time.time() + 3000 or s._eventq[0][2].data is remind
+    assert sorted(e[3].spec for e in s._eventq) == ['cron 0 9 * * *', 'every 3600']
+
+
+def test_upload_file():
+    content = os.urandom(300000)
+    path = os.path.join(tempfile.mkdtemp(), 'banner.png')
+    with open(path, 'wb') as f:
+        f.write(content)
+
+    with fakegap.FakeGap() as gap:
+        bot = gappy.Bot('TOKEN', base_url=gap.url)
+        bot._file_chunk_size = 4096
+        with open(path, 'rb') as f:
+            for file in (path, content, memoryview(content), f):
+                type, data = bot.upload_file('image', file, 'desc')
+                assert type == 'image'
+                assert json.loads(data)['desc'] == 'desc'
+            assert not f.closed
+
+        bot.send_image(1, path)
+
+    uploads = [c for c in gap.calls if c[0] == 'upload']
+    assert len(uploads) == 5
+    for _, headers, _, body in uploads:
+        assert int(headers['Content-Length']) == len(body)
+        assert content in body
+    assert b'filename="banner.png"' in uploads[0][3]
+
+
+def test_upload_cache():
+    tmp = tempfile.mkdtemp()
+    path = os.path.join(tmp, 'banner.png')
+    with open(path, 'wb') as f:
+        f.write(b'banner')
+
+    with fakegap.FakeGap() as gap:
+        bot = gappy.Bot('TOKEN', base_url=gap.url,
+                        upload_cache=gappy.upload.UploadCache(path=os.path.join(tmp, 'cache')))
+        first = bot.send_image(1, path, 'one')
+        bot.send_image(2, path, 'two')
+        bot.upload_file('image', b'banner')
+        bot.upload_file('file', b'banner')
+
+        with open(path, 'wb') as f:
+            f.write(b'new banner')
+        os.utime(path, (0, 0))
+        bot.send_image(3, path)
+
+        # the on-disk tier outlives the bot
+        bot = gappy.Bot('TOKEN', base_url=gap.url,
+                        upload_cache=gappy.upload.UploadCache(path=os.path.join(tmp, 'cache')))
+        bot.upload_file('image', b'banner')
+
+    assert 'id' in first
+    assert gap.methods().count('upload') == 3
+    sent = [json.loads(c[2]['data']) for c in gap.calls if c[0] == 'sendMessage']
+    assert [d.get('desc') for d in sent] == ['one', 'two', None]
+    assert sent[0]['SID'] == sent[1]['SID'] != sent[2]['SID']
+
+
+def test_upload_manager():
+    ids = iter(range(100))
+
+    def slow(fields):
+        time.sleep(0.2)
+        return 200, {'SID': 'sid-%d' % next(ids)}, {}
+
+    with fakegap.FakeGap() as gap:
+        gap.script('upload', slow)
+        bot = gappy.Bot('TOKEN', base_url=gap.url, pool_size=8)
+        uploader = bot.uploader(workers=4)
+        logo = os.urandom(1000)  # buffers are matched by identity, not hashed
+        same = [uploader.upload_file('image', logo, 'n%d' % n) for n in range(8)]
+        others = [uploader.upload_file('image', b'photo %d' % n) for n in range(3)]
+        results = [f.result(5) for f in same]
+        [f.result(5) for f in others]
+        stats = uploader.stats()
+
+        # paths are matched by their stat, without being read by the caller
+        path = os.path.join(tempfile.mkdtemp(), 'video.mp4')
+        with open(path, 'wb') as f:
+            f.write(b'video')
+        videos = [uploader.upload_file('video', path) for _ in range(3)]
+        assert len({f.result(5)[1] for f in videos}) == 1
+
+        gap.script('upload', lambda fields: (500, {}, {}))
+        failed = uploader.upload_file('image', b'broken')
+        try:
+            failed.result(5)
+        except ValueError:
+            pass
+        else:
+            raise AssertionError('failed upload succeeded')
+
+        limited = bot.uploader(bandwidth=200000)
+        gap.script('upload', lambda fields: (200, {'SID': 'big'}, {}))
+        start = time.monotonic()
+        limited.upload_file('file', b'x' * 300000).result(5)
+        elapsed = time.monotonic() - start
+        uploader.close()
+        limited.close()
+        try:
+            uploader.upload_file('image', b'late')
+        except RuntimeError:
+            pass
+        else:
+            raise AssertionError('closed uploader took a file')
+        assert not uploader._inflight and uploader.stats()['queued'] == 0
+
+    assert gap.methods().count('upload') == 7
+    descriptors = [json.loads(r[1]) for r in results]
+    assert len({d['SID'] for d in descriptors}) == 1
+    assert [d['desc'] for d in descriptors] == ['n%d' % n for n in range(8)]
+    assert stats['uploaded'] == 4 and stats['shared'] == 7 and stats['queued'] == stats['active'] == 0
+    assert stats['bytes'] > 0 and stats['bytes_per_second'] > 0
+    assert uploader.stats()['failed'] == 1 and uploader.stats()['shared'] == 9
+    assert elapsed > 0.4, elapsed
+
+
+def test_broadcast():
+    with fakegap.FakeGap() as gap:
+        gap.script('sendMessage', lambda fields: (
+            (400, {'error': 'blocked'}, {}) if fields['chat_id'] == '13'
+            else (200, {'id': int(fields['chat_id']) * 10}, {})))
+        bot = gappy.Bot('TOKEN', base_url=gap.url, pool_size=4)
+        b = bot.broadcast(iter(range(40)), 'text', 'news', inline_keyboard=[[{'text': 'ok'}]], workers=4)
+        results = {r.chat_id: r for r in b}
+
+        location = bot.broadcast([1, 2], 'location', {'lat': 1.5, 'long': 2.5}).run()
+
+    assert len(results) == 40
+    assert results[7].ok and results[7].message_id == 70
+    assert not results[13].ok and results[13].error.description == 'blocked'
+    assert b.stats()['succeeded'] == 39 and b.failed == 1
+    assert all(r.ok and r.message_id for r in location)
+    fields = [c[2] for c in gap.calls if c[0] == 'sendMessage']
+    assert all(f['data'] == 'news' and f['inline_keyboard'] == '[[{"text":"ok"}]]' for f in fields)
+    assert json.loads(gap.calls[-1][2]['data']) == {'lat': 1.5, 'long': 2.5}
+
+
+def test_rate_limit_and_retry():
+    from gappy.ratelimit import RateLimiter, RetryPolicy
+
+    failures = {'1': [(429, {'error': 'slow down'}, {'Retry-After': '0'}),
+                      (502, {'error': 'bad gateway'}, {})]}
+
+    def send_message(fields):
+        queued = failures.get(fields['chat_id'])
+        return queued.pop(0) if queued else (200, {'id': 1}, {})
+
+    with fakegap.FakeGap() as gap:
+        gap.script('sendMessage', send_message)
+        bot = gappy.Bot('TOKEN', base_url=gap.url,
+                        limiter=RateLimiter(per_chat_rate=20, per_chat_burst=1),
+                        retry=RetryPolicy(retries=2, backoff=0.01))
+        assert bot.send_text(1, 'hi') == {'id': 1}
+        assert len(gap.calls) == 3
+
+        start = time.time()
+        for _ in range(5):
+            bot.send_text(2, 'hi')
+        assert time.time() - start >= 0.19
+
+        failures['3'] = [(503, {'error': 'unavailable'}, {})] * 3
+        try:
+            bot.send_text(3, 'hi')
+        except gappy.exception.GapError as e:
+            assert e.description == 'unavailable'
+        else:
+            raise AssertionError('error swallowed')
+
+    retry = RetryPolicy(max_backoff=5)
+    assert retry.delay(0, {'Retry-After': '3600'}) == 5
+    assert retry.delay(0, {'Retry-After': '2'}) == 2
+
+
+def test_payload_encoding():
+    keyboard = [[{'text': 'a', 'cb_data': 'x', 'url': None}]]
+    p = gappy._message_payload(1, 'text', 'hi', None, keyboard, None)
+    assert p == {'chat_id': 1, 'type': 'text', 'data': 'hi',
+                 'inline_keyboard': '[[{"text":"a","cb_data":"x"}]]'}
+    assert gappy._message_payload(1, 'text', 'hi', None, keyboard, None) == p
+
+    keyboard[0][0]['text'] = 'b'
+    assert gappy._message_payload(1, 'text', 'hi', None, keyboard, None)['inline_keyboard'] == \
+        '[[{"text":"b","cb_data":"x"}]]'
+    assert gappy._rectify({'form': keyboard, 'n': None, 'f': 1.5}) == {'form': '[[{"text":"b","cb_data":"x"}]]', 'f': 1.5}
+
+
+def test_webhook():
+    import io
+    import urllib.request
+    from gappy.webhook import Webhook
+
+    webhook = Webhook(workers=2, maxsize=5)
+    texts = []
+    others = []
+    release = threading.Event()
+
+    @webhook.on('text')
+    def on_text(update):
+        release.wait(2)
+        texts.append((update.chat_id, update.data))
+
+    @webhook.on()
+    def on_other(update):
+        others.append(update.type)
+
+    def post_wsgi(body):
+        status = []
+        environ = {'REQUEST_METHOD': 'POST', 'CONTENT_LENGTH': str(len(body)),
+                   'CONTENT_TYPE': 'application/x-www-form-urlencoded', 'wsgi.input': io.BytesIO(body)}
+        text = b''.join(webhook.wsgi_app(environ, lambda s, h: status.append(s)))
+        return status[0], text
+
+    assert post_wsgi(b'type=text&chat_id=1&data=hello') == ('200 OK', b'OK')
+    assert post_wsgi(b'chat_id=1')[0].startswith('400')
+
+    async def post_asgi(body):
+        sent = []
+        messages = [{'type': 'http.request', 'body': body, 'more_body': False}]
+
+        async def receive():
+            return messages.pop(0)
+
+        async def send(message):
+            sent.append(message)
+
+        scope = {'type': 'http', 'method': 'POST',
+                 'headers': [(b'content-type', b'application/json')]}
+        await webhook.asgi_app(scope, receive, send)
+        return sent[0]['status'], sent[1]['body']
+
+    assert asyncio.run(post_asgi(b'{"type": "text", "chat_id": "2", "data": "hi"}')) == (200, b'OK')
+
+    server = webhook.make_server('127.0.0.1', 0)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = 'http://127.0.0.1:%d/' % server.server_address[1]
+    assert urllib.request.urlopen(url, b'type=text&chat_id=3&data=yo').read() == b'OK'
+
+    # The workers are stuck on text updates, so the queue fills up
+    # and the endpoint answers at once instead of waiting.
+    statuses = [post_wsgi(b'type=join&chat_id=%d' % i)[0] for i in range(10)]
+    assert '503 Busy' in statuses
+
+    release.set()
+    webhook.close()
+    server.shutdown()
+    stats = webhook.stats()
+    assert sorted(texts) == [('1', 'hello'), ('2', 'hi'), ('3', 'yo')]
+    assert stats['dropped'] == statuses.count('503 Busy')
+    assert stats['handled'] == stats['received'] == 3 + len(others)
+
+
+def test_dispatcher():
+    with fakegap.FakeGap() as gap:
+        bot = gappy.Bot('TOKEN', base_url=gap.url, pool_size=8)
+        d = bot.dispatcher(workers=8)
+        futures = [d.send_text(n % 5, str(n)) for n in range(100)]
+        results = [f.result(5) for f in futures]
+        d.shutdown()
+
+    assert all('id' in r for r in results)
+    for chat in range(5):
+        sent = [c[2]['data'] for c in gap.calls if c[2]['chat_id'] == str(chat)]
+        assert sent == [str(n) for n in range(chat, 100, 5)]
+    stats = d.stats()
+    assert stats['completed'] == 100 and len(stats['depths']) == 8
+    for name in ('upload_file', 'get_last_message', 'close'):
+        assert not hasattr(d, name)
+
+
+def test_metrics():
+    with fakegap.FakeGap() as gap:
+        gap.script('deleteMessage', lambda fields: (404, {'error': 'message not found'}, {}))
+        bot = gappy.Bot('TOKEN', base_url=gap.url)
+        calls = []
+        bot.on_request(lambda method, params: calls.append(method))
+        collector = bot.add_metrics()
+
+        for n in range(3):
+            bot.send_text(n, 'hello')
+        try:
+            bot.delete_message(1, 2)
+        except gappy.exception.GapError:
+            pass
+        bot.upload_file('file', b'x' * 1000)
+
+    assert calls == ['sendMessage'] * 3 + ['deleteMessage', 'upload']
+    snapshot = collector.snapshot()
+    assert snapshot['sendMessage']['count'] == 3
+    assert snapshot['sendMessage']['histogram'][-1] == (float('inf'), 3)
+    assert snapshot['sendMessage']['bytes_out'] > 0 and snapshot['sendMessage']['bytes_in'] > 0
+    assert snapshot['deleteMessage']['errors'] == {'message not found': 1}
+    assert snapshot['upload']['bytes_out'] > 1000
+
+    text = collector.prometheus()
+    assert 'gappy_requests_total{method="sendMessage"} 3' in text
+    assert 'gappy_request_errors_total{method="deleteMessage",reason="message not found"} 1' in text
+    assert 'gappy_request_duration_seconds_bucket{method="sendMessage",le="+Inf"} 3' in text
+
+
+def test_history():
+    h = gappy.history.MessageHistory(per_chat=3, max_chats=2)
+    assert h.last() is None and h.recent(1) == []
+
+    def send(chat):
+        for n in range(100):
+            h.record({'chat_id': chat, 'data': n})
+    threads = [threading.Thread(target=send, args=(chat,)) for chat in (1, 2, 3)]
+    for th in threads:
+        th.start()
+    for th in threads:
+        th.join()
+
+    assert len(h) == 2
+    for chat in (1, 2, 3):
+        recent = h.recent(chat)
+        assert recent == [] or [m['data'] for m in recent] == [97, 98, 99]
+    assert h.last()['data'] == 99
+
+    with fakegap.FakeGap() as gap:
+        bot = gappy.Bot('TOKEN', base_url=gap.url)
+        assert bot.get_last_message() == ''
+        bot.send_text(1, 'one')
+        bot.send_text(2, 'two')
+        bot.send_text(1, 'three')
+    assert bot.get_last_message()['data'] == 'three'
+    assert bot.get_last_message(2)['data'] == 'two'
+    assert [m['data'] for m in bot.get_recent_messages(1)] == ['one', 'three']
+    assert [m['data'] for m in bot.get_recent_messages(1, 1)] == ['three']
+
+
+def test_outbox():
+    path = os.path.join(tempfile.mkdtemp(), 'outbox.db')
+    retry = gappy.ratelimit.RetryPolicy(retries=100, backoff=0.01, max_backoff=0.01)
+
+    # nothing listening: calls stay on disk when the outbox is dropped
+    down = gappy.Bot('TOKEN', base_url='http://127.0.0.1:9')
+    box = down.outbox(path, retry=retry)
+    box.send_invoice(1, 1000, 'ticket', key='invoice-1')
+    box.send_text(1, 'paid', key='text-1')
+    keys = [box.send_text(n, 'hi', wait=False) for n in range(2, 50)]
+    box.flush()
+    assert box.pending() == 50
+    box.close(wait=False)
+
+    # committing goes on while the senders are stuck on an unreachable Gap
+    slow = gappy.ratelimit.RetryPolicy(retries=100, backoff=5, max_backoff=5)
+    box = down.outbox(os.path.join(tempfile.mkdtemp(), 'outbox.db'), workers=1, maxsize=2, retry=slow)
+    start = time.time()
+    for n in range(20):
+        box.send_text(n, 'hi')
+    assert time.time() - start < 2 and box.pending() == 20
+    box.close(wait=False)
+
+    with fakegap.FakeGap() as gap:
+        bot = gappy.Bot('TOKEN', base_url=gap.url)
+        box = bot.outbox(path, workers=4, retry=retry)
+        delivered = []
+        box.on_delivered(lambda entry, result: delivered.append(entry.key))
+        assert box.send_invoice(1, 1000, 'ticket', key='invoice-1') == 'invoice-1'
+
+        def enqueue(chat):
+            for n in range(50):
+                box.send_text(chat, str(n))
+        threads = [threading.Thread(target=enqueue, args=(chat,)) for chat in (100, 101, 102)]
+        for th in threads:
+            th.start()
+        for th in threads:
+            th.join()
+        box.close()
+
+        stats = box.stats()
+        assert stats['duplicate'] == 1
+        assert stats['delivered'] == 200 and stats['failed'] == 0
+        assert stats['commits'] < 200
+        assert set(keys) < set(delivered) and 'invoice-1' in delivered
+
+        calls = [c for c in gap.calls if c[0] == 'invoice']
+        assert len(calls) == 1
+        for chat in ('100', '101', '102'):
+            texts = [c[2]['data'] for c in gap.calls if c[2].get('chat_id') == chat]
+            assert texts == [str(n) for n in range(50)]
+
+        box = bot.outbox(path)
+        assert box.pending() == 0
+        assert not hasattr(box, 'get_last_message') and not hasattr(box, 'upload_file')
+        box.send_invoice(1, 1000, 'ticket', key='invoice-1')
+        box.close()
+        assert box.stats()['duplicate'] == 1
+
+        # a call that cannot be encoded fails alone, and a failed commit is retried
+        box = bot.outbox(os.path.join(tempfile.mkdtemp(), 'outbox.db'))
+        write, failures = box._write, [sqlite3.OperationalError('database is locked')]
+
+        def flaky(entries, acks):
+            if failures and entries:
+                raise failures.pop()
+            return write(entries, acks)
+        box._write = flaky
+        box.send_text(1, 'good', key='good', wait=False)
+        try:
+            box.put('sendMessage', {'chat_id': 1, 'data': object()}, wait=False)
+        except TypeError:
+            pass
+        else:
+            raise AssertionError('unencodable call queued')
+        box.send_text(1, 'after', key='after')
+        box.close()
+        assert not failures and box.stats()['delivered'] == 2 and box.stats()['failed'] == 0
+        assert [c[2]['data'] for c in gap.calls if c[0] == 'sendMessage' and c[2]['chat_id'] == '1'][-2:] == ['good', 'after']
+
+
+def test_codec():
+    backend = gappy.codec.backend
+    try:
+        for name in ('json', backend):
+            gappy.codec.use(name)
+            assert gappy.codec.loads(b'{"id":1}') == gappy.codec.loads('{"id":1}') == {'id': 1}
+            assert gappy.codec.dumps({'a': [1, 'b'], 2: None}) == '{"a":[1,"b"],"2":null}'
+            with fakegap.FakeGap() as gap:
+                bot = gappy.Bot('TOKEN', base_url=gap.url)
+                assert bot.send_text(1, 'hi', inline_keyboard=[[{'text': 'x'}]])['id']
+                assert bot.send_location(1, 1.5, 2.5)
+                assert bot.send_invoice(1, 1000, 'ticket')
+                gap.script('sendMessage', lambda fields: (502, b'<html>bad gateway</html>', {}))
+                try:
+                    bot.send_text(1, 'hi')
+                except gappy.exception.BadHTTPResponse as e:
+                    assert e.status == 502 and 'bad gateway' in e.text
+                else:
+                    assert False
+    finally:
+        gappy.codec.use(backend)
+
+
+def test_bot_pool():
+    tokens = ['A', 'B', 'C']
+    pool = gappy.BotPool(tokens)
+    chats = range(3000)
+    owners = [pool.token_for(chat) for chat in chats]
+    for token in tokens:
+        assert 800 < owners.count(token) < 1200
+    assert owners == [gappy.BotPool(tokens).token_for(str(chat)) for chat in chats]
+    grown = gappy.BotPool(tokens + ['D'])
+    for chat, owner in zip(chats, owners):
+        assert grown.token_for(chat) in (owner, 'D')
+
+    with fakegap.FakeGap() as gap:
+        pool = gappy.BotPool(tokens, base_url=gap.url)
+        collector = pool.add_metrics()
+        for chat in range(30):
+            pool.send_text(chat, 'hi')
+        pool.send_invoice(7, 1000, 'ticket')
+        pool.broadcast(range(30, 60), 'text', 'hello', workers=4).run()
+        pool.close()
+    sent = [(int(c[2]['chat_id']), c[1]['token']) for c in gap.calls]
+    assert len(sent) == 61
+    assert all(token == pool.token_for(chat) for chat, token in sent)
+    assert set(token for _, token in sent) == set(tokens)
+    assert collector.snapshot()['sendMessage']['count'] == 60
+
+    # files are uploaded, and cached, under the token sending them
+    with fakegap.FakeGap() as gap:
+        pool = gappy.BotPool(tokens, base_url=gap.url, upload_cache=gappy.upload.UploadCache())
+        for chat in range(6):
+            pool.send_image(chat, b'logo')
+        pool.broadcast(range(6, 30), 'image', b'banner', workers=4).run()
+        pool.close()
+    uploads = [c for c in gap.calls if c[0] == 'upload']
+    assert len(uploads) == len(set(owners[:6])) + len(tokens)
+    # requests come one at a time up to the broadcast, so ids follow the calls
+    owner = {'sid-%d' % n: c[1]['token'] for n, c in enumerate(gap.calls, 1) if c[0] == 'upload'}
+    for method, headers, fields, _ in gap.calls:
+        if method == 'sendMessage':
+            assert owner[json.loads(fields['data'])['SID']] == headers['token']
+
+
+def burn(data):
+    if data.get('fail'):
+        raise ValueError(data['fail'])
+    return data['chat_id'], os.getpid(), sum(i * i for i in range(data.get('n', 1000)))
+
+
+def burn_update(update):
+    return burn(update.fields)
+
+
+def crash():
+    os._exit(1)
+
+
+def nap(seconds):
+    time.sleep(seconds)
+    return seconds
+
+
+def refuse():
+    raise ValueError('refused')
+
+
+class Unreadable(object):
+    def __reduce__(self):
+        return refuse, ()
+
+
+def unreadable():
+    return Unreadable()
+
+
+def test_process_executor():
+    executor = gappy.process.ProcessExecutor(2, maxsize=4)
+    futures = [(chat, executor.submit(chat, burn, {'chat_id': chat, 'n': 10000}))
+               for chat in range(4) for _ in range(5)]
+    pids = {}
+    for chat, future in futures:
+        result_chat, pid, _ = future.result(10)
+        assert result_chat == chat
+        pids.setdefault(chat, set()).add(pid)
+    assert all(len(p) == 1 for p in pids.values())
+    assert os.getpid() not in set.union(*pids.values())
+    try:
+        executor.submit(1, burn, {'fail': 'boom'}).result(10)
+    except ValueError as e:
+        assert e.args == ('boom',)
+    else:
+        assert False
+
+    s = gappy.Bot.Scheduler(executor=executor)
+    s.on_event(burn)
+    for chat in range(10):
+        s.event_now({'chat_id': chat})
+    s.run_as_thread()
+
+    webhook = gappy.webhook.Webhook(workers=2, executor=executor)
+    webhook.on('text')(burn_update)
+    for chat in range(10):
+        webhook.feed(json.dumps({'type': 'text', 'chat_id': chat}).encode(), 'application/json')
+
+    deadline = time.time() + 10
+    while time.time() < deadline and (executor.stats()['completed'] < 40 or webhook.stats()['handled'] < 10):
+        time.sleep(0.01)
+    webhook.close()
+    executor.shutdown()
+    stats = executor.stats()
+    assert stats['completed'] == 40 and stats['failed'] == 1 and stats['alive'] == 0
+    assert sum(stats['depths']) == 0
+    assert all(0 < u < 1 for u in stats['utilization'])
+
+    # a dead process is replaced; a result that cannot be read fails alone
+    executor = gappy.process.ProcessExecutor(1, maxsize=1)
+    try:
+        executor.submit(0, crash).result(10)
+    except RuntimeError:
+        pass
+    else:
+        assert False
+    assert executor.submit(0, burn, {'chat_id': 0, 'n': 10}).result(10)[0] == 0
+    try:
+        executor.submit(0, unreadable).result(10)
+    except RuntimeError as e:
+        assert 'refused' in str(e)
+    else:
+        assert False
+    assert executor.submit(0, burn, {'chat_id': 0, 'n': 10}).result(10)[0] == 0
+    stats = executor.stats()
+    executor.shutdown()
+    assert stats['restarts'] == 1 and stats['alive'] == 1 and stats['depths'] == [0]
+
+    # a crash is noticed while another process keeps the results coming
+    executor = gappy.process.ProcessExecutor(2)
+    busy = [k for k in range(100) if executor._partition(k) != executor._partition(0)][0]
+    crashed = executor.submit(0, crash)
+    deadline = time.time() + 5
+    while not crashed.done() and time.time() < deadline:
+        executor.submit(busy, nap, 0.05).result(5)
+    assert isinstance(crashed.exception(0), RuntimeError)
+    assert executor.submit(0, nap, 0).result(5) == 0
+    executor.shutdown()
+
+
+def test_keyboard():
+    rows = [[{'text': 'Yes', 'cb_data': 'yes'}, {'text': 'No', 'cb_data': 'no', 'url': None}]]
+    fields = [{'name': 'email', 'type': 'text', 'label': 'Email'}]
+    inline = gappy.keyboard.InlineKeyboard(rows)
+    form = gappy.keyboard.Form(fields)
+    assert json.loads(inline.json) == [[{'text': 'Yes', 'cb_data': 'yes'}, {'text': 'No', 'cb_data': 'no'}]]
+    assert inline.rows[0][1]['text'] == 'No' and form.fields[0]['name'] == 'email'
+    assert inline == gappy.keyboard.InlineKeyboard(rows) and len({inline, gappy.keyboard.InlineKeyboard(rows)}) == 1
+    for change in (lambda: setattr(inline, 'json', '[]'),
+                   lambda: inline.rows[0][0].__setitem__('text', 'Maybe')):
+        try:
+            change()
+        except (AttributeError, TypeError):
+            pass
+        else:
+            raise AssertionError('changed')
+    for bad in (lambda: gappy.keyboard.InlineKeyboard([[{'cb_data': 'x'}]]),
+                lambda: gappy.keyboard.InlineKeyboard([]),
+                lambda: gappy.keyboard.Form([{'name': 'x'}])):
+        try:
+            bad()
+        except ValueError:
+            pass
+        else:
+            raise AssertionError('accepted')
+
+    # sent exactly as the plain structures would be
+    assert gappy._message_payload(1, 'text', 'hi', None, inline, form) == \
+        gappy._message_payload(1, 'text', 'hi', None, rows, fields)
+    assert gappy._rectify({'inline_keyboard': inline, 'form': form}) == \
+        {'inline_keyboard': inline.json, 'form': form.json}
+
+    bot = gappy.Bot('TOKEN')
+    reply = bot.reply_keyboard([[{'yes': 'Yes'}]])
+    assert json.loads(reply) == {'keyboard': '[[{"yes":"Yes"}]]', 'once': True, 'selective': False}
+    assert reply == gappy.keyboard.ReplyKeyboard([[{'yes': 'Yes'}]]).json
+    try:
+        bot.reply_keyboard({'yes': 'Yes'})
+    except ValueError:
+        pass
+    else:
+        raise AssertionError('accepted')
+
+
+def test_template():
+    inline = gappy.keyboard.InlineKeyboard([[{'text': 'Track', 'cb_data': 'track'}]])
+    tpl = gappy.template.Template('Hi {name}, order {order[id]} shipped', inline_keyboard=inline)
+    assert tpl.fields == {'name', 'order'}
+    p = tpl.render(5, {'name': 'Sara', 'order': {'id': 42}})
+    assert p == gappy._message_payload(5, 'text', 'Hi Sara, order 42 shipped', None, inline, None)
+    assert tpl.render(6, {'name': 'Ali', 'order': {'id': 1}})['data'] == 'Hi Ali, order 1 shipped'
+    assert gappy.template.Template('Hello').render(1)['data'] == 'Hello'
+    assert gappy.template.Template('Use {{code}}').render(1)['data'] == 'Use {code}'
+    assert gappy.template.Template('{{code}} {x}').render(1, {'x': 1})['data'] == '{code} 1'
+    try:
+        tpl.render(1)
+    except KeyError:
+        pass
+    else:
+        raise AssertionError('rendered without variables')
+    try:
+        gappy.template.Template('Hi {}')
+    except ValueError:
+        pass
+    else:
+        raise AssertionError('positional field accepted')
+
+    with fakegap.FakeGap() as gap:
+        bot = gappy.Bot('TOKEN', base_url=gap.url)
+        bot.send_template(1, tpl, name='Reza', order={'id': 7})
+        b = bot.broadcast_template(tpl, ((n, {'name': 'user%d' % n, 'order': {'id': n}}) for n in range(2, 30)),
+                                   workers=4)
+        results = b.run()
+        failed = bot.broadcast_template(tpl, [(99, {'name': 'x'})]).run()
+    assert b.succeeded == 28 and sorted(r.chat_id for r in results) == list(range(2, 30))
+    assert failed[0].chat_id == 99 and isinstance(failed[0].error, KeyError)
+    texts = {c[2]['chat_id']: c[2]['data'] for c in gap.calls}
+    assert texts['1'] == 'Hi Reza, order 7 shipped' and texts['29'] == 'Hi user29, order 29 shipped'
+    assert all(c[2]['inline_keyboard'] == inline.json for c in gap.calls)
+
+
+def test_edit_coalescing():
+    with fakegap.FakeGap() as gap:
+        bot = gappy.Bot('TOKEN', base_url=gap.url)
+        c = bot.coalescer(window=0.3)
+        first = c.edit_message(1, 10, 'progress 0%')
+        assert first.result(5) is not None
+        futures = [c.edit_message(1, 10, 'progress %d%%' % n) for n in range(1, 101)]
+        c.edit_message(1, 10, inline_keyboard=[[{'text': 'Stop', 'cb_data': 'stop'}]])
+        assert len(set(futures)) == 1
+        c.edit_message(2, 20, 'a').result(5)
+        c.edit_message(2, 20, 'b')
+        doomed = c.edit_message(3, 30, 'x')
+        doomed = c.edit_message(3, 30, 'y')
+        c.delete_message(3, 30).result(5)
+        futures[-1].result(5)
+        stats = c.stats()
+        c.close()
+        try:
+            c.delete_message(1, 10)
+        except RuntimeError:
+            pass
+        else:
+            raise AssertionError('closed coalescer took a delete')
+
+    assert doomed.cancelled()
+    edits = [c[2] for c in gap.calls if c[0] == 'editMessage']
+    progress = [e for e in edits if e['chat_id'] == '1']
+    assert [e['data'] for e in progress] == ['progress 0%', 'progress 100%']
+    assert 'stop' in progress[1]['inline_keyboard']
+    assert [e['data'] for e in edits if e['chat_id'] == '2'] == ['a', 'b']
+    assert not any(e['chat_id'] == '3' for e in edits)
+    assert [c[0] for c in gap.calls].count('deleteMessage') == 1
+    assert stats['requested'] == 106 and stats['cancelled'] == 1
+    assert stats['coalesced'] == 106 - 1 - stats['sent'] - stats['pending']
+
+
+# Microseconds `import gappy` may take, compiled modules cached; `requests`
+# alone takes several times this.
+IMPORT_BUDGET = 25000
+
+
+def test_import_time():
+    env = dict(os.environ, PYTHONPATH=os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+               PYTHONPYCACHEPREFIX=tempfile.mkdtemp())
+    env.pop('PYTHONDONTWRITEBYTECODE', None)
+    code = ('import sys, gappy; '
+            'print(" ".join(sorted(m for m in sys.modules if m == "requests" or m.startswith("gappy."))))')
+    timings = []
+    for _ in range(4):  # the first run compiles
+        p = subprocess.run([sys.executable, '-X', 'importtime', '-c', code], env=env,
+                           stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
+        assert p.returncode == 0, p.stderr
+        line = [l for l in p.stderr.splitlines() if l.endswith('| gappy')][0]
+        timings.append(int(line.split('|')[1]))
+    # only the transport and its codec are loaded, not requests
+    assert p.stdout.split() == ['gappy.api', 'gappy.codec', 'gappy.exception'], p.stdout
+    assert min(timings[1:]) < IMPORT_BUDGET, timings
+
+    # lazy submodules are reachable as attributes of the package
+    code = ('import gappy; '
+            'gappy.keyboard.InlineKeyboard([[{"text": "a"}]]); '
+            'print(" ".join(sorted(m for m in gappy._lazy_modules if getattr(gappy, m, None) is None)))')
+    p = subprocess.run([sys.executable, '-c', code], env=env,
+                       stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
+    assert p.returncode == 0 and not p.stdout.strip(), p.stdout + p.stderr
+
+
+if __name__ == '__main__':
+    test_async_bot()
+    test_connection_reuse()
+    test_scheduler()
+    test_scheduler_workers()
+    test_scheduler_store()
+    test_scheduler_recurring()
+    test_upload_file()
+    test_upload_cache()
+    test_upload_manager()
+    test_broadcast()
+    test_rate_limit_and_retry()
+    test_payload_encoding()
+    test_webhook()
+    test_dispatcher()
+    test_metrics()
+    test_history()
+    test_outbox()
+    test_codec()
+    test_bot_pool()
+    test_process_executor()
+    test_keyboard()
+    test_template()
+    test_edit_coalescing()
+    test_import_time()